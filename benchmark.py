@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+预算文件提取工具的性能基准。
+
+用法：
+    python benchmark.py imports [--repeat N]
+    python benchmark.py prefetch [--folder 文件夹] [--depth N] [--latency-ms MS] [--bandwidth MB]
+    python benchmark.py logging [--folder 文件夹] [--files N]
+    python benchmark.py service [--timeout 秒]
+
+每个基准打印测量结果，并与预算比较；超出预算时退出码为1，可放在计划任务或CI中检查性能回退。
+"""
+
+import argparse
+import builtins
+import filecmp
+import io
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# 导入耗时预算（毫秒，取多次测量的中位数）
+IMPORT_BUDGET_MS = {
+    "dlzb_runtime": 150,
+    "dlzb_store": 150,
+    "dlzb_budget_file": 250,
+    "dlzb_buget_file_details": 250,
+}
+
+# 导入模块时不应被加载的重量级依赖
+HEAVY_MODULES = ("pandas", "numpy", "openpyxl", "xlrd", "tkinter", "multiprocessing", "cProfile")
+
+# 命令行冷启动（解释器启动 + 导入 + 解析参数）耗时预算（毫秒）
+CLI_BUDGET_MS = 600
+
+# 预读基准：模拟网络共享时，预读相对不预读的最低加速比
+PREFETCH_MIN_SPEEDUP = 1.2
+
+# 日志基准：逐文件日志关闭（默认级别）时，被过滤掉的日志调用占每个文件处理耗时的比例上限
+LOGGING_MAX_OVERHEAD = 0.01
+
+_IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def _measure_import(module):
+    """在新的解释器中导入模块，返回 (耗时毫秒, 被连带加载的重量级依赖)"""
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout.split()
+    return float(output[0]), output[1].split(",") if len(output) > 1 else []
+
+
+def _measure_cli(script):
+    """以 --help 运行脚本，返回墙钟耗时（毫秒）"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, str(ROOT / script), "--help"], cwd=ROOT, capture_output=True, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def bench_imports(args):
+    """模块导入耗时与命令行冷启动耗时"""
+    ok = True
+    print(f"{'模块':<36}{'中位数(ms)':>12}{'预算(ms)':>10}  结果")
+    for module, budget in IMPORT_BUDGET_MS.items():
+        samples = []
+        heavy = []
+        for _ in range(args.repeat):
+            elapsed, heavy = _measure_import(module)
+            samples.append(elapsed)
+        median = statistics.median(samples)
+        passed = median <= budget and not heavy
+        ok &= passed
+        note = "通过" if passed else "超出预算"
+        if heavy:
+            note += f"（连带加载了 {', '.join(heavy)}）"
+        print(f"{module:<36}{median:>12.1f}{budget:>10}  {note}")
+
+    for script in ("dlzb_budget_file.py", "dlzb_buget_file_details.py"):
+        median = statistics.median(_measure_cli(script) for _ in range(args.repeat))
+        passed = median <= CLI_BUDGET_MS
+        ok &= passed
+        print(f"{script + ' --help':<36}{median:>12.1f}{CLI_BUDGET_MS:>10}  {'通过' if passed else '超出预算'}")
+    return ok
+
+
+def _make_workbooks(folder, count, rows):
+    """生成 count 个各有 rows 行明细的预算单（.xlsx），用作没有指定文件夹时的基准数据"""
+    import openpyxl
+    for i in range(count):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws["A2"] = "预算单"
+        ws["A4"] = f"WZ-FJ-2024{i % 12 + 1:02d}-{i:03d}"
+        ws["A6"] = f"WZBD2024{i:04d}"
+        for row in range(rows):
+            values = [row + 1, f"CH{row % 30:04d}", "滤网", "DN100", "304", "个", row % 20 + 1, "GB", "A",
+                      10.5 + row, "", row + 1, "否"]
+            for col, value in enumerate(values, 1):
+                ws.cell(row=9 + row, column=col, value=value)
+        wb.save(Path(folder) / f"WZ-FJ-2024{i % 12 + 1:02d}-{i:03d}.xlsx")
+
+
+@contextmanager
+def _throttled(folder, latency_ms, bandwidth_mb):
+    """
+    模拟网络共享：打开 folder 中的文件时先等待 延迟 + 文件大小/带宽
+
+    等待用 time.sleep，与真实的网络I/O一样释放GIL；预读线程与不预读时的解析使用同一个打开函数，
+    两种方式付出相同的读取代价。
+    """
+    real_open = io.open
+    prefix = os.path.join(os.path.abspath(folder), "")
+
+    def slow_open(file, *args, **kwargs):
+        if isinstance(file, (str, os.PathLike)):
+            path = os.path.abspath(os.fspath(file))
+            if path.startswith(prefix) and os.path.isfile(path):
+                time.sleep(latency_ms / 1000 + os.path.getsize(path) / (bandwidth_mb * 1024 * 1024))
+        return real_open(file, *args, **kwargs)
+
+    builtins.open = io.open = slow_open
+    try:
+        yield
+    finally:
+        builtins.open = io.open = real_open
+
+
+def _corrupt_archive(folder):
+    """生成含一个压缩数据损坏成员的ZIP归档（另有一个完好的成员），返回归档路径"""
+    import zipfile
+
+    members = sorted(Path(folder).glob("*.xlsx"))[:2]
+    archive = Path(folder) / "损坏.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.write(members[0], "完好.xlsx")
+        zf.write(members[1], "损坏.xlsx")
+    with zipfile.ZipFile(archive) as zf:
+        info = zf.getinfo("损坏.xlsx")
+    data = bytearray(archive.read_bytes())
+    start = info.header_offset + 30 + len(info.filename.encode("utf-8")) + len(info.extra) + 10
+    data[start:start + 50] = bytes(value ^ 0xFF for value in data[start:start + 50])
+    archive.write_bytes(bytes(data))
+    return archive
+
+
+def _prefetch_survives_corrupt_archive(tmp, depth, timeout=60):
+    """预读遇到损坏的ZIP成员时，明细提取应照常结束（该成员记为出错），而不是一直等待"""
+    import threading
+    from dlzb_buget_file_details import extract_details_from_folder
+
+    folder = Path(tmp) / "corrupt"
+    folder.mkdir()
+    _make_workbooks(folder, 2, 5)
+    archive = _corrupt_archive(folder)
+    for member in folder.glob("*.xlsx"):
+        member.unlink()
+    errors = []
+    worker = threading.Thread(target=lambda: extract_details_from_folder(
+        folder, Path(tmp) / "损坏归档.csv", log_callback=errors.append, archives=True, prefetch=depth), daemon=True)
+    worker.start()
+    worker.join(timeout)
+    finished = not worker.is_alive()
+    reported = any("出错" in message for message in errors)
+    print(f"损坏的ZIP成员（{archive.name}）+ 预读{depth}个文件：{'正常结束' if finished else f'{timeout}秒内未结束'}"
+          f"{'，已报告读取出错' if reported else ''}")
+    return finished and reported
+
+
+def bench_prefetch(args):
+    """预读对读取慢的文件夹（模拟网络共享）的效果：明细提取不预读与预读的耗时对比"""
+    from dlzb_buget_file_details import extract_details_from_folder
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.folder
+        if folder is None:
+            folder = Path(tmp) / "data"
+            folder.mkdir()
+            _make_workbooks(folder, args.files, args.rows)
+        outputs = {}
+        samples = {0: [], args.depth: []}
+        for _ in range(args.repeat):
+            for depth in samples:
+                outputs[depth] = Path(tmp) / f"明细_预读{depth}.csv"
+                start = time.perf_counter()
+                with _throttled(folder, args.latency_ms, args.bandwidth):
+                    extract_details_from_folder(folder, outputs[depth], prefetch=depth,
+                                                prefetch_memory_mb=args.memory)
+                samples[depth].append(time.perf_counter() - start)
+        same = filecmp.cmp(outputs[0], outputs[args.depth], shallow=False)
+
+    baseline = statistics.median(samples[0])
+    prefetched = statistics.median(samples[args.depth])
+    speedup = baseline / prefetched if prefetched else float("inf")
+    passed = same and speedup >= PREFETCH_MIN_SPEEDUP
+    print(f"模拟网络共享：每次打开延迟 {args.latency_ms}ms，带宽 {args.bandwidth}MB/s")
+    print(f"{'方式':<16}{'中位数(s)':>12}")
+    print(f"{'不预读':<16}{baseline:>12.2f}")
+    print(f"{f'预读{args.depth}个文件':<16}{prefetched:>12.2f}")
+    note = "通过" if passed else "未达到预期"
+    if not same:
+        note += "（两种方式的输出不一致）"
+    print(f"加速比 {speedup:.2f}（预期至少 {PREFETCH_MIN_SPEEDUP}）  {note}")
+    with tempfile.TemporaryDirectory() as tmp:
+        passed &= _prefetch_survives_corrupt_archive(tmp, args.depth)
+    return passed
+
+
+def _service_task(task_id, file_path, *args):
+    """
+    服务基准的工作进程任务：文件名含"卡住"的文件开始后不再结束，
+    含"慢"的文件先等待 timeout 的八成（不计入超时）再照常提取，其余文件照常提取
+    """
+    import dlzb_service
+
+    name = Path(file_path).name
+    if "卡住" in name:
+        dlzb_service._report_start(task_id)
+        time.sleep(3600)
+    elif "慢" in name:
+        time.sleep(float(os.environ["DLZB_BENCH_SERVICE_DELAY"]))
+    return dlzb_service._extract_task(task_id, file_path, *args)
+
+
+def _post_json(url, body, results, key):
+    import json
+    import urllib.request
+
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        results[key] = (json.loads(response.read()), time.perf_counter() - start)
+
+
+def bench_service(args):
+    """本地HTTP服务的超时回收：卡住的文件应返回timeout，同时进行的请求照常完成，进程池回收后重新预热"""
+    import threading
+    from http.server import ThreadingHTTPServer
+    from dlzb_service import ExtractionHandler, ExtractionService
+
+    class HangingService(ExtractionService):
+        task = staticmethod(_service_task)
+
+    class QuietHandler(ExtractionHandler):
+        def log_message(self, *args):
+            pass
+
+    os.environ["DLZB_BENCH_SERVICE_DELAY"] = str(args.timeout * 0.8)
+    with tempfile.TemporaryDirectory() as tmp:
+        hung, other = Path(tmp) / "hung", Path(tmp) / "other"
+        for folder in (hung, other):
+            folder.mkdir()
+            _make_workbooks(folder, 3, 5)
+        first = sorted(hung.glob("*.xlsx"))[0]
+        first.rename(hung / "卡住.xlsx")
+        first = sorted(other.glob("*.xlsx"))[0]
+        first.rename(other / "慢.xlsx")
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+        server.daemon_threads = True
+        server.service = service = HangingService(workers=2, timeout=args.timeout)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/extract"
+        try:
+            old_pool = service._pool
+            results = {}
+            # 卡住的文件占用一个工作进程；另一个请求在进程池回收时正在处理，其文件应重新提交并照常完成
+            requests = [threading.Thread(target=_post_json, args=(url, {"folder": str(hung)}, results, "hung")),
+                        threading.Thread(target=_post_json, args=(url, {"folder": str(other)}, results, "other"))]
+            requests[0].start()
+            time.sleep(args.timeout / 3)
+            requests[1].start()
+            for thread in requests:
+                thread.join(args.timeout * 10)
+            _post_json(url, {"folder": str(other)}, results, "after")
+        finally:
+            server.shutdown()
+            service.close()
+
+    statuses = {key: {Path(item["路径"]).name: item["状态"] for item in body["files"]}
+                for key, (body, _) in results.items()}
+    checks = {
+        "卡住的文件返回timeout": statuses.get("hung", {}).get("卡住.xlsx") == "timeout",
+        "同时进行的请求全部完成": bool(statuses.get("other"))
+                                  and set(statuses["other"].values()) == {"ok"},
+        "进程池已回收并重新预热": service.pool_restarts == 1 and service._pool is not old_pool
+                                  and set(statuses.get("after", {}).values()) == {"ok"},
+    }
+    for name, key in (("卡住的请求", "hung"), ("同时进行的请求", "other"), ("回收后的请求", "after")):
+        if key in results:
+            print(f"{name}：{results[key][1]:.2f}秒  {statuses[key]}")
+    for name, ok in checks.items():
+        print(f"{name}：{'通过' if ok else '未通过'}")
+    return all(checks.values())
+
+
+class _CountingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def bench_logging(args):
+    """逐文件日志的开销：默认级别（逐文件信息被过滤）、日志完全禁用与全部输出时的汇总提取耗时"""
+    import timeit
+    from dlzb_budget_file import extract_filenames_to_excel
+    from dlzb_runtime import LOGGER, set_log_level
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = args.folder
+        if folder is None:
+            folder = Path(tmp) / "data"
+            folder.mkdir()
+            _make_workbooks(folder, args.files, 5)
+        output = str(Path(tmp) / "汇总.csv")
+
+        def run(level):
+            set_log_level(level)
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                file_info = extract_filenames_to_excel(folder, output, True, report_file=False, raise_errors=True)
+            return time.perf_counter() - start, len(file_info)
+
+        original = LOGGER.level
+        modes = {"默认（逐文件信息被过滤）": logging.WARNING, "日志完全禁用": None, "全部输出（-vv）": logging.DEBUG}
+        samples = {mode: [] for mode in modes}
+        try:
+            # 统计每个文件的日志调用次数（DEBUG 级别时每次调用都产生一条记录）
+            counter = _CountingHandler()
+            LOGGER.addHandler(counter)
+            _, files = run(logging.DEBUG)
+            LOGGER.removeHandler(counter)
+            for _ in range(args.repeat):
+                for mode, level in modes.items():
+                    if level is None:
+                        logging.disable(logging.CRITICAL)
+                    try:
+                        samples[mode].append(run(level or logging.WARNING)[0])
+                    finally:
+                        logging.disable(logging.NOTSET)
+            set_log_level(logging.WARNING)
+            probe = logging.getLogger("dlzb.summary")
+            per_call = min(timeit.repeat(lambda: probe.debug("√ 文件 %s 的事业部预算编号验证通过", "WZ"),
+                                         number=10000, repeat=5)) / 10000
+        finally:
+            set_log_level(original)
+
+    medians = {mode: statistics.median(values) for mode, values in samples.items()}
+    per_file = medians["默认（逐文件信息被过滤）"] / max(files, 1)
+    calls_per_file = counter.count / max(files, 1)
+    overhead = calls_per_file * per_call / per_file if per_file else 0.0
+    passed = overhead <= LOGGING_MAX_OVERHEAD
+    print(f"{files} 个文件，每个文件 {calls_per_file:.1f} 次日志调用，被过滤的调用每次 {per_call * 1e9:.0f}ns")
+    print(f"{'方式':<20}{'中位数(s)':>12}{'每文件(ms)':>12}")
+    for mode, median in medians.items():
+        print(f"{mode:<20}{median:>12.3f}{median / max(files, 1) * 1000:>12.2f}")
+    print(f"被过滤的日志调用占处理耗时 {overhead:.4%}（上限 {LOGGING_MAX_OVERHEAD:.0%}）  "
+          f"{'通过' if passed else '超出预算'}")
+    return passed
+
+
+BENCHMARKS = {
+    "imports": bench_imports,
+    "prefetch": bench_prefetch,
+    "logging": bench_logging,
+    "service": bench_service,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="预算文件提取工具性能基准")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    imports = sub.add_parser("imports", help=bench_imports.__doc__)
+    imports.add_argument("--repeat", type=int, default=5, help="测量次数，取中位数（默认：5）")
+    prefetch = sub.add_parser("prefetch", help=bench_prefetch.__doc__)
+    prefetch.add_argument("--folder", default=None, help="测试文件夹，默认生成一批预算单")
+    prefetch.add_argument("--files", type=int, default=40, help="生成的预算单数量（默认：40）")
+    prefetch.add_argument("--rows", type=int, default=300, help="生成的每个预算单的明细行数（默认：300）")
+    prefetch.add_argument("--depth", type=int, default=4, help="预读深度（默认：4）")
+    prefetch.add_argument("--memory", type=float, default=256, help="预读内存上限MB（默认：256）")
+    prefetch.add_argument("--latency-ms", type=float, default=30, help="模拟的每次打开延迟（毫秒，默认：30）")
+    prefetch.add_argument("--bandwidth", type=float, default=2, help="模拟的读取带宽（MB/s，默认：2）")
+    prefetch.add_argument("--repeat", type=int, default=3, help="测量次数，取中位数（默认：3）")
+    logs = sub.add_parser("logging", help=bench_logging.__doc__)
+    logs.add_argument("--folder", default=None, help="测试文件夹，默认生成一批预算单")
+    logs.add_argument("--files", type=int, default=100, help="生成的预算单数量（默认：100）")
+    logs.add_argument("--repeat", type=int, default=3, help="测量次数，取中位数（默认：3）")
+    service = sub.add_parser("service", help=bench_service.__doc__)
+    service.add_argument("--timeout", type=float, default=3, help="服务的单个文件处理时间上限（秒，默认：3）")
+    args = parser.parse_args(argv)
+    return 0 if BENCHMARKS[args.benchmark](args) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,283 +1,515 @@
-import pandas as pd
-import openpyxl
-import xlrd
+import logging
 import os
 import re
 import time
+from contextlib import nullcontext
 from pathlib import Path
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from openpyxl.utils import get_column_letter
+
+# pandas、openpyxl、xlrd 导入较慢，在用到它们的函数中再导入，
+# 使只提取文件名的运行、命令行帮助和子进程启动不必为此付出时间
+
+from dlzb_runtime import (StageTimer, StrategyStats, STRATEGY_LABELS, RunProfiler, IsolatedPool, write_stage_rows,
+                          write_strategy_sheet, default_report_path, default_profile_path, write_run_report,
+                          discover_excel_files, check_folders, UIEventChannel, pump_channel, RunControl,
+                          select_shard, shard_key, parse_shard, is_budget_form, excel_path, workbook_source,
+                          open_xls, link_target, Prefetcher, largest_first, format_utilization,
+                          EventStream, events_on_stdout, set_log_level, verbosity_level, format_warning_counts)
+from dlzb_store import (ResultStore, default_checkpoint_path, run_fingerprint, remove_store, save_partial,
+                        missing_shards, default_partial_path, PARTIAL_SUFFIX, SnapshotStore, default_snapshot_path,
+                        content_hash, check_run_options)
+
+# 提取规则变化时递增，使旧的缓存结果失效
+CACHE_VERSION = 1
+
+# 每个文件的处理信息按级别过滤（见 dlzb_runtime.LOGGER），默认只输出警告及以上
+log = logging.getLogger("dlzb.summary")
+
+# 从Excel内容中提取的字段（与输出列顺序一致）
+CONTENT_FIELDS = ['事业部预算编号', '合同号', '部门（显示值）', '单据编号', '备注', '制单日期', '制单人']
 
 # 全局变量用于统计
-stats = {
-    "total_files": 0,
-    "processed_files": 0,
-    "matched_budgets": 0,
-    "unmatched_budgets": 0,
-    "extracted_from_filename": 0,
-    "missing_data": {
-        "事业部预算编号": 0,
-        "合同号": 0,
-        "部门（显示值）": 0,
-        "单据编号": 0,
-        "备注": 0,
-        "制单日期": 0,
-        "制单人": 0
+def _new_stats():
+    """创建一份新的统计数据"""
+    return {
+        "total_files": 0,
+        "processed_files": 0,
+        "matched_budgets": 0,
+        "unmatched_budgets": 0,
+        "extracted_from_filename": 0,
+        "missing_data": {
+            "事业部预算编号": 0,
+            "合同号": 0,
+            "部门（显示值）": 0,
+            "单据编号": 0,
+            "备注": 0,
+            "制单日期": 0,
+            "制单人": 0
+        },
+        # 分阶段耗时
+        "timings": StageTimer(),
+        # 各字段各提取策略的命中次数与耗时
+        "strategies": StrategyStats(),
+        # 每个文件的处理耗时 [(文件名, 耗时秒, 文件大小字节), ...]
+        "file_times": [],
+        # 使用只读流式方式读取的大文件数
+        "streamed_files": 0,
+        # 直接使用缓存结果的文件数
+        "cached_files": 0,
+        # 从检查点恢复的文件数
+        "resumed_files": 0,
+        # 超时、内存超限或子进程崩溃而跳过的文件 [(文件名, 原因), ...]
+        "failed_files": [],
+        # 文件级警告 [(文件路径, 类别, 消息), ...]，由事件流输出
+        "warnings": []
     }
-}
 
-def extract_filenames_to_excel(folder_path, output_file="文件名列表.xlsx", extract_content=False, progress_callback=None):
+def _merge_stats(target, delta):
+    """把单个文件（通常来自子进程）的统计数据合并到 target"""
+    for key, value in delta.items():
+        if key == "missing_data":
+            for field, count in value.items():
+                target["missing_data"][field] += count
+        elif key in ("timings", "strategies"):
+            target[key].merge(value)
+        elif key in ("file_times", "failed_files", "warnings"):
+            target[key].extend(value)
+        elif key != "total_files":
+            target[key] += value
+
+def _note(run_stats, file_path, kind, message, level=logging.INFO):
+    """按级别记录文件级警告的日志，并记入统计数据的 warnings（run_stats 为None时使用全局stats）"""
+    log.log(level, message)
+    (stats if run_stats is None else run_stats)["warnings"].append((str(file_path), kind, message))
+
+stats = _new_stats()
+
+def iter_file_records(folder_path, extract_content=True, recursive=False, workers=0, timeout=None,
+                      max_memory_mb=None, streaming_threshold_mb=5, cache_dir=None, control=None, checkpoint=None,
+                      all_sheets=False, archives=False, prefetch=0, prefetch_memory_mb=256, schedule="largest"):
+    """
+    逐个产出文件夹中Excel文件的提取结果，每处理完一个文件产出一条，不读写全局统计数据
+    
+    Args:
+        folder_path: 文件夹路径，也可以是多个文件夹组成的列表
+        control: RunControl，用于暂停/取消并统计吞吐量；取消后不再产出新的记录
+        checkpoint: 检查点文件路径，已完成的文件定期写入其中，重新运行时直接产出（状态为"resumed"）
+        其余参数与 extract_filenames_to_excel 相同
+    
+    Yields:
+        每个文件一条记录（字典）：
+            index: 文件在发现顺序中的序号（使用子进程时产出顺序为完成顺序）
+            total: 文件总数
+            path: 文件Path对象（ZIP归档中的文件为 ArchiveMember）
+            status: "ok"、"cached"（使用缓存结果）、"resumed"（从检查点恢复）
+                    或 "skipped"（超时、内存超限或子进程崩溃）
+            data: 文件信息字典，文件无法访问时为None；all_sheets 时其他预算单工作表的记录
+                  在 data['_工作表'] 中（见 _expand_sheets）
+            stats: 该文件的统计数据（结构与 _new_stats() 相同），可用 _merge_stats 累加
+            reason: 跳过的原因，其他状态为None
+    
+    Raises:
+        ValueError: 文件夹不存在或不是文件夹
+    """
+    error = check_folders(folder_path)
+    if error:
+        raise ValueError(error)
+    excel_files = discover_excel_files(folder_path, recursive, archives)
+    yield from _iter_file_records(excel_files, extract_content, workers=workers, timeout=timeout,
+                                  max_memory_mb=max_memory_mb, streaming_threshold_mb=streaming_threshold_mb,
+                                  cache_dir=cache_dir, control=control, checkpoint=checkpoint,
+                                  checkpoint_kind=_checkpoint_kind(folder_path, recursive, extract_content,
+                                                                   all_sheets),
+                                  all_sheets=all_sheets, prefetch=prefetch, prefetch_memory_mb=prefetch_memory_mb,
+                                  schedule=schedule)
+
+def _checkpoint_kind(folder_path, recursive, extract_content, all_sheets=False):
+    """检查点记录类别：参数不同的运行不会复用彼此的检查点"""
+    folders = [folder_path] if isinstance(folder_path, (str, Path)) else list(folder_path)
+    fingerprint = run_fingerprint(sorted(str(Path(f).absolute()) for f in folders), bool(recursive),
+                                  bool(extract_content), bool(all_sheets))
+    return f"summary:v{CACHE_VERSION}:{fingerprint}"
+
+def _cache_kind(extract_content, all_sheets=False):
+    """结果缓存的记录类别"""
+    return f"summary:v{CACHE_VERSION}:{int(extract_content)}{':sheets' if all_sheets else ''}"
+
+def _iter_file_records(excel_files, extract_content, workers=0, timeout=None, max_memory_mb=None,
+                       streaming_threshold_mb=5, cache_dir=None, control=None, checkpoint=None,
+                       checkpoint_kind=None, snapshot_store=None, all_sheets=False, prefetch=0,
+                       prefetch_memory_mb=256, schedule="largest", utilization=None):
+    """
+    对已发现的文件列表逐个产出提取结果，见 iter_file_records
+
+    传入 snapshot_store（SnapshotStore）时，打开的每个工作簿的表头区域同时写入快照库；
+    快照库中还没有快照的文件不使用缓存和检查点结果，以便补齐快照。
+    prefetch 大于0时，在当前进程中依次处理的文件由 Prefetcher 提前读入内存（子进程处理时不预读）。
+    utilization 传入字典时，使用子进程处理后填入 workers（每个子进程的利用率）与 parallel_efficiency。
+    """
+    capture = snapshot_store is not None and extract_content
+    total = len(excel_files)
+    if control is not None:
+        control.start(total)
+    
+    def record(index, status, value, reason=None):
+        file_data, file_stats = value
+        if control is not None:
+            control.advance(rows=1 if file_data is not None else 0)
+        return {"index": index, "total": total, "path": excel_files[index], "status": status,
+                "data": file_data, "stats": file_stats, "reason": reason}
+    
+    # 检查点中已完成的文件直接恢复，未变化的文件直接使用缓存结果
+    stores = []
+    if checkpoint:
+        stores.append((ResultStore.checkpoint(checkpoint, checkpoint_kind), "resumed"))
+    if cache_dir:
+        stores.append((ResultStore.in_dir(cache_dir, _cache_kind(extract_content, all_sheets)), "cached"))
+    file_stat_cache = {}
+    pending = list(range(total))
+    try:
+        if stores:
+            pending = []
+            for index, file in enumerate(excel_files):
+                lookup_start = time.perf_counter()
+                try:
+                    file_stat_cache[index] = file.stat()
+                except OSError:
+                    pending.append(index)
+                    continue
+                if capture and not snapshot_store.has(file.absolute(), file_stat_cache[index], "header"):
+                    pending.append(index)
+                    continue
+                for store, status in stores:
+                    stored = store.get(file.absolute(), file_stat_cache[index])
+                    if stored is not None:
+                        break
+                else:
+                    pending.append(index)
+                    continue
+                file_data, stored_stats = stored
+                # 缓存或检查点中的文件不计入本次的耗时与策略统计
+                file_stats = _new_stats()
+                _merge_stats(file_stats, {key: value for key, value in stored_stats.items()
+                                          if key not in ("timings", "strategies", "file_times")})
+                file_stats[f"{status}_files"] = 1
+                file_stats["timings"].add("cache_lookup", time.perf_counter() - lookup_start)
+                yield record(index, status, (file_data, file_stats))
+        
+        def finish(index, value):
+            file_data, file_stats = value
+            snapshot = file_data.pop('_快照', None) if file_data is not None else None
+            if snapshot is not None:
+                snapshot_store.put(excel_files[index].absolute(), "header", snapshot)
+            if file_data is not None and index in file_stat_cache:
+                for store, _ in stores:
+                    store.put(excel_files[index].absolute(), file_stat_cache[index], value,
+                              file_stats["file_times"][0][1] if file_stats["file_times"] else 0.0)
+            return record(index, "ok", value)
+        
+        if workers or timeout or max_memory_mb:
+            if schedule == "largest":
+                # 按历史耗时或文件大小从大到小分配，小文件最后填补空闲的子进程
+                history = {}
+                for store, _ in stores:
+                    history.update(store.durations())
+                pending = largest_first(excel_files, pending, file_stat_cache, history)
+            # 在隔离的子进程中处理，超时或内存超限的文件被终止并记录，其余文件继续处理
+            pool = IsolatedPool(_process_file_task, workers=workers or 1, timeout=timeout,
+                                max_memory_mb=max_memory_mb)
+            tasks = [(str(excel_files[index]), extract_content, streaming_threshold_mb, capture, all_sheets)
+                     for index in pending]
+            for task_index, status, value in pool.run(tasks, control):
+                index = pending[task_index]
+                if status == "ok":
+                    yield finish(index, value)
+                else:
+                    file = excel_files[index]
+                    file_stats = _new_stats()
+                    file_stats["failed_files"].append((file.name, value))
+                    yield record(index, "skipped", (_empty_file_data(file, extract_content), file_stats), value)
+            if utilization is not None:
+                utilization.update(workers=pool.worker_stats, parallel_efficiency=pool.parallel_efficiency)
+        else:
+            depth = prefetch if extract_content else 0
+            with Prefetcher([excel_files[index] for index in pending], depth, prefetch_memory_mb) as prefetcher:
+                for index in pending:
+                    if control is not None and not control.checkpoint():
+                        break
+                    file, waited = prefetcher.take()
+                    value = _process_file_task(file, extract_content, streaming_threshold_mb, capture, all_sheets)
+                    if depth:
+                        value[1]["timings"].add("prefetch_wait", waited)
+                    yield finish(index, value)
+    finally:
+        for store, _ in stores:
+            store.close()
+
+def _iter_snapshot_records(files, extract_content, snapshot_store, control=None):
+    """按快照库中的表头区域快照逐个产出提取结果（状态为"snapshot"），记录结构见 iter_file_records"""
+    total = len(files)
+    if control is not None:
+        control.start(total)
+    for index, file in enumerate(files):
+        if control is not None and not control.checkpoint():
+            break
+        file_stats = _new_stats()
+        with file_stats["timings"].stage("snapshot_load"):
+            snapshot = snapshot_store.get(file, "header")
+        file_data = _process_snapshot(file, snapshot, extract_content, file_stats)
+        if control is not None:
+            control.advance(rows=1)
+        yield {"index": index, "total": total, "path": file, "status": "snapshot", "data": file_data,
+               "stats": file_stats, "reason": None}
+
+def extract_filenames_to_excel(folder_path, output_file="文件名列表.xlsx", extract_content=False, progress_callback=None,
+                               report_file=None, strategy_detail=False, profile=None, profile_top=20,
+                               workers=0, timeout=None, max_memory_mb=None, streaming_threshold_mb=5,
+                               recursive=False, cache_dir=None, raise_errors=False, control=None, checkpoint=False,
+                               shard=None, index=None, typed=False, snapshots=None, rules_only=False,
+                               all_sheets=False, archives=False, prefetch=0, prefetch_memory_mb=256,
+                               schedule="largest", events=None, changes=None):
     """
     提取指定文件夹中所有文件名并保存到Excel文件
     
     Args:
-        folder_path: 文件夹路径（字符串或Path对象）
-        output_file: 输出Excel文件名
+        folder_path: 文件夹路径（字符串或Path对象），也可以是多个文件夹组成的列表
+        output_file: 输出文件名，后缀为.csv时输出不带格式的CSV，否则输出.xlsx
         extract_content: 是否提取Excel文件内容
         progress_callback: 进度回调函数，用于更新GUI进度
+        report_file: JSON运行报告路径，默认为"<输出文件名>_运行报告.json"，传入False则不生成
+        strategy_detail: 是否额外输出每个文件各字段的提取来源（"字段来源明细"工作表）
+        profile: 性能剖析文件路径，传入True则使用"<输出文件名>_profile.prof"，默认不剖析
+        profile_top: 剖析摘要中列出的函数数量和最慢文件数量
+        workers: 隔离子进程数量，0表示在当前进程中依次处理
+        timeout: 单个文件的处理时间上限（秒），超时的文件被跳过并记录原因
+        max_memory_mb: 子进程常驻内存上限（MB），超限的文件被跳过并记录原因
+        streaming_threshold_mb: 超过该大小（MB）的.xlsx文件改用只读流式方式读取，None表示不启用
+        recursive: 是否递归处理子文件夹
+        cache_dir: 结果缓存目录，未变化的文件直接使用上次的提取结果；默认不使用缓存
+        raise_errors: 出错时抛出异常而不是打印后返回空列表
+        control: RunControl，用于暂停/取消并统计吞吐量；取消后用已提取的结果写出部分输出
+        checkpoint: 是否把已完成文件的结果定期写入检查点，传入True使用"<输出文件名>_检查点.sqlite"，
+            也可指定路径；中断后以相同参数重新运行会从检查点继续，正常完成后检查点被删除
+        shard: (序号, 分片数)，只处理按稳定哈希分到该分片的文件，并把结果写成部分结果文件
+            （output_file 为部分结果路径），各分片的部分结果用 merge_summary_partials 合并
+        index: 把每个文件的提取结果写入编号索引（见 dlzb_index.py），传入True使用输出目录中的
+            dlzb_index.sqlite，也可指定路径；未变化的已索引文件不会重复写入
+        typed: 是否把制单日期（Excel序列号或日期文本）转换为日期后输出，无法转换的值逐行列出
+        snapshots: 把每个工作簿的表头区域（单元格值与合并区域）按内容哈希保存到快照库，
+            传入True使用输出目录中的dlzb_snapshots.sqlite，也可指定路径
+        rules_only: 只按快照库中的快照重新运行提取规则，文件列表与单元格都来自快照库，
+            不访问原始文件；快照库由 snapshots 指定（默认同上）
+        all_sheets: 除主工作表外，也提取其他表头探测为预算单的工作表，每个工作表输出一条记录，
+            并增加"工作表"列；默认只读取活动工作表（快照只包含主工作表）
+        archives: 把文件夹中的ZIP归档当作文件夹，直接从归档读取其中的Excel文件（不解压到磁盘），
+            输出的文件路径为"归档.zip!成员路径"
+        prefetch: 预读深度，在处理当前文件的同时由后台线程把后面 prefetch 个文件读入内存，
+            适合网络共享等读取慢的位置；0表示不预读，使用子进程时不预读
+        prefetch_memory_mb: 预读内容（已读入但尚未处理）的内存上限（MB）
+        schedule: 使用子进程时的处理顺序，"largest"（默认）按历史耗时（需要 cache_dir 或检查点中的记录）
+            或文件大小从大到小，"discovery" 按发现顺序；输出顺序不受影响
+        events: 结构化事件流（JSON Lines，见 EventStream）的输出路径，"-" 表示标准输出，
+            也可传入 EventStream；默认不输出
+        changes: 与结果缓存中上次的提取结果比较，写出变化报告（新增、删除的文件与修改的字段，见
+            dlzb_reports.compare_runs），传入True使用"<输出文件名>_变化报告.xlsx"，也可指定.xlsx或.csv路径；
+            需要 cache_dir，不能用于分片或只按快照运行
+    
+    设置了timeout或max_memory_mb时，即使workers为0也会使用一个隔离子进程。
+    
+    Returns:
+        文件信息列表；文件夹不存在时返回None
     """
+    # 除剖析参数外原样传给 _extract_filenames；两者的参数不一致时调用即报错，不会在剖析运行中悄悄丢掉选项
+    options = {name: value for name, value in locals().items() if name not in ("profile", "profile_top")}
+    if profile:
+        profile_path = default_profile_path(Path(__file__).parent / output_file) if profile is True else profile
+        with RunProfiler(profile_path, top_n=profile_top) as profiler:
+            file_info = _extract_filenames(**options)
+        profiler.save(stats["file_times"])
+        return file_info
+    return _extract_filenames(**options)
+
+def _extract_filenames(folder_path, output_file, extract_content, progress_callback, report_file, strategy_detail,
+                       workers, timeout, max_memory_mb, streaming_threshold_mb, recursive, cache_dir, raise_errors,
+                       control, checkpoint, shard, index, typed, snapshots, rules_only, all_sheets, archives,
+                       prefetch, prefetch_memory_mb, schedule, events, changes):
+    """extract_filenames_to_excel 的主体（不含性能剖析），参数含义见该函数"""
+    global stats
+    stream = EventStream.open(events)
     try:
         start_time = time.time()
         
         # 重置统计数据
-        global stats
-        stats = {
-            "total_files": 0,
-            "processed_files": 0,
-            "matched_budgets": 0,
-            "unmatched_budgets": 0,
-            "extracted_from_filename": 0,
-            "missing_data": {
-                "事业部预算编号": 0,
-                "合同号": 0,
-                "部门（显示值）": 0,
-                "单据编号": 0,
-                "备注": 0,
-                "制单日期": 0,
-                "制单人": 0
-            }
-        }
+        stats = _new_stats()
+        timer = stats["timings"]
+        strategies = stats["strategies"]
         
-        # 确保folder_path是Path对象
-        folder = Path(folder_path)
+        # 确保folder_path是Path对象列表
+        folders = [Path(folder_path)] if isinstance(folder_path, (str, Path)) else [Path(f) for f in folder_path]
         
-        # 检查文件夹是否存在
-        if not folder.exists():
-            print(f"错误：文件夹 {folder} 不存在！")
-            return
-        if not folder.is_dir():
-            print(f"错误：{folder} 不是一个文件夹！")
+        # 检查文件夹是否存在（只按快照运行时不访问文件夹）
+        error = None if rules_only else check_folders(folders)
+        if error:
+            print(error)
             return
         
-        print("开始提取文件名...")
-        print(f"目标文件夹：{folder}")
+        # 确保输出路径在当前项目文件夹中
+        current_dir = Path(__file__).parent
+        output_path = current_dir / output_file
+        
+        # 确保输出文件有正确的后缀
+        if not shard and output_path.suffix.lower() not in ('.xlsx', '.csv'):
+            output_path = output_path.with_suffix('.xlsx')
+        
+        error = check_run_options(output_path, snapshots, rules_only, changes, cache_dir, shard)
+        if error:
+            raise ValueError(error)
+        snapshot_store = None
+        if snapshots or rules_only:
+            snapshot_path = default_snapshot_path(output_path) if snapshots in (None, True) else Path(snapshots)
+            snapshot_store = SnapshotStore(snapshot_path)
+        
+        print("开始提取文件名..." if not rules_only else f"按快照库 {snapshot_store.db_path} 重新运行提取规则...")
+        for folder in folders:
+            print(f"目标文件夹：{folder}")
         print("-" * 50)
         
         # 获取所有文件的详细信息
         file_info = []
-        excel_files = [f for f in folder.iterdir() if f.is_file() and f.suffix.lower() in ['.xls', '.xlsx']]
+        unreadable = []
+        with timer.stage("discovery"):
+            if rules_only:
+                excel_files = snapshot_store.paths("header", folders, recursive)
+            else:
+                excel_files = discover_excel_files(folders, recursive, archives, unreadable)
+                if snapshot_store is not None:
+                    snapshot_store.record_order(excel_files)
+            if shard:
+                excel_files = select_shard(excel_files, folders, shard)
+                unreadable = [item for item in unreadable if select_shard([item[0]], folders, shard)]
+                print(f"分片 {shard[0]}/{shard[1]}：{len(excel_files)} 个文件")
         stats["total_files"] = len(excel_files)
         
+        # 变化报告：在本次运行覆盖结果缓存之前读取上次的结果
+        previous = None
+        if changes:
+            with timer.stage("change_report"):
+                cache = ResultStore.in_dir(cache_dir, _cache_kind(extract_content, all_sheets))
+                previous = cache.results(folders, recursive)
+                cache.close()
+        if stream is not None:
+            stream.run_start("summary", len(excel_files), folders=[str(folder.absolute()) for folder in folders],
+                             output=str(output_path.absolute()))
+        # 无法读取的归档计入跳过的文件
+        for archive, reason in unreadable:
+            stats["failed_files"].append((archive.name, reason))
+            if stream is not None:
+                stream.warning(archive, "read_error", reason)
+        
+        checkpoint_path = None
+        if checkpoint:
+            checkpoint_path = default_checkpoint_path(output_path) if checkpoint is True else Path(checkpoint)
+        
+        index_db = None
+        if index:
+            from dlzb_index import BudgetIndex, default_index_path
+            index_db = BudgetIndex(default_index_path(output_path) if index is True else index)
+        
         # 进度显示
         total_files = len(excel_files)
         processed = 0
+        results = [None] * total_files
+        # 跳过的文件在输出中保留空行，但不参与变化比较
+        skipped = set()
         
-        for file in excel_files:
+        utilization = {}
+        if rules_only:
+            records = _iter_snapshot_records(excel_files, extract_content, snapshot_store, control)
+        else:
+            records = _iter_file_records(excel_files, extract_content, workers, timeout, max_memory_mb,
+                                         streaming_threshold_mb, cache_dir, control, checkpoint_path,
+                                         _checkpoint_kind(folders, recursive, extract_content, all_sheets),
+                                         snapshot_store, all_sheets, prefetch, prefetch_memory_mb, schedule,
+                                         utilization)
+        for record in records:
+            if record["status"] == "skipped":
+                log.warning("! 文件 %s 已跳过: %s", record['path'].name, record['reason'])
+                skipped.add(record["index"])
+            _merge_stats(stats, record["stats"])
+            results[record["index"]] = record["data"]
+            if stream is not None:
+                _emit_record(stream, record)
+            if index_db is not None and record["data"] is not None:
+                index_db.add_file(record["path"], record["data"])
+            
             # 更新进度
             processed += 1
             progress_percent = processed / total_files * 100
-            
             if progress_callback:
                 progress_callback(progress_percent)
-                
             if processed % 10 == 0 or processed == total_files:
                 print(f"处理进度: {processed}/{total_files} ({progress_percent:.1f}%)")
-            
-            try:
-                # 获取文件统计信息
-                stat = file.stat()
-                
-                # 保存文件的完整路径，用于之后创建超链接
-                file_path = str(file.absolute())
-                
-                file_data = {
-                    '文件名': file.stem,
-                    '文件路径': file_path,  # 添加文件路径字段
-                }
-                
-                # 如果需要提取文件内容
-                if extract_content:
-                    try:
-                        # 尝试读取Excel文件内容
-                        content_data = extract_excel_content(file)
-                        # 合并字典
-                        file_data.update(content_data)
-                    except Exception as e:
-                        print(f"警告：无法从文件 {file.name} 提取内容: {e}")
-                        # 创建空数据
-                        file_data.update({
-                            '事业部预算编号': '',
-                            '合同号': '',
-                            '部门（显示值）': '',
-                            '单据编号': '',
-                            '备注': '',
-                            '制单日期': '',
-                            '制单人': ''
-                        })
-                
-                file_info.append(file_data)
-                stats["processed_files"] += 1
-                
-            except Exception as e:
-                print(f"处理文件 {file.name} 时出错: {e}")
-        
-        # 创建DataFrame
-        df = pd.DataFrame(file_info)
-        
-        # 确保列的顺序一致
-        column_order = ['文件名']
-        if extract_content:
-            column_order.extend(['事业部预算编号', '合同号', '部门（显示值）', '单据编号', '备注', '制单日期', '制单人'])
-        
-        # 添加操作列
-        column_order.append('操作')
-        
-        # 重新排列列
-        for col in column_order:
-            if col not in df.columns:
-                df[col] = ''  # 如果某列不存在，添加空列
-        
-        # 按指定顺序重排列（但不包括文件路径列，它只用于创建超链接）
-        visible_columns = [col for col in column_order if col != '文件路径']
-        df_visible = df[visible_columns]
-        
-        # 确保输出路径在当前项目文件夹中
-        current_dir = Path(__file__).parent
-        output_path = current_dir / output_file
         
-        # 确保输出文件有正确的后缀
-        if not output_path.suffix.lower() == '.xlsx':
-            output_path = output_path.with_suffix('.xlsx')
-        
-        # 保存到Excel（不带格式）
-        df_visible.to_excel(output_path, index=False, engine='openpyxl')
-        
-        # 打开工作簿进行格式优化
-        from openpyxl import load_workbook
-        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-        from openpyxl.utils import get_column_letter
-        from openpyxl.worksheet.hyperlink import Hyperlink
-        
-        wb = load_workbook(output_path)
-        ws = wb.active
-        
-        # 定义样式
-        header_font = Font(name='微软雅黑', size=11, bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-        header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        hyperlink_font = Font(name='微软雅黑', size=10, color="0563C1", underline="single")
-        
-        # 定义边框样式
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        
-        # 设置表头样式
-        for col in range(1, ws.max_column + 1):
-            cell = ws.cell(row=1, column=col)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-            cell.border = thin_border
-        
-        # 获取操作列的列号
-        operation_col = None
-        for col in range(1, ws.max_column + 1):
-            if ws.cell(row=1, column=col).value == '操作':
-                operation_col = col
-                break
-        
-        # 设置数据区域样式和添加超链接
-        for row in range(2, ws.max_row + 1):
-            for col in range(1, ws.max_column + 1):
-                cell = ws.cell(row=row, column=col)
-                cell.alignment = Alignment(horizontal='left', vertical='center')
-                cell.border = thin_border
-                
-                # 为操作列添加超链接和文本
-                if col == operation_col:
-                    # 获取当前行对应的文件路径
-                    file_path = df.iloc[row-2]['文件路径']
-                    
-                    # 设置操作列的文本和样式
-                    cell.value = "打开文件"
-                    cell.font = hyperlink_font
-                    
-                    # 添加超链接
-                    cell.hyperlink = file_path
-        
-        # 自动调整列宽
-        for col in range(1, ws.max_column + 1):
-            column_letter = get_column_letter(col)
-            # 获取该列最长内容的长度
-            max_length = 0
-            for row in range(1, ws.max_row + 1):
-                cell_value = str(ws.cell(row=row, column=col).value or '')
-                if len(cell_value) > max_length:
-                    max_length = len(cell_value)
-            
-            # 设置列宽（根据内容长度计算，中文字符宽度需要调整）
-            adjusted_width = max_length * 1.2 + 4  # 中文字符宽度调整系数
-            ws.column_dimensions[column_letter].width = adjusted_width
-        
-        # 冻结首行
-        ws.freeze_panes = "A2"
-        
-        # 添加统计信息到新工作表
-        ws_stats = wb.create_sheet(title="统计信息")
-        
-        # 添加标题
-        ws_stats['A1'] = "提取统计信息"
-        ws_stats.merge_cells('A1:B1')
-        ws_stats['A1'].font = Font(name='微软雅黑', size=14, bold=True)
-        ws_stats['A1'].alignment = Alignment(horizontal='center')
-        
-        # 添加统计数据
-        ws_stats['A3'] = "总文件数"
-        ws_stats['B3'] = stats["total_files"]
-        ws_stats['A4'] = "成功处理文件数"
-        ws_stats['B4'] = stats["processed_files"]
-        ws_stats['A5'] = "预算编号匹配文件数"
-        ws_stats['B5'] = stats["matched_budgets"]
-        ws_stats['A6'] = "预算编号不匹配文件数"
-        ws_stats['B6'] = stats["unmatched_budgets"]
-        ws_stats['A7'] = "从文件名提取预算编号数"
-        ws_stats['B7'] = stats["extracted_from_filename"]
-        
-        # 缺失数据统计
-        ws_stats['A9'] = "缺失数据统计"
-        ws_stats.merge_cells('A9:B9')
-        ws_stats['A9'].font = Font(bold=True)
-        
-        row = 10
-        for field, count in stats["missing_data"].items():
-            ws_stats[f'A{row}'] = f"缺失{field}的文件数"
-            ws_stats[f'B{row}'] = count
-            row += 1
-        
-        # 设置统计表格的列宽
-        ws_stats.column_dimensions['A'].width = 25
-        ws_stats.column_dimensions['B'].width = 15
-        
-        # 保存格式化后的Excel
-        wb.save(output_path)
+        if index_db is not None:
+            print(f"编号索引已更新：{index_db.db_path.absolute()}")
+            index_db.close()
+        if snapshot_store is not None:
+            if not rules_only:
+                print(f"快照库已更新：{snapshot_store.db_path.absolute()}")
+            snapshot_store.close()
+        if stats["resumed_files"]:
+            print(f"{stats['resumed_files']} 个文件已在上次中断的运行中完成，从检查点恢复")
+        if control is not None and control.cancelled:
+            stats["cancelled"] = True
+            print(f"已取消：已处理 {processed}/{total_files} 个文件，输出部分结果")
+            if checkpoint_path:
+                print(f"检查点保留在 {checkpoint_path}，以相同参数重新运行可继续")
+        
+        file_info = [record for item in results if item is not None for record in _expand_sheets(item)]
+        
+        if shard:
+            # 分片运行只写出部分结果，由 dlzb_merge.py 合并成最终的汇总表
+            save_partial(output_path, "summary", shard,
+                         {"extract_content": bool(extract_content), "all_sheets": bool(all_sheets)},
+                         [(shard_key(file, folders), data) for file, data in zip(excel_files, results)],
+                         {key: value for key, value in stats.items() if key != "cancelled"},
+                         folders=[str(folder.absolute()) for folder in folders],
+                         elapsed_seconds=round(time.time() - start_time, 3), cancelled=bool(stats.get("cancelled")))
+        else:
+            write_summary_output(file_info, output_path, extract_content, stats, start_time, strategy_detail,
+                                 typed)
+        # 输出已完整写出，检查点不再需要；取消的运行保留检查点以便继续
+        if checkpoint_path and not stats.get("cancelled"):
+            remove_store(checkpoint_path)
+        
+        if previous is not None:
+            compared = [None if index in skipped else data for index, data in enumerate(results)]
+            change_path = _write_changes(previous, excel_files, compared, extract_content, all_sheets, cache_dir,
+                                         changes, output_path, timer)
+            print(f"变化报告：{change_path.absolute()}")
         
         end_time = time.time()
         elapsed_time = end_time - start_time
         
+        # 写入JSON运行报告
+        if report_file is not False:
+            report_path = write_run_report(
+                report_file or default_report_path(output_path),
+                timer,
+                folder=[str(folder.absolute()) for folder in folders],
+                output=str(output_path.absolute()),
+                elapsed_seconds=round(elapsed_time, 3),
+                stats={key: value for key, value in stats.items() if key not in ("timings", "strategies", "file_times", "warnings")},
+                strategies=strategies.summary(),
+                **utilization,
+                **({"sources": [
+                    {"文件名": item['文件名'], **item.get('_来源', {})} for item in file_info
+                ]} if strategy_detail else {}),
+            )
+            print(f"运行报告：{report_path.absolute()}")
+        if stream is not None:
+            stream.run_end(output=str(output_path.absolute()), elapsed_seconds=round(elapsed_time, 3),
+                           records=len(file_info), **_event_summary(stats))
+        
         print(f"完成：共提取 {len(file_info)} 个文件的详细信息")
         print(f"处理时间：{elapsed_time:.2f}秒")
         print(f"已保存到：{output_path.absolute()}")
@@ -288,18 +520,533 @@ def extract_filenames_to_excel(folder_path, output_file="文件名列表.xlsx",
         print(f"  预算编号匹配文件数: {stats['matched_budgets']}")
         print(f"  预算编号不匹配文件数: {stats['unmatched_budgets']}")
         print(f"  从文件名提取预算编号数: {stats['extracted_from_filename']}")
+        if stats["cached_files"]:
+            print(f"  使用缓存结果的文件数: {stats['cached_files']}")
+        if utilization.get("workers"):
+            for line in format_utilization(utilization["workers"], utilization["parallel_efficiency"]):
+                print(f"  {line}")
+        if stats["failed_files"]:
+            print(f"  跳过的文件数: {len(stats['failed_files'])}")
+        if stats["warnings"]:
+            print(f"  文件级警告: {format_warning_counts(stats['warnings'])}")
         print("  缺失数据统计:")
         for field, count in stats["missing_data"].items():
             print(f"    缺失{field}的文件数: {count}")
+        print("  阶段耗时:")
+        for name, item in timer.summary().items():
+            print(f"    {name}: 共{item['total']:.2f}秒, 平均{item['mean'] * 1000:.1f}毫秒, P95 {item['p95'] * 1000:.1f}毫秒")
         print("-" * 50)
         
         return file_info
             
     except Exception as e:
+        if stream is not None:
+            stream.emit("run_error", message=str(e))
+        if raise_errors:
+            raise
         print(f"出错：{e}")
         import traceback
         traceback.print_exc()
         return []
+    finally:
+        if stream is not None and stream is not events:
+            stream.close()
+
+def _write_changes(previous, excel_files, results, extract_content, all_sheets, cache_dir, changes, output_path,
+                   timer):
+    """
+    比较上次（结果缓存）与本次的提取结果并写出变化报告，已删除文件的缓存结果随之清除
+
+    Args:
+        previous: ResultStore.results 读取的上次结果
+        results: 本次的提取结果，出错或跳过的文件为None，不参与比较
+        changes: 变化报告路径，True表示使用输出文件对应的默认路径
+
+    Returns:
+        变化报告的Path对象
+    """
+    from dlzb_reports import compare_runs, change_counts, default_change_report_path, write_change_report
+    with timer.stage("change_report"):
+        current = {str(file.absolute()): _expand_sheets(data) if data is not None else None
+                   for file, data in zip(excel_files, results)}
+        before = {path: _expand_sheets(payload[0]) for path, payload in previous.items() if payload[0] is not None}
+        report = compare_runs(before, current, CONTENT_FIELDS if extract_content else [])
+        change_path = write_change_report(report, default_change_report_path(output_path) if changes is True
+                                          else Path(changes))
+        removed = [path for path in before if path not in current]
+        if removed:
+            cache = ResultStore.in_dir(cache_dir, _cache_kind(extract_content, all_sheets))
+            cache.discard(removed)
+            cache.close()
+    counts = change_counts(report)
+    print(f"与上次运行相比：{'，'.join(f'{kind} {count}' for kind, count in counts.items()) or '没有变化'}")
+    return change_path
+
+def _emit_record(stream, record):
+    """把一条文件记录（见 iter_file_records）的警告与完成事件写入事件流"""
+    file_stats, file_data = record["stats"], record["data"]
+    for path, kind, message in file_stats["warnings"]:
+        stream.warning(path, kind, message)
+    seconds, size = file_stats["file_times"][0][1:] if file_stats["file_times"] else (None, None)
+    status = "error" if file_data is None and record["status"] == "ok" else record["status"]
+    stream.file_done(record["index"], record["path"].absolute(), status, seconds, size,
+                     rows=len(_expand_sheets(file_data)) if file_data is not None else 0, reason=record["reason"])
+
+def _event_summary(run_stats):
+    """run_end 事件中的汇总统计"""
+    summary = {key: run_stats[key] for key in ("total_files", "processed_files", "matched_budgets",
+                                               "unmatched_budgets", "extracted_from_filename", "streamed_files",
+                                               "cached_files", "resumed_files")}
+    summary.update(failed_files=len(run_stats["failed_files"]), warnings=len(run_stats["warnings"]),
+                   cancelled=bool(run_stats.get("cancelled")))
+    return summary
+
+def merge_summary_partials(partials, output_file, strategy_detail=False, report_file=None):
+    """
+    把各分片的部分结果合并成最终的汇总表
+    
+    Args:
+        partials: dlzb_store.load_partials 读取的汇总部分结果列表
+        output_file: 输出文件路径，后缀为.csv时输出CSV，否则输出.xlsx
+        strategy_detail: 是否额外输出"字段来源明细"工作表
+        report_file: JSON运行报告路径，默认为"<输出文件名>_运行报告.json"，传入False则不生成
+    
+    合并结果按分片键（输入文件夹名/相对路径）排序，与分片数和各分片的完成顺序无关。
+    
+    Returns:
+        合并后的文件信息列表
+    """
+    start_time = time.time()
+    run_stats = _new_stats()
+    records = []
+    folders = []
+    for partial in partials:
+        _merge_stats(run_stats, partial["stats"])
+        run_stats["total_files"] += partial["stats"]["total_files"]
+        records.extend(partial["records"])
+        folders.extend(folder for folder in partial["folders"] if folder not in folders)
+        if partial.get("cancelled"):
+            run_stats["cancelled"] = True
+    run_stats["shards"] = len(partials)
+    run_stats["missing_shards"] = missing_shards(partials)
+    records.sort(key=lambda record: record[0])
+    file_info = [record for _, data in records if data is not None for record in _expand_sheets(data)]
+    
+    output_path = Path(output_file)
+    if output_path.suffix.lower() not in ('.xlsx', '.csv'):
+        output_path = output_path.with_suffix('.xlsx')
+    # 各分片并行运行，已用时间取最慢分片的耗时加上合并耗时
+    start_time -= max(partial["elapsed_seconds"] for partial in partials)
+    write_summary_output(file_info, output_path, partials[0]["options"]["extract_content"], run_stats, start_time,
+                         strategy_detail)
+    if report_file is not False:
+        report_path = write_run_report(
+            report_file or default_report_path(output_path),
+            run_stats["timings"],
+            folder=folders,
+            output=str(output_path.absolute()),
+            elapsed_seconds=round(time.time() - start_time, 3),
+            stats={key: value for key, value in run_stats.items() if key not in ("timings", "strategies", "file_times", "warnings")},
+            strategies=run_stats["strategies"].summary(),
+        )
+        print(f"运行报告：{report_path.absolute()}")
+    if run_stats["missing_shards"]:
+        print(f"警告：缺少分片 {', '.join(map(str, run_stats['missing_shards']))}，汇总表不完整")
+    print(f"已合并 {len(partials)} 个分片，共 {len(file_info)} 个文件，保存到：{output_path.absolute()}")
+    return file_info
+
+def write_summary_output(file_info, output_path, extract_content, run_stats, start_time, strategy_detail=False,
+                         typed=False):
+    """
+    将文件信息写入输出文件
+    
+    .xlsx输出带格式、超链接和统计信息工作表；.csv输出只包含数据。
+    
+    Args:
+        file_info: 文件信息列表
+        output_path: 输出文件Path对象
+        extract_content: 是否包含Excel内容字段
+        run_stats: 统计数据字典
+        start_time: 运行开始时间（time.time()），用于统计已用时间
+        strategy_detail: 是否输出"字段来源明细"工作表
+        typed: 是否把制单日期转换为日期（无法转换的值保留原文，并在"类型转换失败"工作表中列出）
+    """
+    import pandas as pd
+    
+    timer = run_stats["timings"]
+    
+    # 创建DataFrame
+    dataframe_start = time.perf_counter()
+    df = pd.DataFrame(file_info)
+    
+    # 确保列的顺序一致
+    column_order = ['文件名']
+    if '工作表' in df.columns:
+        column_order.append('工作表')
+    if extract_content:
+        column_order.extend(['事业部预算编号', '合同号', '部门（显示值）', '单据编号', '备注', '制单日期', '制单人'])
+    
+    # 添加操作列
+    column_order.append('操作')
+    
+    # 重新排列列
+    for col in column_order:
+        if col not in df.columns:
+            df[col] = ''  # 如果某列不存在，添加空列
+    
+    # 按指定顺序重排列（但不包括文件路径列，它只用于创建超链接）
+    visible_columns = [col for col in column_order if col != '文件路径']
+    timer.add("dataframe_build", time.perf_counter() - dataframe_start)
+    
+    conversion_failures = None
+    if typed and extract_content:
+        from dlzb_reports import convert_types
+        with timer.stage("type_conversion"):
+            conversion_failures = convert_types(df, date_columns=['制单日期'], context_column='文件名')
+        run_stats["conversion_failures"] = len(conversion_failures)
+    df_visible = df[visible_columns]
+    
+    # 输出CSV时不做格式化，保留文件路径列代替超链接，统计信息见JSON运行报告
+    if output_path.suffix.lower() == '.csv':
+        csv_columns = [col if col != '操作' else '文件路径' for col in visible_columns]
+        with timer.stage("excel_write"):
+            df[csv_columns].to_csv(output_path, index=False, encoding='utf-8-sig')
+            if conversion_failures is not None and len(conversion_failures):
+                from dlzb_reports import failure_csv_path
+                conversion_failures.to_csv(failure_csv_path(output_path), index=False, encoding='utf-8-sig')
+        return
+    
+    # 保存到Excel（不带格式）
+    with timer.stage("excel_write"):
+        df_visible.to_excel(output_path, index=False, engine='openpyxl')
+    restyle_start = time.perf_counter()
+    
+    # 打开工作簿进行格式优化
+    from openpyxl import load_workbook
+    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.hyperlink import Hyperlink
+    
+    wb = load_workbook(output_path)
+    ws = wb.active
+    
+    # 定义样式
+    header_font = Font(name='微软雅黑', size=11, bold=True, color="FFFFFF")
+    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
+    header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    hyperlink_font = Font(name='微软雅黑', size=10, color="0563C1", underline="single")
+    
+    # 定义边框样式
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    
+    # 设置表头样式
+    for col in range(1, ws.max_column + 1):
+        cell = ws.cell(row=1, column=col)
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = header_alignment
+        cell.border = thin_border
+    
+    # 获取操作列的列号
+    operation_col = None
+    for col in range(1, ws.max_column + 1):
+        if ws.cell(row=1, column=col).value == '操作':
+            operation_col = col
+            break
+    
+    # 设置数据区域样式和添加超链接
+    for row in range(2, ws.max_row + 1):
+        for col in range(1, ws.max_column + 1):
+            cell = ws.cell(row=row, column=col)
+            cell.alignment = Alignment(horizontal='left', vertical='center')
+            cell.border = thin_border
+            
+            # 为操作列添加超链接和文本
+            if col == operation_col:
+                # 获取当前行对应的文件路径
+                file_path = df.iloc[row-2]['文件路径']
+                
+                # 设置操作列的文本和样式
+                cell.value = "打开文件"
+                cell.font = hyperlink_font
+                
+                # 添加超链接
+                cell.hyperlink = link_target(file_path)
+    
+    # 自动调整列宽
+    for col in range(1, ws.max_column + 1):
+        column_letter = get_column_letter(col)
+        # 获取该列最长内容的长度
+        max_length = 0
+        for row in range(1, ws.max_row + 1):
+            cell_value = str(ws.cell(row=row, column=col).value or '')
+            if len(cell_value) > max_length:
+                max_length = len(cell_value)
+        
+        # 设置列宽（根据内容长度计算，中文字符宽度需要调整）
+        adjusted_width = max_length * 1.2 + 4  # 中文字符宽度调整系数
+        ws.column_dimensions[column_letter].width = adjusted_width
+    
+    # 冻结首行
+    ws.freeze_panes = "A2"
+    
+    timer.add("restyle", time.perf_counter() - restyle_start)
+    
+    # 添加统计信息到新工作表
+    ws_stats = wb.create_sheet(title="统计信息")
+    
+    # 添加标题
+    ws_stats['A1'] = "提取统计信息"
+    ws_stats.merge_cells('A1:B1')
+    ws_stats['A1'].font = Font(name='微软雅黑', size=14, bold=True)
+    ws_stats['A1'].alignment = Alignment(horizontal='center')
+    
+    # 添加统计数据
+    ws_stats['A3'] = "总文件数"
+    ws_stats['B3'] = run_stats["total_files"]
+    ws_stats['A4'] = "成功处理文件数"
+    ws_stats['B4'] = run_stats["processed_files"]
+    ws_stats['A5'] = "预算编号匹配文件数"
+    ws_stats['B5'] = run_stats["matched_budgets"]
+    ws_stats['A6'] = "预算编号不匹配文件数"
+    ws_stats['B6'] = run_stats["unmatched_budgets"]
+    ws_stats['A7'] = "从文件名提取预算编号数"
+    ws_stats['B7'] = run_stats["extracted_from_filename"]
+    
+    # 缺失数据统计
+    ws_stats['A9'] = "缺失数据统计"
+    ws_stats.merge_cells('A9:B9')
+    ws_stats['A9'].font = Font(bold=True)
+    
+    row = 10
+    for field, count in run_stats["missing_data"].items():
+        ws_stats[f'A{row}'] = f"缺失{field}的文件数"
+        ws_stats[f'B{row}'] = count
+        row += 1
+    
+    ws_stats[f'A{row}'] = "流式读取的大文件数"
+    ws_stats[f'B{row}'] = run_stats["streamed_files"]
+    row += 1
+    ws_stats[f'A{row}'] = "使用缓存结果的文件数"
+    ws_stats[f'B{row}'] = run_stats["cached_files"]
+    row += 1
+    if run_stats["resumed_files"]:
+        ws_stats[f'A{row}'] = "从检查点恢复的文件数"
+        ws_stats[f'B{row}'] = run_stats["resumed_files"]
+        row += 1
+    if "conversion_failures" in run_stats:
+        ws_stats[f'A{row}'] = "类型转换失败的值"
+        ws_stats[f'B{row}'] = run_stats["conversion_failures"]
+        row += 1
+    if run_stats.get("shards"):
+        ws_stats[f'A{row}'] = "合并的分片数"
+        ws_stats[f'B{row}'] = run_stats["shards"]
+        row += 1
+    if run_stats.get("missing_shards"):
+        ws_stats[f'A{row}'] = "缺少的分片"
+        ws_stats[f'B{row}'] = ", ".join(map(str, run_stats["missing_shards"]))
+        row += 1
+    if run_stats.get("cancelled"):
+        ws_stats[f'A{row}'] = "运行状态"
+        ws_stats[f'B{row}'] = "已取消（部分结果）"
+        row += 1
+    
+    # 分阶段耗时统计
+    ws_stats[f'A{row + 1}'] = "已用时间(秒)"
+    ws_stats[f'B{row + 1}'] = round(time.time() - start_time, 2)
+    row = write_stage_rows(ws_stats, row + 3, timer)
+    
+    # 超时、内存超限等被跳过的文件
+    if run_stats["failed_files"]:
+        row += 1
+        ws_stats[f'A{row}'] = f"跳过的文件（{len(run_stats['failed_files'])}个）"
+        ws_stats[f'A{row}'].font = Font(bold=True)
+        for name, reason in run_stats["failed_files"]:
+            row += 1
+            ws_stats[f'A{row}'] = name
+            ws_stats[f'B{row}'] = reason
+    
+    # 设置统计表格的列宽
+    ws_stats.column_dimensions['A'].width = 25
+    ws_stats.column_dimensions['B'].width = 15
+    for col_letter in ('C', 'D', 'E'):
+        ws_stats.column_dimensions[col_letter].width = 12
+    
+    # 提取策略统计
+    if extract_content:
+        write_strategy_sheet(wb, run_stats["strategies"])
+        if strategy_detail:
+            write_source_detail_sheet(wb, file_info)
+    if conversion_failures is not None and len(conversion_failures):
+        from dlzb_reports import write_failure_sheet
+        write_failure_sheet(wb, conversion_failures)
+    
+    # 保存格式化后的Excel
+    with timer.stage("workbook_save"):
+        wb.save(output_path)
+
+def _empty_file_data(file, extract_content):
+    """无法提取内容时使用的空记录"""
+    file_data = {'文件名': file.stem, '文件路径': str(file.absolute())}
+    if extract_content:
+        file_data.update({field: '' for field in CONTENT_FIELDS})
+    return file_data
+
+def _fill_content(file_data, file, run_stats, **options):
+    """
+    提取文件内容合并到 file_data，并记录最终有值的字段来源
+    
+    Args:
+        options: 传给 extract_excel_content 的参数
+    
+    Returns:
+        是否提取成功；失败时各内容字段为空字符串
+    """
+    strategies = run_stats["strategies"]
+    try:
+        # 尝试读取Excel文件内容
+        strategies.take_sources()
+        content_data = extract_excel_content(file, run_stats, **options)
+        # 合并字典
+        file_data.update(content_data)
+        # 只保留最终有值的字段来源
+        sources = strategies.take_sources()
+        file_data['_来源'] = {field: sources[field] for field in sources if content_data.get(field)}
+        return True
+    except Exception as e:
+        log.warning("警告：无法从文件 %s 提取内容: %s", file.name, e)
+        # 创建空数据
+        file_data.update({field: '' for field in CONTENT_FIELDS})
+        return False
+
+def _process_file(file, extract_content, run_stats, streaming_threshold_mb=None, snapshot=False, all_sheets=False):
+    """
+    处理单个文件，统计数据记录到 run_stats
+    
+    snapshot 为True时，读取的表头区域快照放在 file_data['_快照'] 中，由调用方写入快照库；
+    all_sheets 为True时记录主工作表的名称，其他预算单工作表的记录放在 file_data['_工作表'] 中
+    
+    Returns:
+        文件信息字典，文件无法访问时返回None
+    """
+    file_start = time.perf_counter()
+    try:
+        # 获取文件统计信息
+        stat = file.stat()
+        
+        # 保存文件的完整路径，用于之后创建超链接
+        file_path = str(file.absolute())
+        
+        file_data = {
+            '文件名': file.stem,
+            '文件路径': file_path,  # 添加文件路径字段
+        }
+        
+        # 如果需要提取文件内容
+        if extract_content:
+            # 大文件改用只读流式方式读取，只加载表头区域
+            streaming = (streaming_threshold_mb is not None and file.suffix.lower() == '.xlsx'
+                         and stat.st_size > streaming_threshold_mb * 1024 * 1024)
+            capture = {} if snapshot else None
+            sheets = [] if all_sheets else None
+            if (_fill_content(file_data, file, run_stats, streaming=streaming, capture=capture, sheets=sheets)
+                    and streaming):
+                run_stats["streamed_files"] += 1
+            if sheets:
+                file_data['工作表'] = sheets[0][0]
+                file_data['_工作表'] = []
+                for title, ws in sheets[1:]:
+                    sheet_data = {'文件名': file.stem, '工作表': title, '文件路径': file_path}
+                    _fill_content(sheet_data, file, run_stats, worksheet=ws)
+                    file_data['_工作表'].append(sheet_data)
+            if capture:
+                with run_stats["timings"].stage("snapshot_capture"):
+                    file_data['_快照'] = {"hash": content_hash(file), "size": stat.st_size,
+                                          "mtime_ns": stat.st_mtime_ns, "data": capture}
+        
+        run_stats["processed_files"] += 1
+        run_stats["file_times"].append((file.name, time.perf_counter() - file_start, stat.st_size))
+        return file_data
+        
+    except Exception as e:
+        _note(run_stats, file, "file_error", f"处理文件 {file.name} 时出错: {e}", logging.WARNING)
+        return None
+
+def _process_file_task(file_path, extract_content, streaming_threshold_mb, snapshot=False, all_sheets=False):
+    """子进程任务：处理单个文件，返回 (文件信息, 该文件的统计数据)"""
+    file_stats = _new_stats()
+    file_data = _process_file(excel_path(file_path), extract_content, file_stats, streaming_threshold_mb, snapshot,
+                              all_sheets)
+    return file_data, file_stats
+
+def _expand_sheets(file_data):
+    """把文件信息展开为每个工作表一条记录（其他预算单工作表的记录在 file_data['_工作表'] 中）"""
+    others = file_data.get('_工作表')
+    if others is None:
+        return [file_data]
+    return [{key: value for key, value in file_data.items() if key != '_工作表'}] + others
+
+def _process_snapshot(file, snapshot, extract_content, run_stats):
+    """
+    按快照对单个文件运行提取规则，不访问原始文件
+    
+    Args:
+        file: 快照库中记录的文件路径
+        snapshot: SnapshotStore.get 返回的 (表头区域快照, 文件大小)
+    
+    Returns:
+        文件信息字典
+    """
+    file_start = time.perf_counter()
+    data, size = snapshot
+    file_data = {'文件名': file.stem, '文件路径': str(file)}
+    if extract_content:
+        _fill_content(file_data, file, run_stats, worksheet=grid_from_snapshot(data))
+    run_stats["processed_files"] += 1
+    run_stats["file_times"].append((file.name, time.perf_counter() - file_start, size))
+    return file_data
+
+def write_source_detail_sheet(wb, file_info):
+    """
+    输出每个文件各字段由哪种策略提取（"字段来源明细"工作表）
+    
+    Args:
+        wb: openpyxl工作簿
+        file_info: extract_filenames_to_excel 收集的文件信息列表
+    """
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+    
+    ws = wb.create_sheet(title="字段来源明细")
+    ws.append(['文件名'] + CONTENT_FIELDS)
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+    for item in file_info:
+        sources = item.get('_来源', {})
+        ws.append([item['文件名']] + [STRATEGY_LABELS.get(sources.get(field), '') for field in CONTENT_FIELDS])
+    ws.column_dimensions['A'].width = 30
+    for col in range(2, len(CONTENT_FIELDS) + 2):
+        ws.column_dimensions[get_column_letter(col)].width = 14
+    ws.freeze_panes = "A2"
+
+def _resolve_field(strategies, result, field, strategy, lookup, *args):
+    """
+    调用一种提取策略填充字段，并记录该策略的尝试、命中次数和耗时
+    
+    Returns:
+        策略返回的值
+    """
+    start = time.perf_counter()
+    value = lookup(*args)
+    strategies.record(field, strategy, bool(value), time.perf_counter() - start)
+    if value:
+        result[field] = value
+    return value
 
 def normalize_budget_id(text):
     """
@@ -320,18 +1067,31 @@ def normalize_budget_id(text):
     
     return text
 
-def extract_excel_content(file_path):
+def budget_matches_filename(budget_id, file_stem):
+    """
+    事业部预算编号是否与文件名相符：比较两者的纯数字部分，存在包含关系即视为相符
+    """
+    file_numbers = re.sub(r'[^0-9]', '', normalize_budget_id(file_stem))
+    budget_numbers = re.sub(r'[^0-9]', '', str(budget_id))
+    return (budget_numbers in file_numbers) or (file_numbers in budget_numbers)
+
+def extract_excel_content(file_path, run_stats=None, streaming=False, capture=None, worksheet=None, sheets=None):
     """
     从Excel文件中提取特定内容
     
     Args:
         file_path: Excel文件路径
+        run_stats: 统计数据字典，默认使用全局stats
+        streaming: 是否以只读流式方式读取.xlsx（只加载表头区域，适合大文件）
+        capture: 传入字典时，把提取规则读取的表头区域快照写入其中（见 SheetGrid.to_snapshot）
+        worksheet: 已打开的工作表或由快照还原的工作表（SheetGrid 或 XlsGrid），传入时不打开文件
+        sheets: 传入列表时，填入 [(名称, 工作表)]：主工作表在前，其后是表头探测为预算单的其他工作表
     
     Returns:
         包含提取内容的字典
     """
     try:
-        file_ext = Path(file_path).suffix.lower()
+        file_ext = excel_path(file_path).suffix.lower()
         # 调整字典顺序，确保与提取顺序一致
         result = {
             '事业部预算编号': '',
@@ -345,15 +1105,15 @@ def extract_excel_content(file_path):
         
         if file_ext == '.xlsx':
             # 使用openpyxl读取.xlsx文件
-            return extract_with_openpyxl(file_path, result)
+            return extract_with_openpyxl(file_path, result, run_stats, streaming, capture, worksheet, sheets)
         elif file_ext == '.xls':
             # 使用xlrd读取.xls文件
-            return extract_with_xlrd(file_path, result)
+            return extract_with_xlrd(file_path, result, run_stats, capture, worksheet, sheets)
         else:
             raise ValueError(f"不支持的文件格式: {file_ext}")
     
     except Exception as e:
-        print(f"提取文件 {file_path} 内容时出错: {e}")
+        _note(run_stats, file_path, "read_error", f"提取文件 {file_path} 内容时出错: {e}", logging.WARNING)
         return {
             '事业部预算编号': '',
             '合同号': '',
@@ -668,7 +1428,7 @@ def find_value_by_coordinate(worksheet, col, row):
                 if value:
                     return str(value).strip()
     except Exception as e:
-        print(f"根据坐标获取单元格值时出错: {e}")
+        log.debug("根据坐标获取单元格值时出错: %s", e)
     
     return ""
 
@@ -711,7 +1471,7 @@ def find_value_in_column(worksheet, col_letter, keyword, max_rows=100):
                             if value:
                                 return str(value).strip()
     except Exception as e:
-        print(f"在列中查找值时出错: {e}")
+        log.debug("在列中查找值时出错: %s", e)
     
     return ""
 
@@ -743,57 +1503,217 @@ def clean_extracted_value(value, field_name):
     
     return value.strip()
 
-def extract_with_openpyxl(file_path, result):
-    """使用openpyxl提取.xlsx文件内容"""
+class _GridCell:
+    """SheetGrid中的单元格，只有value属性"""
+    __slots__ = ("value",)
+    
+    def __init__(self, value):
+        self.value = value
+
+class _GridMergedCells:
+    """提供与openpyxl一致的 merged_cells.ranges 接口"""
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+class _GridRange:
+    """快照中的合并区域，只有提取逻辑用到的bounds属性 (min_col, min_row, max_col, max_row)"""
+    __slots__ = ("bounds",)
+    
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+
+class SheetGrid:
+    """
+    只保存单元格值的轻量工作表
+    
+    实现了提取逻辑用到的openpyxl工作表接口（cell、iter_rows、max_row、max_column、
+    merged_cells），用于只读流式读取大文件时只加载表头区域。
+    """
+    # 流式读取时加载的区域，覆盖关键字搜索（100行×30列）与正则扫描的范围
+    MAX_ROWS = 100
+    MAX_COLS = 50
+    
+    def __init__(self, rows, merged_ranges=(), title=''):
+        self.rows = [tuple(row) for row in rows]
+        self.title = title
+        self.max_row = len(self.rows)
+        self.max_column = max((len(row) for row in self.rows), default=0)
+        self.merged_cells = _GridMergedCells(list(merged_ranges))
+    
+    @classmethod
+    def from_workbook(cls, file_path, max_rows=MAX_ROWS, max_cols=MAX_COLS, sheets=None):
+        """
+        以只读模式打开.xlsx文件，只读取活动工作表的表头区域
+        
+        sheets 传入列表时，填入活动工作表及表头探测为预算单的其他工作表 [(名称, SheetGrid)]；
+        其他工作表只读取左上角用于探测，不是预算单时不再读取
+        """
+        import openpyxl
+        with workbook_source(excel_path(file_path)) as source:
+            wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+            try:
+                ws = wb.active
+                rows = ws.iter_rows(min_row=1, max_row=max_rows, max_col=max_cols, values_only=True)
+                grid = cls(rows, title=ws.title)
+                if sheets is not None:
+                    sheets.append((ws.title, grid))
+                    for other in wb.worksheets:
+                        if other is not ws and is_budget_form(other):
+                            rows = other.iter_rows(min_row=1, max_row=max_rows, max_col=max_cols, values_only=True)
+                            sheets.append((other.title, cls(rows, title=other.title)))
+                return grid
+            finally:
+                wb.close()
+    
+    @classmethod
+    def from_worksheet(cls, ws, max_rows=MAX_ROWS, max_cols=MAX_COLS):
+        """复制openpyxl工作表的表头区域与合并区域（已是SheetGrid时原样返回）"""
+        if isinstance(ws, cls):
+            return ws
+        rows = ws.iter_rows(min_row=1, max_row=min(ws.max_row, max_rows), max_col=min(ws.max_column, max_cols),
+                            values_only=True)
+        return cls(rows, [_GridRange(merged.bounds) for merged in ws.merged_cells.ranges], ws.title)
+    
+    def to_snapshot(self):
+        """保存到快照库的内容，用 grid_from_snapshot 还原"""
+        return {"engine": "openpyxl", "title": self.title, "rows": self.rows,
+                "merged": [merged.bounds for merged in self.merged_cells.ranges]}
+    
+    def _value(self, row, column):
+        if 1 <= row <= self.max_row:
+            values = self.rows[row - 1]
+            if 1 <= column <= len(values):
+                return values[column - 1]
+        return None
+    
+    def cell(self, row, column):
+        return _GridCell(self._value(row, column))
+    
+    def iter_rows(self, min_row=1, max_row=None, max_col=None):
+        max_row = min(max_row or self.max_row, self.max_row)
+        max_col = max_col or self.max_column
+        for row in range(min_row, max_row + 1):
+            yield tuple(_GridCell(self._value(row, col)) for col in range(1, max_col + 1))
+
+class XlsGrid:
+    """
+    只保存单元格值的xlrd风格工作表（nrows、ncols、cell_value），由.xls文件的快照还原
+    
+    与 SheetGrid 一样只保留表头区域，提取逻辑按xlrd工作表处理它。
+    """
+    def __init__(self, rows, title=''):
+        self.rows = [tuple(row) for row in rows]
+        self.name = title
+        self.nrows = len(self.rows)
+        self.ncols = max((len(row) for row in self.rows), default=0)
+    
+    @classmethod
+    def from_sheet(cls, sheet, max_rows=SheetGrid.MAX_ROWS, max_cols=SheetGrid.MAX_COLS):
+        """复制xlrd工作表的表头区域"""
+        ncols = min(sheet.ncols, max_cols)
+        return cls((sheet.row_values(row, 0, ncols) for row in range(min(sheet.nrows, max_rows))), sheet.name)
+    
+    def to_snapshot(self):
+        """保存到快照库的内容，用 grid_from_snapshot 还原"""
+        return {"engine": "xlrd", "title": self.name, "rows": self.rows}
+    
+    def cell_value(self, rowx, colx):
+        values = self.rows[rowx]
+        return values[colx] if colx < len(values) else ''
+    
+    def cell(self, rowx, colx):
+        # 与xlrd的 Sheet.cell 签名一致，提取逻辑对两者的处理相同
+        return _GridCell(self.cell_value(rowx, colx))
+
+def grid_from_snapshot(data):
+    """由 to_snapshot 保存的内容还原工作表（SheetGrid 或 XlsGrid）"""
+    if data["engine"] == "xlrd":
+        return XlsGrid(data["rows"], data["title"])
+    return SheetGrid(data["rows"], [_GridRange(bounds) for bounds in data["merged"]], data["title"])
+
+def extract_with_openpyxl(file_path, result, run_stats=None, streaming=False, capture=None, worksheet=None,
+                          sheets=None):
+    """使用openpyxl提取.xlsx文件内容（capture、worksheet、sheets 见 extract_excel_content）"""
+    import openpyxl
+    if run_stats is None:
+        run_stats = stats
     try:
-        # 使用openpyxl读取Excel文件
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        ws = wb.active
+        timer = run_stats["timings"]
+        strategies = run_stats["strategies"]
+        
+        if worksheet is not None:
+            # 按快照运行提取规则，不打开文件
+            ws = worksheet
+        else:
+            # 使用openpyxl读取Excel文件
+            with timer.stage("workbook_open"):
+                if streaming:
+                    ws = SheetGrid.from_workbook(file_path, sheets=sheets)
+                else:
+                    # 非只读模式在载入时读完全部内容，之后不再需要来源文件
+                    with workbook_source(excel_path(file_path)) as source:
+                        wb = openpyxl.load_workbook(source, data_only=True)
+                    ws = wb.active
+            if sheets is not None and not streaming:
+                # 整个工作簿已经载入，探测只读取其他工作表的左上角
+                with timer.stage("sheet_probe"):
+                    sheets.append((ws.title, ws))
+                    sheets.extend((other.title, other) for other in wb.worksheets
+                                  if other is not ws and is_budget_form(other))
+            if capture is not None:
+                with timer.stage("snapshot_capture"):
+                    capture.update(SheetGrid.from_worksheet(ws).to_snapshot())
         
         # 1. 根据坐标查找固定位置的值（根据截图中的位置）
+        stage_start = time.perf_counter()
         # A列下的"事业部预算编号"数据实际上是G列的合同号数据
-        result['合同号'] = find_value_by_coordinate(ws, 'A', 4)
+        _resolve_field(strategies, result, '合同号', 'coordinate', find_value_by_coordinate, ws, 'A', 4)
         
         # G列下的"合同号"数据实际上是A列的事业部预算编号数据
-        result['事业部预算编号'] = find_value_by_coordinate(ws, 'G', 4)
+        _resolve_field(strategies, result, '事业部预算编号', 'coordinate', find_value_by_coordinate, ws, 'G', 4)
         
         # A列第5行是部门信息
-        result['部门（显示值）'] = find_value_by_coordinate(ws, 'A', 5)
+        _resolve_field(strategies, result, '部门（显示值）', 'coordinate', find_value_by_coordinate, ws, 'A', 5)
         
         # A列第6行是单据编号（这个没问题）
-        result['单据编号'] = find_value_by_coordinate(ws, 'A', 6)
+        _resolve_field(strategies, result, '单据编号', 'coordinate', find_value_by_coordinate, ws, 'A', 6)
         
         # G列第6行是备注信息（这个没问题）
-        result['备注'] = find_value_by_coordinate(ws, 'G', 6)
+        _resolve_field(strategies, result, '备注', 'coordinate', find_value_by_coordinate, ws, 'G', 6)
         
         # 查找制单日期和制单人信息
-        result['制单日期'] = find_value_in_column(ws, 'G', '制单日期')
-        result['制单人'] = find_value_in_column(ws, 'H', '制单人')
+        _resolve_field(strategies, result, '制单日期', 'column_scan', find_value_in_column, ws, 'G', '制单日期')
+        _resolve_field(strategies, result, '制单人', 'column_scan', find_value_in_column, ws, 'H', '制单人')
+        timer.add("coordinate_lookup", time.perf_counter() - stage_start)
         
         # 2. 如果以上方法未能提取到全部信息，尝试使用关键字搜索
+        stage_start = time.perf_counter()
         if not result['事业部预算编号']:
-            result['事业部预算编号'] = find_value_by_keyword(ws, ['事业部预算编号'])
+            _resolve_field(strategies, result, '事业部预算编号', 'keyword', find_value_by_keyword, ws, ['事业部预算编号'])
         
         if not result['合同号']:
-            result['合同号'] = find_value_by_keyword(ws, ['合同号'])
+            _resolve_field(strategies, result, '合同号', 'keyword', find_value_by_keyword, ws, ['合同号'])
         
         if not result['部门（显示值）']:
-            result['部门（显示值）'] = find_value_by_keyword(ws, ['部门（显示值）', '部门(显示值)', '部门', '使用部门', '申请部门', '所属部门', '责任部门'])
+            _resolve_field(strategies, result, '部门（显示值）', 'keyword', find_value_by_keyword, ws, ['部门（显示值）', '部门(显示值)', '部门', '使用部门', '申请部门', '所属部门', '责任部门'])
         
         if not result['单据编号']:
-            result['单据编号'] = find_value_by_keyword(ws, ['单据编号', '单据号', '凭证号', '凭证编号', '发票号', '发票编号', '申请单号'])
+            _resolve_field(strategies, result, '单据编号', 'keyword', find_value_by_keyword, ws, ['单据编号', '单据号', '凭证号', '凭证编号', '发票号', '发票编号', '申请单号'])
         
         if not result['备注']:
-            result['备注'] = find_value_by_keyword(ws, ['备注', '备注说明', '说明', '项目说明', '其他说明', '补充说明', '附注'])
+            _resolve_field(strategies, result, '备注', 'keyword', find_value_by_keyword, ws, ['备注', '备注说明', '说明', '项目说明', '其他说明', '补充说明', '附注'])
         
         if not result['制单日期']:
-            result['制单日期'] = find_value_by_keyword(ws, ['制单日期'])
+            _resolve_field(strategies, result, '制单日期', 'keyword', find_value_by_keyword, ws, ['制单日期'])
         
         if not result['制单人']:
-            result['制单人'] = find_value_by_keyword(ws, ['制单人'])
+            _resolve_field(strategies, result, '制单人', 'keyword', find_value_by_keyword, ws, ['制单人'])
+        timer.add("keyword_fallback", time.perf_counter() - stage_start)
         
         # 3. 如果常规方法未能提取到全部信息，尝试扫描整个表格寻找特定模式
         if not all(result.values()):
+            stage_start = time.perf_counter()
+            pending = [field for field in ('事业部预算编号', '单据编号', '部门（显示值）', '合同号') if not result[field]]
             # 尝试扫描整个表格，寻找包含关键信息的行
             budget_pattern = r'WZ[-_]?FJ[-_]?(\d{6})[-_]?(\d{3})'
             document_pattern = r'WZBD(\d{8})'
@@ -836,8 +1756,14 @@ def extract_with_openpyxl(file_path, result):
                     
                     if clean_text and len(clean_text) > 3:  # 至少有一些有意义的文本
                         result['合同号'] = clean_text
+            elapsed = time.perf_counter() - stage_start
+            timer.add("regex_scan", elapsed)
+            # 一次扫描同时服务多个字段，耗时按待查字段平均分摊
+            for field in pending:
+                strategies.record(field, 'regex_scan', bool(result[field]), elapsed / len(pending))
         
         # 清理提取的数据
+        stage_start = time.perf_counter()
         for key in result:
             if result[key]:
                 result[key] = clean_extracted_value(result[key], key)
@@ -856,102 +1782,125 @@ def extract_with_openpyxl(file_path, result):
         # 记录缺失数据统计
         for field, value in result.items():
             if not value:
-                stats["missing_data"][field] += 1
+                run_stats["missing_data"][field] += 1
         
         # 如果没有找到事业部预算编号，尝试从文件名提取
         if not result['事业部预算编号']:
-            file_stem = Path(file_path).stem
+            file_stem = excel_path(file_path).stem
             # 尝试从文件名中提取预算编号格式
             budget_id_match = re.search(r'([A-Z]{1,2})[-_]?([A-Z]{1,2})[-_]?(\d{6})[-_]?(\d{3})', file_stem)
             if budget_id_match:
                 extracted_id = f"{budget_id_match.group(1)}-{budget_id_match.group(2)}-{budget_id_match.group(3)}-{budget_id_match.group(4)}"
                 result['事业部预算编号'] = extracted_id
-                stats["extracted_from_filename"] += 1
-                print(f"✓ 从文件名 {file_stem} 提取预算编号: {extracted_id}")
+                run_stats["extracted_from_filename"] += 1
+                strategies.record('事业部预算编号', 'filename', True, 0.0)
+                _note(run_stats, file_path, "budget_from_filename",
+                      f"✓ 从文件名 {file_stem} 提取预算编号: {extracted_id}")
         
         # 验证事业部预算编号与文件名的关系（更宽松的匹配）
-        file_stem = Path(file_path).stem
+        file_stem = excel_path(file_path).stem
         if result['事业部预算编号']:
             # 标准化文件名中的预算编号格式
             normalized_stem = normalize_budget_id(file_stem)
             
-            # 提取纯数字部分进行比较
-            file_numbers = re.sub(r'[^0-9]', '', normalized_stem)
-            budget_numbers = re.sub(r'[^0-9]', '', result['事业部预算编号'])
-            
-            # 如果数字部分包含关系，也算匹配
-            if (budget_numbers in file_numbers) or (file_numbers in budget_numbers):
-                print(f"√ 文件 {file_stem} 的事业部预算编号验证通过")
-                stats["matched_budgets"] += 1
+            if budget_matches_filename(result['事业部预算编号'], file_stem):
+                log.debug("√ 文件 %s 的事业部预算编号验证通过", file_stem)
+                run_stats["matched_budgets"] += 1
             else:
-                print(f"! 警告：文件 {file_stem} 的事业部预算编号与文件名不匹配")
-                stats["unmatched_budgets"] += 1
+                _note(run_stats, file_path, "budget_mismatch",
+                      f"! 警告：文件 {file_stem} 的事业部预算编号与文件名不匹配")
+                run_stats["unmatched_budgets"] += 1
                 # 使用文件名作为预算编号
                 if not result['事业部预算编号'] and normalized_stem:
                     result['事业部预算编号'] = normalized_stem
-                    print(f"  > 已使用文件名 {normalized_stem} 作为预算编号")
+                    log.info("  > 已使用文件名 %s 作为预算编号", normalized_stem)
+        timer.add("cleanup_validation", time.perf_counter() - stage_start)
         
         return result
     
     except Exception as e:
-        print(f"使用openpyxl提取 {file_path} 时出错: {e}")
+        _note(run_stats, file_path, "read_error", f"使用openpyxl提取 {file_path} 时出错: {e}", logging.WARNING)
         for field in result:
-            stats["missing_data"][field] += 1
+            run_stats["missing_data"][field] += 1
         return result
 
-def extract_with_xlrd(file_path, result):
-    """使用xlrd提取.xls文件内容"""
+def extract_with_xlrd(file_path, result, run_stats=None, capture=None, worksheet=None, sheets=None):
+    """使用xlrd提取.xls文件内容（capture、worksheet、sheets 见 extract_excel_content）"""
+    import xlrd
+    if run_stats is None:
+        run_stats = stats
     try:
-        # 使用xlrd读取Excel文件
-        wb = xlrd.open_workbook(file_path)
-        ws = wb.sheet_by_index(0)  # 获取第一个工作表
+        timer = run_stats["timings"]
+        strategies = run_stats["strategies"]
+        
+        if worksheet is not None:
+            # 按快照运行提取规则，不打开文件
+            ws = worksheet
+        else:
+            # 使用xlrd读取Excel文件
+            with timer.stage("workbook_open"):
+                wb = open_xls(excel_path(file_path))
+                ws = wb.sheet_by_index(0)  # 获取第一个工作表
+            if sheets is not None:
+                with timer.stage("sheet_probe"):
+                    sheets.append((ws.name, ws))
+                    sheets.extend((other.name, other) for other in wb.sheets()[1:] if is_budget_form(other))
+            if capture is not None:
+                with timer.stage("snapshot_capture"):
+                    capture.update(XlsGrid.from_sheet(ws).to_snapshot())
         
         # 1. 根据坐标查找固定位置的值（根据截图中的位置）
+        stage_start = time.perf_counter()
         # A列下的"事业部预算编号"数据实际上是G列的合同号数据
-        result['合同号'] = find_value_by_coordinate(ws, 'A', 4)
+        _resolve_field(strategies, result, '合同号', 'coordinate', find_value_by_coordinate, ws, 'A', 4)
         
         # G列下的"合同号"数据实际上是A列的事业部预算编号数据
-        result['事业部预算编号'] = find_value_by_coordinate(ws, 'G', 4)
+        _resolve_field(strategies, result, '事业部预算编号', 'coordinate', find_value_by_coordinate, ws, 'G', 4)
         
         # A列第5行是部门信息
-        result['部门（显示值）'] = find_value_by_coordinate(ws, 'A', 5)
+        _resolve_field(strategies, result, '部门（显示值）', 'coordinate', find_value_by_coordinate, ws, 'A', 5)
         
         # A列第6行是单据编号（这个没问题）
-        result['单据编号'] = find_value_by_coordinate(ws, 'A', 6)
+        _resolve_field(strategies, result, '单据编号', 'coordinate', find_value_by_coordinate, ws, 'A', 6)
         
         # G列第6行是备注信息（这个没问题）
-        result['备注'] = find_value_by_coordinate(ws, 'G', 6)
+        _resolve_field(strategies, result, '备注', 'coordinate', find_value_by_coordinate, ws, 'G', 6)
         
         # 查找制单日期和制单人信息
-        result['制单日期'] = find_value_in_column(ws, 'G', '制单日期')
-        result['制单人'] = find_value_in_column(ws, 'H', '制单人')
+        _resolve_field(strategies, result, '制单日期', 'column_scan', find_value_in_column, ws, 'G', '制单日期')
+        _resolve_field(strategies, result, '制单人', 'column_scan', find_value_in_column, ws, 'H', '制单人')
+        timer.add("coordinate_lookup", time.perf_counter() - stage_start)
         
         # 2. 如果以上方法未能提取到全部信息，尝试使用关键字搜索
+        stage_start = time.perf_counter()
         if not result['事业部预算编号']:
-            result['事业部预算编号'] = find_value_by_keyword(ws, ['事业部预算编号'])
+            _resolve_field(strategies, result, '事业部预算编号', 'keyword', find_value_by_keyword, ws, ['事业部预算编号'])
         
         if not result['合同号']:
-            result['合同号'] = find_value_by_keyword(ws, ['合同号'])
+            _resolve_field(strategies, result, '合同号', 'keyword', find_value_by_keyword, ws, ['合同号'])
         
         if not result['部门（显示值）']:
-            result['部门（显示值）'] = find_value_by_keyword(ws, ['部门（显示值）', '部门(显示值)', '部门', '使用部门', '申请部门', '所属部门', '责任部门'])
+            _resolve_field(strategies, result, '部门（显示值）', 'keyword', find_value_by_keyword, ws, ['部门（显示值）', '部门(显示值)', '部门', '使用部门', '申请部门', '所属部门', '责任部门'])
         
         if not result['单据编号']:
-            result['单据编号'] = find_value_by_keyword(ws, ['单据编号', '单据号', '凭证号', '凭证编号', '发票号', '发票编号', '申请单号'])
+            _resolve_field(strategies, result, '单据编号', 'keyword', find_value_by_keyword, ws, ['单据编号', '单据号', '凭证号', '凭证编号', '发票号', '发票编号', '申请单号'])
         
         if not result['备注']:
-            result['备注'] = find_value_by_keyword(ws, ['备注', '备注说明', '说明', '项目说明', '其他说明', '补充说明', '附注'])
+            _resolve_field(strategies, result, '备注', 'keyword', find_value_by_keyword, ws, ['备注', '备注说明', '说明', '项目说明', '其他说明', '补充说明', '附注'])
         
         if not result['制单日期']:
-            result['制单日期'] = find_value_by_keyword(ws, ['制单日期'])
+            _resolve_field(strategies, result, '制单日期', 'keyword', find_value_by_keyword, ws, ['制单日期'])
         
         if not result['制单人']:
-            result['制单人'] = find_value_by_keyword(ws, ['制单人'])
+            _resolve_field(strategies, result, '制单人', 'keyword', find_value_by_keyword, ws, ['制单人'])
+        timer.add("keyword_fallback", time.perf_counter() - stage_start)
         
         # 清理提取的数据
+        stage_start = time.perf_counter()
         for key in result:
             if result[key]:
                 result[key] = clean_extracted_value(result[key], key)
+        timer.add("cleanup_validation", time.perf_counter() - stage_start)
         
         # ... 其余代码保持不变
         
@@ -962,9 +1911,9 @@ def extract_with_xlrd(file_path, result):
         return result
     
     except Exception as e:
-        print(f"使用xlrd提取 {file_path} 时出错: {e}")
+        _note(run_stats, file_path, "read_error", f"使用xlrd提取 {file_path} 时出错: {e}", logging.WARNING)
         for field in result:
-            stats["missing_data"][field] += 1
+            run_stats["missing_data"][field] += 1
         return result
 
 def create_test_files():
@@ -1162,7 +2111,7 @@ def create_gui():
         # 创建主窗口
         root = tk.Tk()
         root.title("预算文件提取工具")
-        root.geometry("600x450")
+        root.geometry("600x480")
         root.resizable(True, True)
         
         # 设置样式
@@ -1219,6 +2168,21 @@ def create_gui():
         extract_check = ttk.Checkbutton(input_frame, text="提取Excel文件内容", variable=extract_var)
         extract_check.pack(anchor=tk.W, pady=5)
         
+        # 多工作表选项
+        sheets_var = tk.BooleanVar(value=False)
+        sheets_check = ttk.Checkbutton(input_frame, text="同时提取其他预算单工作表", variable=sheets_var)
+        sheets_check.pack(anchor=tk.W, pady=5)
+        
+        # ZIP归档选项
+        archives_var = tk.BooleanVar(value=False)
+        archives_check = ttk.Checkbutton(input_frame, text="读取文件夹中ZIP归档里的Excel文件", variable=archives_var)
+        archives_check.pack(anchor=tk.W, pady=5)
+        
+        # 逐文件信息默认不显示，只在结束时显示汇总计数
+        verbose_var = tk.BooleanVar(value=False)
+        verbose_check = ttk.Checkbutton(input_frame, text="显示每个文件的处理信息（文件多时较慢）", variable=verbose_var)
+        verbose_check.pack(anchor=tk.W, pady=5)
+        
         # 操作按钮框架
         button_frame = ttk.Frame(main_frame)
         button_frame.pack(fill=tk.X, pady=10)
@@ -1234,6 +2198,10 @@ def create_gui():
         progress_label = ttk.Label(progress_frame, text="就绪")
         progress_label.pack(anchor=tk.W)
         
+        # 吞吐量、已用时间和剩余时间
+        status_label = ttk.Label(progress_frame, text="")
+        status_label.pack(anchor=tk.W)
+        
         # 日志框架
         log_frame = ttk.LabelFrame(main_frame, text="处理日志", padding=10)
         log_frame.pack(fill=tk.BOTH, expand=True, pady=10)
@@ -1246,31 +2214,60 @@ def create_gui():
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         log_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
-        # 自定义输出重定向
-        class TextRedirector:
-            def __init__(self, text_widget):
-                self.text_widget = text_widget
-                self.buffer = ""
-                
-            def write(self, string):
-                self.buffer += string
-                self.text_widget.insert(tk.END, string)
-                self.text_widget.see(tk.END)
-                self.text_widget.update_idletasks()
-                
-            def flush(self):
-                pass
+        # 工作线程只向事件通道投递日志和进度，由主循环定时批量更新界面
+        channel = UIEventChannel()
+        
+        def show_progress(value):
+            progress_var.set(value)
+            progress_label.config(text=f"处理进度: {value:.1f}%")
         
-        # 进度更新函数
-        def update_progress(value):
-            root.after(0, lambda: progress_var.set(value))
-            root.after(0, lambda: progress_label.config(text=f"处理进度: {value:.1f}%"))
+        pump_channel(root, channel, log_text, show_progress)
+        
+        # 当前运行的控制对象，未运行时为None
+        current_run = {"control": None}
+        
+        def refresh_status():
+            control = current_run["control"]
+            if control is not None:
+                status_label.config(text=control.status_text())
+                root.after(500, refresh_status)
+        
+        def toggle_pause():
+            control = current_run["control"]
+            if control is None:
+                return
+            if control.paused:
+                control.resume()
+                pause_button.config(text="暂停")
+            else:
+                control.pause()
+                pause_button.config(text="继续")
+        
+        def cancel_run():
+            control = current_run["control"]
+            if control is not None:
+                control.cancel()
+                progress_label.config(text="正在取消，稍后输出已处理的部分结果...")
+                pause_button.config(state=tk.DISABLED)
+                cancel_button.config(state=tk.DISABLED)
+        
+        def finish_run():
+            control = current_run["control"]
+            status_label.config(text=control.status_text())
+            current_run["control"] = None
+            start_button.config(state=tk.NORMAL)
+            test_button.config(state=tk.NORMAL)
+            pause_button.config(state=tk.DISABLED, text="暂停")
+            cancel_button.config(state=tk.DISABLED)
         
         # 处理函数
         def process_files():
             folder_path = folder_var.get()
             output_file = output_var.get()
             extract_content = extract_var.get()
+            all_sheets = sheets_var.get()
+            archives = archives_var.get()
+            set_log_level(logging.INFO if verbose_var.get() else logging.WARNING)
             
             if not folder_path:
                 messagebox.showerror("错误", "请选择Excel文件夹!")
@@ -1279,6 +2276,11 @@ def create_gui():
             # 禁用按钮，避免重复点击
             start_button.config(state=tk.DISABLED)
             test_button.config(state=tk.DISABLED)
+            pause_button.config(state=tk.NORMAL, text="暂停")
+            cancel_button.config(state=tk.NORMAL)
+            control = RunControl()
+            current_run["control"] = control
+            refresh_status()
             
             # 清空日志
             log_text.delete(1.0, tk.END)
@@ -1287,31 +2289,36 @@ def create_gui():
             progress_label.config(text="正在处理...")
             progress_var.set(0)
             
-            # 重定向标准输出到文本框
+            # 重定向标准输出到事件通道
             import sys
             original_stdout = sys.stdout
-            sys.stdout = TextRedirector(log_text)
+            sys.stdout = channel
             
             def run_extraction():
                 try:
                     # 运行提取函数，传入进度回调
-                    extract_filenames_to_excel(folder_path, output_file, extract_content, progress_callback=update_progress)
+                    extract_filenames_to_excel(folder_path, output_file, extract_content, progress_callback=channel.progress,
+                                               control=control, checkpoint=True, all_sheets=all_sheets,
+                                               archives=archives)
                     
                     # 完成后在主线程更新UI
-                    root.after(0, lambda: progress_var.set(100))
-                    root.after(0, lambda: progress_label.config(text="处理完成!"))
-                    root.after(0, lambda: messagebox.showinfo("完成", f"处理完成!\n输出文件: {output_file}"))
+                    if control.cancelled:
+                        channel.post(progress_label.config, {"text": "已取消"})
+                        channel.post(messagebox.showinfo, "已取消", f"已取消，已处理的部分结果已保存\n输出文件: {output_file}")
+                    else:
+                        channel.post(progress_var.set, 100)
+                        channel.post(progress_label.config, {"text": "处理完成!"})
+                        channel.post(messagebox.showinfo, "完成", f"处理完成!\n输出文件: {output_file}")
                     
                 except Exception as e:
                     import traceback
                     error_msg = f"处理过程中出错: {e}\n{traceback.format_exc()}"
-                    root.after(0, lambda: messagebox.showerror("错误", error_msg))
+                    channel.post(messagebox.showerror, "错误", error_msg)
                 finally:
                     # 恢复标准输出
                     sys.stdout = original_stdout
                     # 恢复按钮状态
-                    root.after(0, lambda: start_button.config(state=tk.NORMAL))
-                    root.after(0, lambda: test_button.config(state=tk.NORMAL))
+                    channel.post(finish_run)
             
             # 在新线程中运行，避免UI冻结
             thread = threading.Thread(target=run_extraction)
@@ -1333,6 +2340,12 @@ def create_gui():
         test_button = ttk.Button(button_frame, text="创建测试文件", command=create_test)
         test_button.pack(side=tk.LEFT, padx=5)
         
+        pause_button = ttk.Button(button_frame, text="暂停", command=toggle_pause, state=tk.DISABLED)
+        pause_button.pack(side=tk.LEFT, padx=5)
+        
+        cancel_button = ttk.Button(button_frame, text="取消", command=cancel_run, state=tk.DISABLED)
+        cancel_button.pack(side=tk.LEFT, padx=5)
+        
         quit_button = ttk.Button(button_frame, text="退出", command=root.destroy)
         quit_button.pack(side=tk.RIGHT, padx=5)
         
@@ -1358,11 +2371,119 @@ def create_gui():
         return False
 
 # 使用示例
+def main(argv=None):
+    """
+    命令行入口，供计划任务和流水线调用（不依赖tkinter）
+    
+    Returns:
+        进程退出码：0成功，1处理失败，2参数或输入文件夹错误
+    """
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Excel预算文件信息提取工具")
+    parser.add_argument("folders", nargs="+", help="要处理的文件夹，可指定多个")
+    parser.add_argument("-o", "--output", default="文件名列表.xlsx",
+                        help="输出文件路径，后缀为.csv时输出CSV（默认：文件名列表.xlsx）")
+    parser.add_argument("--no-content", action="store_true", help="只提取文件名，不读取Excel内容")
+    parser.add_argument("-r", "--recursive", action="store_true", help="递归处理子文件夹")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="隔离子进程数量，0表示在当前进程中依次处理")
+    parser.add_argument("--timeout", type=float, default=None, help="单个文件的处理时间上限（秒）")
+    parser.add_argument("--max-memory", type=int, default=None, help="子进程常驻内存上限（MB）")
+    parser.add_argument("--streaming-threshold", type=float, default=5,
+                        help="超过该大小（MB）的.xlsx文件使用只读流式读取，0表示不启用（默认：5）")
+    parser.add_argument("--cache", metavar="DIR", default=None, help="结果缓存目录，未变化的文件直接使用上次的结果")
+    parser.add_argument("--changes", nargs="?", const=True, default=None,
+                        help="与 --cache 中上次的结果比较，写出变化报告（新增、删除的文件与修改的字段），"
+                             "可指定.xlsx或.csv路径（默认：<输出文件名>_变化报告.xlsx）")
+    parser.add_argument("--checkpoint", nargs="?", const=True, default=False,
+                        help="定期保存已完成文件的结果，中断后以相同参数重新运行可继续；可指定检查点路径")
+    parser.add_argument("--shard", metavar="I/K", default=None,
+                        help="只处理第I个分片（共K个，I从0开始），结果写成部分结果文件，用 dlzb_merge.py 合并")
+    parser.add_argument("--typed", action="store_true",
+                        help="把制单日期转换为日期后输出，无法转换的值在\"类型转换失败\"工作表中列出")
+    parser.add_argument("--index", nargs="?", const=True, default=None,
+                        help="把提取结果写入编号索引（默认为输出目录中的dlzb_index.sqlite），用 dlzb_index.py 查询")
+    parser.add_argument("--all-sheets", action="store_true",
+                        help="同时提取其他表头像预算单的工作表，每个工作表一条记录，并增加\"工作表\"列")
+    parser.add_argument("--archives", action="store_true",
+                        help="把文件夹中的ZIP归档当作文件夹，直接读取其中的Excel文件（路径为 归档.zip!成员路径）")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="预读深度：处理当前文件时由后台线程提前读入后面N个文件（默认：0，不预读；使用子进程时不预读）")
+    parser.add_argument("--prefetch-memory", type=float, default=256, metavar="MB",
+                        help="预读内容的内存上限（MB，默认：256）")
+    parser.add_argument("--schedule", choices=("largest", "discovery"), default="largest",
+                        help="使用子进程时的处理顺序：largest按历史耗时或文件大小从大到小（默认），discovery按发现顺序")
+    parser.add_argument("--snapshots", nargs="?", const=True, default=None,
+                        help="把每个工作簿的表头区域按内容哈希保存到快照库（默认为输出目录中的dlzb_snapshots.sqlite）")
+    parser.add_argument("--rules-only", action="store_true",
+                        help="只按快照库重新运行提取规则，不访问原始文件")
+    parser.add_argument("--progress", action="store_true", help="在标准错误输出中显示进度百分比")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="输出每个文件的警告与处理信息（默认只输出汇总计数），-vv 另外输出验证通过等细节")
+    parser.add_argument("--events", metavar="PATH", default=None,
+                        help="把运行开始、文件完成、警告、吞吐量与运行汇总事件逐行写成JSON；\"-\"表示标准输出"
+                             "（其余输出改写到标准错误输出）")
+    parser.add_argument("--report", default=None, help="JSON运行报告路径，默认与输出文件同名")
+    parser.add_argument("--no-report", action="store_true", help="不生成JSON运行报告")
+    parser.add_argument("--strategy-detail", action="store_true", help="额外输出每个文件各字段的提取来源")
+    parser.add_argument("--profile", nargs="?", const=True, default=None,
+                        help="开启性能剖析，可指定pstats输出路径")
+    parser.add_argument("--profile-top", type=int, default=20, help="剖析摘要中列出的函数和最慢文件数量")
+    args = parser.parse_args(argv)
+    set_log_level(verbosity_level(args.verbose))
+    
+    error = None if args.rules_only else check_folders(args.folders)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    output = Path(args.output).absolute()
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        if output.suffix.lower() != PARTIAL_SUFFIX:
+            output = default_partial_path(output, shard)
+    error = check_run_options(output, args.snapshots, args.rules_only, args.changes, args.cache, shard)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    
+    def print_progress(percent):
+        print(f"\r进度: {percent:5.1f}%", end="", file=sys.stderr, flush=True)
+    
+    try:
+        with events_on_stdout() if args.events == "-" else nullcontext(args.events) as events:
+            extract_filenames_to_excel(
+                args.folders, str(output), not args.no_content,
+                progress_callback=print_progress if args.progress else None,
+                report_file=False if args.no_report else args.report,
+                strategy_detail=args.strategy_detail, profile=args.profile, profile_top=args.profile_top,
+                workers=args.workers, timeout=args.timeout, max_memory_mb=args.max_memory,
+                streaming_threshold_mb=args.streaming_threshold or None,
+                recursive=args.recursive, cache_dir=args.cache, raise_errors=True, checkpoint=args.checkpoint,
+                shard=shard, index=args.index, typed=args.typed, snapshots=args.snapshots,
+                rules_only=args.rules_only, all_sheets=args.all_sheets, archives=args.archives,
+                prefetch=args.prefetch, prefetch_memory_mb=args.prefetch_memory, schedule=args.schedule,
+                events=events, changes=args.changes,
+            )
+    except Exception as e:
+        if args.progress:
+            print(file=sys.stderr)
+        print(f"出错：{e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return 1
+    if args.progress:
+        print(file=sys.stderr)
+    return 0
+
 if __name__ == "__main__":
     # 如果没有命令行参数，启动GUI
     import sys
     if len(sys.argv) == 1:
         create_gui()
     else:
-        # 提取文件名到Excel
-        extract_filenames_to_excel("E:/liu/Documents/WPSDrive/201050461/WPS云盘/工作项目/11.电力装备/04上线试用/预算导出/2024预算导出", "文件输出", True)
+        sys.exit(main())
@@ -22,13 +22,20 @@
 
 # 后续将逐步实现各功能 
 
-import pandas as pd
-import openpyxl
+from contextlib import nullcontext
+import logging
 from pathlib import Path
-import xlrd
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
 import threading
+import time
+
+from dlzb_runtime import (StageTimer, RunProfiler, IsolatedPool, default_profile_path, default_report_path,
+                          write_run_report, discover_excel_files, check_folders, UIEventChannel, pump_channel,
+                          RunControl, select_shard, shard_key, parse_shard, is_budget_form, excel_path,
+                          workbook_source, open_xls, link_target, Prefetcher, largest_first, format_utilization,
+                          EventStream, events_on_stdout, set_log_level, verbosity_level)
+from dlzb_store import (ResultStore, default_checkpoint_path, run_fingerprint, remove_store, save_partial,
+                        missing_shards, default_partial_path, PARTIAL_SUFFIX, SnapshotStore, default_snapshot_path,
+                        content_hash, check_run_options)
 
 # 明细表字段
 DETAIL_COLUMNS = [
@@ -36,115 +43,802 @@ DETAIL_COLUMNS = [
     '预算数量', '技术标准', '目标价格类别', '目标价格', '行备注', '源单行号', '年度合同', '操作'
 ]
 
-def extract_details_from_folder(folder_path, output_file="明细表汇总.xlsx", progress_callback=None, log_callback=None):
-    folder = Path(folder_path)
-    excel_files = [f for f in folder.iterdir() if f.is_file() and f.suffix.lower() in ['.xls', '.xlsx']]
-    if log_callback:
-        log_callback(f"共发现{len(excel_files)}个Excel文件待处理。\n")
-    all_details = []
-    for idx, file in enumerate(excel_files):
-        try:
-            if file.suffix.lower() == '.xlsx':
-                wb = openpyxl.load_workbook(file, data_only=True)
+# 单个文件的明细行数上限，防止异常文件导致读取无法结束
+MAX_DETAIL_ROWS = 100000
+
+# 提取规则变化时递增，使旧的缓存结果失效
+CACHE_VERSION = 1
+
+# 每个文件的处理信息按级别过滤（见 dlzb_runtime.LOGGER），默认只输出警告及以上
+log = logging.getLogger("dlzb.details")
+
+# pandas、openpyxl、xlrd、tkinter 导入较慢，在用到它们的函数中再导入
+
+def extract_details_from_folder(folder_path, output_file="明细表汇总.xlsx", progress_callback=None, log_callback=None,
+                                profile=None, profile_top=20, workers=0, timeout=None, max_memory_mb=None,
+                                streaming_threshold_mb=5, max_rows=MAX_DETAIL_ROWS, recursive=False, cache_dir=None,
+                                report_file=None, control=None, checkpoint=False, shard=None, index=None,
+                                aggregate=False, headers=None, typed=False, snapshots=None, rules_only=False,
+                                all_sheets=False, archives=False, prefetch=0, prefetch_memory_mb=256,
+                                schedule="largest", events=None, changes=None):
+    """
+    批量提取文件夹中所有Excel文件的明细表并汇总输出
+
+    Args:
+        folder_path: 文件夹路径，也可以是多个文件夹组成的列表
+        output_file: 输出文件路径，后缀为.csv时输出不带格式的CSV，否则输出Excel
+        progress_callback: 进度回调函数，参数为百分比
+        log_callback: 日志回调函数，参数为日志文本
+        profile: 性能剖析文件路径，传入True则使用"<输出文件名>_profile.prof"，默认不剖析
+        profile_top: 剖析摘要中列出的函数数量和最慢文件数量
+        workers: 隔离子进程数量，0表示在当前进程中依次处理
+        timeout: 单个文件的处理时间上限（秒），超时的文件被跳过并记录原因
+        max_memory_mb: 子进程常驻内存上限（MB），超限的文件被跳过并记录原因
+        streaming_threshold_mb: 超过该大小（MB）的.xlsx文件改用只读流式方式读取，None表示不启用
+        max_rows: 单个文件的明细行数上限
+        recursive: 是否递归处理子文件夹
+        cache_dir: 结果缓存目录，未变化的文件直接使用上次的提取结果；默认不使用缓存
+        report_file: JSON运行报告路径，传入True则使用"<输出文件名>_运行报告.json"，默认不生成
+        control: RunControl，用于暂停/取消并统计吞吐量；取消后用已提取的结果写出部分输出
+        checkpoint: 是否把已完成文件的结果定期写入检查点，传入True使用"<输出文件名>_检查点.sqlite"，
+            也可指定路径；中断后以相同参数重新运行会从检查点继续，正常完成后检查点被删除
+        shard: (序号, 分片数)，只处理按稳定哈希分到该分片的文件，并把结果写成部分结果文件
+            （output_file 为部分结果路径），各分片的部分结果用 merge_detail_partials 合并
+        index: 把每个文件的明细行写入编号索引（见 dlzb_index.py），传入True使用输出目录中的
+            dlzb_index.sqlite，也可指定路径；未变化的已索引文件不会重复写入
+        aggregate: 是否在明细行流过时按存货编码、部门、制单日期月份汇总预算数量与金额，
+            写成"按存货编码汇总"等工作表（CSV输出时写成同名的单独CSV文件）
+        headers: 提供各文件部门与制单日期的汇总提取结果（输出文件或编号索引路径，见
+            dlzb_reports.load_header_table），默认使用 index 指定的索引；都没有时部门和月份记为"未知"
+        typed: 是否把预算数量、目标价格转换为数值后输出，无法转换的值保留原文并逐行列出
+            （"类型转换失败"工作表，CSV输出时为单独的CSV文件）
+        snapshots: 把每个工作簿读到的明细块按内容哈希保存到快照库，传入True使用输出目录中的
+            dlzb_snapshots.sqlite，也可指定路径；可与汇总提取器共用同一个快照库
+        rules_only: 只按快照库中的明细块重新运行明细提取规则，不访问原始文件；快照库由 snapshots 指定
+        all_sheets: 除主工作表外，也提取其他表头探测为预算单的工作表，输出增加"工作表"列；
+            默认只读取活动工作表（快照只包含主工作表）
+        archives: 把文件夹中的ZIP归档当作文件夹，直接从归档读取其中的Excel文件（不解压到磁盘），
+            明细行的文件路径为"归档.zip!成员路径"
+        prefetch: 预读深度，在处理当前文件的同时由后台线程把后面 prefetch 个文件读入内存，
+            适合网络共享等读取慢的位置；0表示不预读，使用子进程时不预读
+        prefetch_memory_mb: 预读内容（已读入但尚未处理）的内存上限（MB）
+        schedule: 使用子进程时的处理顺序，"largest"（默认）按历史耗时（需要 cache_dir 或检查点中的记录）
+            或文件大小从大到小，"discovery" 按发现顺序；输出顺序不受影响
+        events: 结构化事件流（JSON Lines，见 EventStream）的输出路径，"-" 表示标准输出，
+            也可传入 EventStream；默认不输出
+        changes: 与结果缓存中上次的提取结果比较，写出变化报告（新增、删除的文件与新增、删除、修改的明细行，
+            明细行按序号对应，见 dlzb_reports.compare_runs），传入True使用"<输出文件名>_变化报告.xlsx"，
+            也可指定.xlsx或.csv路径；需要 cache_dir，不能用于分片或只按快照运行
+
+    设置了timeout或max_memory_mb时，即使workers为0也会使用一个隔离子进程。
+
+    Returns:
+        输出文件的Path对象
+    """
+    stream = EventStream.open(events)
+    options = dict(workers=workers, timeout=timeout, max_memory_mb=max_memory_mb,
+                   streaming_threshold_mb=streaming_threshold_mb, max_rows=max_rows, recursive=recursive,
+                   cache_dir=cache_dir, report_file=report_file, control=control, checkpoint=checkpoint,
+                   shard=shard, index=index, aggregate=aggregate, headers=headers, typed=typed,
+                   snapshots=snapshots, rules_only=rules_only, all_sheets=all_sheets, archives=archives,
+                   prefetch=prefetch, prefetch_memory_mb=prefetch_memory_mb, schedule=schedule, events=stream,
+                   changes=changes)
+    try:
+        if profile:
+            file_times = []
+            profile_path = default_profile_path(output_file) if profile is True else profile
+            with RunProfiler(profile_path, top_n=profile_top) as profiler:
+                output_path = _extract_details(folder_path, output_file, progress_callback, log_callback,
+                                               file_times, **options)
+            profiler.save(file_times)
+            return output_path
+        return _extract_details(folder_path, output_file, progress_callback, log_callback, **options)
+    except Exception as e:
+        if stream is not None:
+            stream.emit("run_error", message=str(e))
+        raise
+    finally:
+        if stream is not None and stream is not events:
+            stream.close()
+
+def _make_detail(budget_id, doc_id, values, file):
+    """由A~M列的13个值组装一行明细"""
+    detail = {'事业部预算编号': budget_id, '单据编号': doc_id}
+    detail.update(zip(DETAIL_COLUMNS[2:15], values))
+    detail['操作'] = str(file.absolute())
+    return detail
+
+def details_from_rows(rows, file, max_rows=MAX_DETAIL_ROWS, block=None):
+    """
+    按明细表规则从逐行的A~M列值中提取明细行：第4行A列为事业部预算编号，第6行A列为单据编号，
+    第9行起为明细行，A列序号为空时结束
+
+    Args:
+        rows: 从第1行开始、每行A~M列的值，可以是逐行读取的生成器（读到结束行即停止）
+        file: 文件Path对象
+        max_rows: 明细行数上限
+        block: 传入列表时，把读到的每一行追加到其中，作为明细块快照
+
+    Returns:
+        (明细行列表, 是否因超过上限而截断)
+    """
+    details = []
+    budget_id = doc_id = ''
+    for row_idx, values in enumerate(rows, 1):
+        values = tuple(values) + (None,) * (13 - len(values))
+        if block is not None:
+            block.append(values)
+        if row_idx == 4:
+            budget_id = values[0] or ''
+        elif row_idx == 6:
+            doc_id = values[0] or ''
+        elif row_idx > 8:
+            seq = values[0]
+            if seq is None or str(seq).strip() == '':
+                break
+            if len(details) >= max_rows:
+                return details, True
+            details.append(_make_detail(budget_id, doc_id, values, file))
+    return details, False
+
+def _xls_rows(ws):
+    """xlrd工作表逐行的A~M列值"""
+    return ([ws.cell_value(row, col) if col < ws.ncols else '' for col in range(13)] for row in range(ws.nrows))
+
+def _add_sheets(title, details, truncated, others, file, max_rows):
+    """
+    给主工作表的明细行标注工作表名称，并追加其他预算单工作表的明细行
+
+    Args:
+        title: 主工作表名称
+        details: 主工作表的明细行
+        truncated: 主工作表是否截断
+        others: [(工作表名称, 逐行的A~M列值)]，每个工作表各自受行数上限约束
+
+    Returns:
+        (明细行列表, 是否有工作表因超过上限而截断)
+    """
+    for detail in details:
+        detail['工作表'] = title
+    for other_title, rows in others:
+        sheet_details, sheet_truncated = details_from_rows(rows, file, max_rows)
+        for detail in sheet_details:
+            detail['工作表'] = other_title
+        details.extend(sheet_details)
+        truncated = truncated or sheet_truncated
+    return details, truncated
+
+def extract_file_details(file, streaming=False, max_rows=MAX_DETAIL_ROWS, block=None, all_sheets=False):
+    """
+    提取单个Excel文件的明细行
+
+    Args:
+        file: 文件Path对象（或ZIP归档中的 ArchiveMember）
+        streaming: 是否以只读流式方式读取.xlsx（适合大文件）
+        max_rows: 明细行数上限
+        block: 传入列表时，读到的A~M列各行追加到其中（见 details_from_rows），只包含主工作表
+        all_sheets: 是否也提取表头探测为预算单的其他工作表，每行明细标注"工作表"
+
+    Returns:
+        (明细行列表, 是否因超过上限而截断)
+    """
+    file = excel_path(file)
+    if file.suffix.lower() == '.xlsx':
+        import openpyxl
+        with workbook_source(file) as source:
+            wb = openpyxl.load_workbook(source, read_only=streaming, data_only=True)
+            try:
                 ws = wb.active
-                budget_id = ws.cell(row=4, column=1).value or ''
-                doc_id = ws.cell(row=6, column=1).value or ''
-                header_row = 8
-                row = header_row + 1
-                while True:
-                    seq = ws.cell(row=row, column=1).value
-                    if seq is None or str(seq).strip() == '':
+                details, truncated = details_from_rows(ws.iter_rows(max_col=13, values_only=True), file, max_rows,
+                                                       block)
+                if all_sheets:
+                    others = [(other.title, other.iter_rows(max_col=13, values_only=True))
+                              for other in wb.worksheets if other is not ws and is_budget_form(other)]
+                    details, truncated = _add_sheets(ws.title, details, truncated, others, file, max_rows)
+                return details, truncated
+            finally:
+                if streaming:
+                    wb.close()
+    elif file.suffix.lower() == '.xls':
+        wb = open_xls(file)
+        ws = wb.sheet_by_index(0)
+        details, truncated = details_from_rows(_xls_rows(ws), file, max_rows, block)
+        if all_sheets:
+            others = [(other.name, _xls_rows(other)) for other in wb.sheets()[1:] if is_budget_form(other)]
+            details, truncated = _add_sheets(ws.name, details, truncated, others, file, max_rows)
+        return details, truncated
+    return [], False
+
+def _is_streaming(file, streaming_threshold_mb):
+    """判断文件是否需要以流式方式读取"""
+    return (streaming_threshold_mb is not None and file.suffix.lower() == '.xlsx'
+            and file.stat().st_size > streaming_threshold_mb * 1024 * 1024)
+
+def _extract_file_task(file_path, streaming_threshold_mb, max_rows, snapshot=False, all_sheets=False):
+    """
+    子进程任务：提取单个文件，返回 (明细行, 是否截断, 是否流式读取, 耗时秒, 文件大小)
+
+    snapshot 为True时在末尾追加明细块快照，由调用方写入快照库
+    """
+    start = time.perf_counter()
+    file = excel_path(file_path)
+    streaming = _is_streaming(file, streaming_threshold_mb)
+    block = [] if snapshot else None
+    details, truncated = extract_file_details(file, streaming, max_rows, block, all_sheets)
+    seconds = time.perf_counter() - start
+    stat = file.stat()
+    result = (details, truncated, streaming, seconds, stat.st_size)
+    if snapshot:
+        result += ({"hash": content_hash(file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                    "data": {"rows": block}},)
+    return result
+
+def iter_detail_rows(folder_path, recursive=False, workers=0, timeout=None, max_memory_mb=None,
+                     streaming_threshold_mb=5, max_rows=MAX_DETAIL_ROWS, cache_dir=None, control=None,
+                     checkpoint=None, all_sheets=False, archives=False, prefetch=0, prefetch_memory_mb=256,
+                     schedule="largest"):
+    """
+    逐个产出文件夹中Excel文件的明细行，每处理完一个文件产出一条记录
+
+    Args:
+        folder_path: 文件夹路径，也可以是多个文件夹组成的列表
+        control: RunControl，用于暂停/取消并统计吞吐量；取消后不再产出新的记录
+        checkpoint: 检查点文件路径，已完成的文件定期写入其中，重新运行时直接产出（状态为"resumed"）
+        其余参数与 extract_details_from_folder 相同
+
+    Yields:
+        每个文件一条记录（字典）：
+            index: 文件在发现顺序中的序号（使用子进程时产出顺序为完成顺序）
+            total: 文件总数
+            path: 文件Path对象（ZIP归档中的文件为 ArchiveMember）
+            status: "ok"、"cached"（使用缓存结果）、"resumed"（从检查点恢复）、
+                    "skipped"（超时、内存超限或子进程崩溃）或 "error"
+            rows: 明细行列表，跳过或出错时为None
+            stats: 该文件的统计数据 {seconds: 耗时秒, size: 文件大小字节, streaming: 是否流式读取,
+                   truncated: 是否因超过行数上限而截断}，预读时还有 prefetch_wait（等待预读的秒数）；
+                   跳过或出错时为None
+            reason: 跳过或出错的原因，其他状态为None
+
+    Raises:
+        ValueError: 文件夹不存在或不是文件夹
+    """
+    error = check_folders(folder_path)
+    if error:
+        raise ValueError(error)
+    checkpoint_kind = _checkpoint_kind(folder_path, recursive, max_rows, all_sheets)
+    yield from _iter_detail_rows(discover_excel_files(folder_path, recursive, archives), workers, timeout, max_memory_mb,
+                                 streaming_threshold_mb, max_rows, cache_dir, control, checkpoint, checkpoint_kind,
+                                 all_sheets=all_sheets, prefetch=prefetch, prefetch_memory_mb=prefetch_memory_mb,
+                                 schedule=schedule)
+
+def _checkpoint_kind(folder_path, recursive, max_rows, all_sheets=False):
+    """检查点记录类别：参数不同的运行不会复用彼此的检查点"""
+    folders = [folder_path] if isinstance(folder_path, (str, Path)) else list(folder_path)
+    fingerprint = run_fingerprint(sorted(str(Path(f).absolute()) for f in folders), bool(recursive), max_rows,
+                                  bool(all_sheets))
+    return f"details:v{CACHE_VERSION}:{fingerprint}"
+
+def _cache_kind(max_rows, all_sheets=False):
+    """结果缓存的记录类别"""
+    return f"details:v{CACHE_VERSION}:{max_rows}{':sheets' if all_sheets else ''}"
+
+def _iter_detail_rows(excel_files, workers=0, timeout=None, max_memory_mb=None, streaming_threshold_mb=5,
+                      max_rows=MAX_DETAIL_ROWS, cache_dir=None, control=None, checkpoint=None,
+                      checkpoint_kind=None, snapshot_store=None, all_sheets=False, prefetch=0,
+                      prefetch_memory_mb=256, schedule="largest", utilization=None):
+    """
+    对已发现的文件列表逐个产出明细行，见 iter_detail_rows
+
+    传入 snapshot_store（SnapshotStore）时，读取的明细块同时写入快照库；
+    快照库中还没有明细块快照的文件不使用缓存和检查点结果，以便补齐快照。
+    prefetch 大于0时，在当前进程中依次处理的文件由 Prefetcher 提前读入内存（子进程处理时不预读）。
+    utilization 传入字典时，使用子进程处理后填入 workers（每个子进程的利用率）与 parallel_efficiency。
+    """
+    capture = snapshot_store is not None
+    total = len(excel_files)
+    if control is not None:
+        control.start(total)
+
+    def record(idx, status, result=None, reason=None):
+        rows = stats = None
+        if result is not None:
+            rows, truncated, streaming, seconds, size = result
+            stats = {"seconds": seconds, "size": size, "streaming": streaming, "truncated": truncated}
+        if control is not None:
+            control.advance(rows=len(rows) if rows else 0)
+        return {"index": idx, "total": total, "path": excel_files[idx], "status": status,
+                "rows": rows, "stats": stats, "reason": reason}
+
+    # 检查点中已完成的文件直接恢复，未变化的文件直接使用缓存结果
+    stores = []
+    if checkpoint:
+        stores.append((ResultStore.checkpoint(checkpoint, checkpoint_kind), "resumed"))
+    if cache_dir:
+        stores.append((ResultStore.in_dir(cache_dir, _cache_kind(max_rows, all_sheets)), "cached"))
+    file_stat_cache = {}
+    pending = list(range(total))
+    try:
+        if stores:
+            pending = []
+            for idx, file in enumerate(excel_files):
+                try:
+                    file_stat_cache[idx] = file.stat()
+                except OSError:
+                    pending.append(idx)
+                    continue
+                if capture and not snapshot_store.has(file.absolute(), file_stat_cache[idx], "details"):
+                    pending.append(idx)
+                    continue
+                for store, status in stores:
+                    result = store.get(file.absolute(), file_stat_cache[idx])
+                    if result is not None:
+                        yield record(idx, status, result)
                         break
-                    detail = {
-                        '事业部预算编号': budget_id,
-                        '单据编号': doc_id,
-                        '序号': ws.cell(row=row, column=1).value,
-                        '存货编码': ws.cell(row=row, column=2).value,
-                        '存货名称': ws.cell(row=row, column=3).value,
-                        '规格型号': ws.cell(row=row, column=4).value,
-                        '材质': ws.cell(row=row, column=5).value,
-                        '单位': ws.cell(row=row, column=6).value,
-                        '预算数量': ws.cell(row=row, column=7).value,
-                        '技术标准': ws.cell(row=row, column=8).value,
-                        '目标价格类别': ws.cell(row=row, column=9).value,
-                        '目标价格': ws.cell(row=row, column=10).value,
-                        '行备注': ws.cell(row=row, column=11).value,
-                        '源单行号': ws.cell(row=row, column=12).value,
-                        '年度合同': ws.cell(row=row, column=13).value,
-                        '操作': str(file.absolute()),
-                    }
-                    all_details.append(detail)
-                    row += 1
-            elif file.suffix.lower() == '.xls':
-                wb = xlrd.open_workbook(str(file))
-                ws = wb.sheet_by_index(0)
-                budget_id = ws.cell_value(3, 0) if ws.nrows > 3 else ''
-                doc_id = ws.cell_value(5, 0) if ws.nrows > 5 else ''
-                header_row = 7
-                row = header_row + 1
-                while row < ws.nrows:
-                    seq = ws.cell_value(row, 0)
-                    if seq is None or str(seq).strip() == '':
+                else:
+                    pending.append(idx)
+
+        def finish(idx, result):
+            if capture:
+                snapshot_store.put(excel_files[idx].absolute(), "details", result[5])
+                result = result[:5]
+            if idx in file_stat_cache:
+                for store, _ in stores:
+                    store.put(excel_files[idx].absolute(), file_stat_cache[idx], result, result[3])
+            return record(idx, "ok", result)
+
+        if workers or timeout or max_memory_mb:
+            if schedule == "largest":
+                # 按历史耗时或文件大小从大到小分配，小文件最后填补空闲的子进程
+                history = {}
+                for store, _ in stores:
+                    history.update(store.durations())
+                pending = largest_first(excel_files, pending, file_stat_cache, history)
+            # 在隔离的子进程中处理，超时或内存超限的文件被终止并记录，其余文件继续处理
+            pool = IsolatedPool(_extract_file_task, workers=workers or 1, timeout=timeout,
+                                max_memory_mb=max_memory_mb)
+            tasks = [(str(excel_files[idx]), streaming_threshold_mb, max_rows, capture, all_sheets)
+                     for idx in pending]
+            for task_idx, status, value in pool.run(tasks, control):
+                idx = pending[task_idx]
+                if status == "ok":
+                    yield finish(idx, value)
+                else:
+                    yield record(idx, "skipped", reason=value)
+            if utilization is not None:
+                utilization.update(workers=pool.worker_stats, parallel_efficiency=pool.parallel_efficiency)
+        else:
+            with Prefetcher([excel_files[idx] for idx in pending], prefetch, prefetch_memory_mb) as prefetcher:
+                for idx in pending:
+                    if control is not None and not control.checkpoint():
                         break
-                    detail = {
-                        '事业部预算编号': budget_id,
-                        '单据编号': doc_id,
-                        '序号': ws.cell_value(row, 0),
-                        '存货编码': ws.cell_value(row, 1),
-                        '存货名称': ws.cell_value(row, 2),
-                        '规格型号': ws.cell_value(row, 3),
-                        '材质': ws.cell_value(row, 4),
-                        '单位': ws.cell_value(row, 5),
-                        '预算数量': ws.cell_value(row, 6),
-                        '技术标准': ws.cell_value(row, 7),
-                        '目标价格类别': ws.cell_value(row, 8),
-                        '目标价格': ws.cell_value(row, 9),
-                        '行备注': ws.cell_value(row, 10),
-                        '源单行号': ws.cell_value(row, 11),
-                        '年度合同': ws.cell_value(row, 12),
-                        '操作': str(file.absolute()),
-                    }
-                    all_details.append(detail)
-                    row += 1
-            if log_callback:
+                    file, waited = prefetcher.take()
+                    try:
+                        result = _extract_file_task(file, streaming_threshold_mb, max_rows, capture, all_sheets)
+                    except Exception as e:
+                        yield record(idx, "error", reason=str(e))
+                        continue
+                    done = finish(idx, result)
+                    if prefetch:
+                        done["stats"]["prefetch_wait"] = waited
+                    yield done
+    finally:
+        for store, _ in stores:
+            store.close()
+
+def _iter_snapshot_details(files, max_rows, snapshot_store, control=None):
+    """按快照库中的明细块快照逐个产出明细行（状态为"snapshot"），记录结构见 iter_detail_rows"""
+    total = len(files)
+    if control is not None:
+        control.start(total)
+    for idx, file in enumerate(files):
+        if control is not None and not control.checkpoint():
+            break
+        start = time.perf_counter()
+        data, size = snapshot_store.get(file, "details")
+        rows, truncated = details_from_rows(data["rows"], file, max_rows)
+        if control is not None:
+            control.advance(rows=len(rows))
+        yield {"index": idx, "total": total, "path": file, "status": "snapshot", "rows": rows,
+               "stats": {"seconds": time.perf_counter() - start, "size": size, "streaming": False,
+                         "truncated": truncated},
+               "reason": None}
+
+def _extract_details(folder_path, output_file, progress_callback=None, log_callback=None, file_times=None,
+                     workers=0, timeout=None, max_memory_mb=None, streaming_threshold_mb=5,
+                     max_rows=MAX_DETAIL_ROWS, recursive=False, cache_dir=None, report_file=None, control=None,
+                     checkpoint=False, shard=None, index=None, aggregate=False, headers=None, typed=False,
+                     snapshots=None, rules_only=False, all_sheets=False, archives=False, prefetch=0,
+                     prefetch_memory_mb=256, schedule="largest", events=None, changes=None):
+    start_time = time.time()
+    timer = StageTimer()
+    folders = [Path(folder_path)] if isinstance(folder_path, (str, Path)) else [Path(f) for f in folder_path]
+    # 只按快照运行时不访问文件夹
+    error = None if rules_only else check_folders(folders)
+    error = error or check_run_options(output_file, snapshots, rules_only, changes, cache_dir, shard)
+    if error:
+        raise ValueError(error)
+    snapshot_store = None
+    if snapshots or rules_only:
+        snapshot_path = default_snapshot_path(output_file) if snapshots in (None, True) else Path(snapshots)
+        snapshot_store = SnapshotStore(snapshot_path)
+    unreadable = []
+    with timer.stage("discovery"):
+        if rules_only:
+            excel_files = snapshot_store.paths("details", folders, recursive)
+        else:
+            excel_files = discover_excel_files(folders, recursive, archives, unreadable)
+            if snapshot_store is not None:
+                snapshot_store.record_order(excel_files)
+        if shard:
+            excel_files = select_shard(excel_files, folders, shard)
+            unreadable = [item for item in unreadable if select_shard([item[0]], folders, shard)]
+        keys = [shard_key(file, folders) for file in excel_files] if shard else None
+    # 变化报告：在本次运行覆盖结果缓存之前读取上次的结果
+    previous = None
+    if changes:
+        with timer.stage("change_report"):
+            cache = ResultStore.in_dir(cache_dir, _cache_kind(max_rows, all_sheets))
+            previous = cache.results(folders, recursive)
+            cache.close()
+    if events is not None:
+        events.run_start("details", len(excel_files), folders=[str(folder.absolute()) for folder in folders],
+                         output=str(Path(output_file).absolute()))
+    if log_callback:
+        log_callback(f"共发现{len(excel_files)}个Excel文件待处理"
+                     f"{f'（分片 {shard[0]}/{shard[1]}）' if shard else ''}。\n")
+    results = [None] * len(excel_files)
+    # 无法读取的归档计入跳过的文件
+    failed_files = [(archive.name, reason) for archive, reason in unreadable]
+    if events is not None:
+        for archive, reason in unreadable:
+            events.warning(archive, "read_error", reason)
+    streamed = 0
+    truncated = 0
+    cached = 0
+    resumed = 0
+    done = 0
+    checkpoint_path = None
+    if checkpoint:
+        checkpoint_path = default_checkpoint_path(output_file) if checkpoint is True else Path(checkpoint)
+    index_db = None
+    if index:
+        from dlzb_index import BudgetIndex, default_index_path
+        index_db = BudgetIndex(default_index_path(output_file) if index is True else index)
+    aggregator = None
+    if aggregate:
+        from dlzb_reports import DetailAggregator, load_header_table
+        if headers is None and index_db is not None:
+            headers = index_db.db_path
+        aggregator = DetailAggregator(load_header_table(headers) if headers else None)
+        if not headers and log_callback:
+            log_callback("未提供汇总提取结果，按部门、月份的汇总记为\"未知\"。\n")
+
+    utilization = {}
+    if rules_only:
+        records = _iter_snapshot_details(excel_files, max_rows, snapshot_store, control)
+    else:
+        records = _iter_detail_rows(excel_files, workers, timeout, max_memory_mb, streaming_threshold_mb,
+                                    max_rows, cache_dir, control, checkpoint_path,
+                                    _checkpoint_kind(folders, recursive, max_rows, all_sheets), snapshot_store,
+                                    all_sheets, prefetch, prefetch_memory_mb, schedule, utilization)
+    # 逐文件的"已处理"日志只在 INFO 级别输出，默认在结束时输出汇总计数
+    per_file = log_callback is not None and log.isEnabledFor(logging.INFO)
+    for record in records:
+        file = record["path"]
+        results[record["index"]] = record["rows"]
+        if index_db is not None and record["rows"] is not None:
+            index_db.add_details(file, record["rows"])
+        if aggregator is not None and record["rows"]:
+            with timer.stage("aggregate"):
+                aggregator.add(file, record["rows"])
+        if events is not None:
+            _emit_record(events, record, max_rows)
+        if record["status"] in ("ok", "snapshot"):
+            file_stats = record["stats"]
+            streamed += file_stats["streaming"]
+            timer.add("detail_read" if record["status"] == "ok" else "snapshot_load", file_stats["seconds"])
+            if "prefetch_wait" in file_stats:
+                timer.add("prefetch_wait", file_stats["prefetch_wait"])
+            if file_times is not None:
+                file_times.append((file.name, file_stats["seconds"], file_stats["size"]))
+            truncated += bool(file_stats["truncated"])
+            if file_stats["truncated"] and log_callback:
+                log_callback(f"警告: {file.name} 明细行数超过{max_rows}行，已截断\n")
+            if per_file:
                 log_callback(f"已处理: {file.name}\n")
-            if progress_callback:
-                progress_callback((idx + 1) / len(excel_files) * 100)
-        except Exception as e:
+        elif record["status"] == "cached":
+            cached += 1
+        elif record["status"] == "resumed":
+            resumed += 1
+        elif record["status"] == "skipped":
+            failed_files.append((file.name, record["reason"]))
             if log_callback:
-                log_callback(f"处理文件 {file.name} 出错: {e}\n")
-    df = pd.DataFrame(all_details, columns=DETAIL_COLUMNS)
+                log_callback(f"处理文件 {file.name} 已跳过: {record['reason']}\n")
+        elif log_callback:
+            log_callback(f"处理文件 {file.name} 出错: {record['reason']}\n")
+        done += 1
+        if progress_callback:
+            progress_callback(done / len(excel_files) * 100)
+    if index_db is not None:
+        index_db.close()
+        if log_callback:
+            log_callback(f"编号索引已更新: {index_db.db_path.absolute()}\n")
+    if snapshot_store is not None:
+        snapshot_store.close()
+        if log_callback and not rules_only:
+            log_callback(f"快照库已更新: {snapshot_store.db_path.absolute()}\n")
+    if log_callback and resumed:
+        log_callback(f"{resumed}个文件已在上次中断的运行中完成，从检查点恢复。\n")
+    if log_callback and cached:
+        log_callback(f"{cached}个文件未变化，使用了缓存结果。\n")
+    if log_callback and utilization.get("workers"):
+        log_callback("".join(f"{line}\n" for line in format_utilization(utilization["workers"],
+                                                                        utilization["parallel_efficiency"])))
+    cancelled = control is not None and control.cancelled
+    if cancelled and log_callback:
+        log_callback(f"已取消：已处理 {done}/{len(excel_files)} 个文件，输出部分结果。\n")
+        if checkpoint_path:
+            log_callback(f"检查点保留在 {checkpoint_path}，以相同参数重新运行可继续。\n")
+
+    run_stats = {
+        "total_files": len(excel_files),
+        "processed_files": sum(1 for details in results if details is not None),
+        "detail_rows": sum(len(details) for details in results if details),
+        "streamed_files": streamed,
+        "cached_files": cached,
+        "resumed_files": resumed,
+        "failed_files": failed_files,
+        "cancelled": cancelled,
+    }
+    if log_callback:
+        log_callback(f"已处理{run_stats['processed_files']}个文件，共{run_stats['detail_rows']}行明细"
+                     f"{f'，{truncated}个文件的明细行被截断' if truncated else ''}。\n")
     output_path = Path(output_file)
-    df.to_excel(output_path, index=False, engine='openpyxl')
-    wb = openpyxl.load_workbook(output_path)
-    ws = wb.active
-    op_col = DETAIL_COLUMNS.index('操作') + 1
-    for i in range(2, ws.max_row + 1):
-        cell = ws.cell(row=i, column=op_col)
-        file_path = cell.value
-        if file_path:
-            cell.value = '打开文件'
-            cell.hyperlink = file_path
-            cell.style = 'Hyperlink'
-    from openpyxl.utils import get_column_letter
-    for col in range(1, ws.max_column + 1):
-        max_length = 0
-        col_letter = get_column_letter(col)
-        for row in range(1, ws.max_row + 1):
-            cell = ws.cell(row=row, column=col)
-            try:
-                cell_len = len(str(cell.value)) if cell.value is not None else 0
-                if cell_len > max_length:
-                    max_length = cell_len
-            except:
-                pass
-        ws.column_dimensions[col_letter].width = max_length * 1.2 + 2
-    wb.save(output_path)
+    if shard:
+        # 分片运行只写出部分结果，由 dlzb_merge.py 合并成最终的明细表
+        save_partial(output_path, "details", shard, {"max_rows": max_rows, "all_sheets": bool(all_sheets)},
+                     list(zip(keys, results)),
+                     {**run_stats, "timings": timer}, folders=[str(folder.absolute()) for folder in folders],
+                     elapsed_seconds=round(time.time() - start_time, 3))
+    else:
+        aggregates = None
+        if aggregator is not None:
+            with timer.stage("aggregate"):
+                aggregates = aggregator.results()
+        write_details_output([detail for details in results if details for detail in details], output_path,
+                             run_stats, timer, aggregates, typed)
+    if previous is not None:
+        _write_changes(previous, excel_files, results, max_rows, all_sheets, cache_dir, changes, output_path, timer,
+                       log_callback)
+    _write_details_report(report_file, output_path, timer, start_time, folders, run_stats, utilization)
+    if events is not None:
+        events.run_end(output=str(output_path.absolute()), elapsed_seconds=round(time.time() - start_time, 3),
+                       **{**run_stats, "failed_files": len(failed_files)})
+    # 输出已完整写出，检查点不再需要；取消的运行保留检查点以便继续
+    if checkpoint_path and not cancelled:
+        remove_store(checkpoint_path)
     if log_callback:
-        log_callback(f"明细表已保存到: {output_path.absolute()}\n")
+        log_callback(f"{'分片部分结果' if shard else '明细表'}已保存到: {output_path.absolute()}\n")
     return output_path
 
-def run_gui():
+def _write_changes(previous, excel_files, results, max_rows, all_sheets, cache_dir, changes, output_path, timer,
+                   log_callback=None):
+    """
+    比较上次（结果缓存）与本次的明细行并写出变化报告，已删除文件的缓存结果随之清除
+
+    Args:
+        previous: ResultStore.results 读取的上次结果
+        changes: 变化报告路径，True表示使用输出文件对应的默认路径
+    """
+    from dlzb_reports import compare_runs, change_counts, default_change_report_path, write_change_report
+    with timer.stage("change_report"):
+        current = {str(file.absolute()): rows for file, rows in zip(excel_files, results)}
+        before = {path: payload[0] for path, payload in previous.items()}
+        fields = [column for column in DETAIL_COLUMNS if column not in ('序号', '操作')]
+        report = compare_runs(before, current, fields, line_key='序号')
+        change_path = write_change_report(report, default_change_report_path(output_path) if changes is True
+                                          else Path(changes))
+        removed = [path for path in before if path not in current]
+        if removed:
+            cache = ResultStore.in_dir(cache_dir, _cache_kind(max_rows, all_sheets))
+            cache.discard(removed)
+            cache.close()
+    if log_callback:
+        counts = change_counts(report)
+        log_callback(f"与上次运行相比：{'，'.join(f'{kind} {count}' for kind, count in counts.items()) or '没有变化'}。\n"
+                     f"变化报告已保存到: {change_path.absolute()}\n")
+
+def _emit_record(stream, record, max_rows):
+    """把一条文件记录（见 iter_detail_rows）的警告与完成事件写入事件流"""
+    file, file_stats, rows = record["path"].absolute(), record["stats"], record["rows"]
+    measured = record["status"] in ("ok", "snapshot")
+    if measured and file_stats["truncated"]:
+        stream.warning(file, "truncated", f"明细行数超过{max_rows}行，已截断")
+    if record["status"] == "error":
+        stream.warning(file, "file_error", record["reason"])
+    stream.file_done(record["index"], file, record["status"], file_stats["seconds"] if measured else None,
+                     file_stats["size"] if file_stats else None, len(rows) if rows else 0, record["reason"])
+
+def detail_columns(all_details):
+    """输出列：有明细行标注了工作表（多工作表提取）时，在"操作"列前增加"工作表"列"""
+    if any('工作表' in detail for detail in all_details):
+        return DETAIL_COLUMNS[:-1] + ['工作表', '操作']
+    return DETAIL_COLUMNS
+
+def write_details_output(all_details, output_path, run_stats, timer, aggregates=None, typed=False):
+    """
+    将明细行写入输出文件
+
+    .xlsx输出带超链接和统计信息工作表；.csv输出只包含数据，"操作"列改为文件路径。
+
+    Args:
+        all_details: 明细行列表
+        output_path: 输出文件Path对象
+        run_stats: 统计数据字典（total_files、processed_files、detail_rows、streamed_files、
+            cached_files、resumed_files、failed_files、cancelled，合并分片时另有 shards、missing_shards）
+        timer: StageTimer，记录写出各阶段的耗时
+        aggregates: {工作表名: DataFrame} 形式的汇总表（见 dlzb_reports.DetailAggregator），默认不输出
+        typed: 是否把预算数量、目标价格转换为数值（无法转换的值保留原文并逐行列出）
+    """
+    import pandas as pd
+    import openpyxl
+
+    columns = detail_columns(all_details)
+    df = pd.DataFrame(all_details, columns=columns)
+    conversion_failures = None
+    if typed:
+        from dlzb_reports import convert_types, write_failure_sheet, failure_csv_path
+        with timer.stage("type_conversion"):
+            conversion_failures = convert_types(df, numeric_columns=['预算数量', '目标价格'],
+                                                context_column='操作').rename(columns={'操作': '文件路径'})
+        run_stats["conversion_failures"] = len(conversion_failures)
+    if output_path.suffix.lower() == '.csv':
+        # CSV不支持超链接，直接输出文件路径
+        with timer.stage("excel_write"):
+            df.rename(columns={'操作': '文件路径'}).to_csv(output_path, index=False, encoding='utf-8-sig')
+            if conversion_failures is not None and len(conversion_failures):
+                conversion_failures.to_csv(failure_csv_path(output_path), index=False, encoding='utf-8-sig')
+            for sheet, table in (aggregates or {}).items():
+                table.to_csv(output_path.with_name(f"{output_path.stem}_{sheet}.csv"), index=False,
+                             encoding='utf-8-sig')
+        return
+    with timer.stage("excel_write"):
+        df.to_excel(output_path, index=False, engine='openpyxl')
+    with timer.stage("restyle"):
+        wb = openpyxl.load_workbook(output_path)
+        ws = wb.active
+        op_col = columns.index('操作') + 1
+        for i in range(2, ws.max_row + 1):
+            cell = ws.cell(row=i, column=op_col)
+            file_path = cell.value
+            if file_path:
+                cell.value = '打开文件'
+                cell.hyperlink = link_target(file_path)
+                cell.style = 'Hyperlink'
+        from openpyxl.utils import get_column_letter
+        for col in range(1, ws.max_column + 1):
+            max_length = 0
+            col_letter = get_column_letter(col)
+            for row in range(1, ws.max_row + 1):
+                cell = ws.cell(row=row, column=col)
+                try:
+                    cell_len = len(str(cell.value)) if cell.value is not None else 0
+                    if cell_len > max_length:
+                        max_length = cell_len
+                except:
+                    pass
+            ws.column_dimensions[col_letter].width = max_length * 1.2 + 2
+
+    # 统计信息
+    ws_stats = wb.create_sheet(title="统计信息")
+    ws_stats.append(["总文件数", run_stats["total_files"]])
+    ws_stats.append(["成功处理文件数", run_stats["processed_files"]])
+    ws_stats.append(["明细行数", run_stats["detail_rows"]])
+    ws_stats.append(["流式读取的大文件数", run_stats["streamed_files"]])
+    ws_stats.append(["使用缓存结果的文件数", run_stats["cached_files"]])
+    if run_stats["resumed_files"]:
+        ws_stats.append(["从检查点恢复的文件数", run_stats["resumed_files"]])
+    if "conversion_failures" in run_stats:
+        ws_stats.append(["类型转换失败的值", run_stats["conversion_failures"]])
+    if run_stats.get("shards"):
+        ws_stats.append(["合并的分片数", run_stats["shards"]])
+    if run_stats.get("missing_shards"):
+        ws_stats.append(["缺少的分片", ", ".join(map(str, run_stats["missing_shards"]))])
+    if run_stats["cancelled"]:
+        ws_stats.append(["运行状态", "已取消（部分结果）"])
+    if run_stats["failed_files"]:
+        ws_stats.append([])
+        ws_stats.append([f"跳过的文件（{len(run_stats['failed_files'])}个）"])
+        for name, reason in run_stats["failed_files"]:
+            ws_stats.append([name, reason])
+    ws_stats.column_dimensions['A'].width = 30
+    ws_stats.column_dimensions['B'].width = 30
+
+    # 汇总表
+    for sheet, table in (aggregates or {}).items():
+        ws_sum = wb.create_sheet(title=sheet)
+        ws_sum.append(list(table.columns))
+        for values in table.itertuples(index=False):
+            ws_sum.append(list(values))
+        for col in range(1, len(table.columns) + 1):
+            ws_sum.column_dimensions[get_column_letter(col)].width = 20
+        for row in ws_sum.iter_rows(min_row=2, min_col=len(table.columns) - 2, max_col=len(table.columns) - 1):
+            for cell in row:
+                cell.number_format = '#,##0.00'
+        ws_sum.freeze_panes = "A2"
+    if conversion_failures is not None and len(conversion_failures):
+        write_failure_sheet(wb, conversion_failures)
+    with timer.stage("workbook_save"):
+        wb.save(output_path)
+
+def merge_detail_partials(partials, output_file, report_file=None, log_callback=None):
+    """
+    把各分片的部分结果合并成最终的明细表
+
+    Args:
+        partials: dlzb_store.load_partials 读取的明细部分结果列表
+        output_file: 输出文件路径，后缀为.csv时输出CSV
+        report_file: JSON运行报告路径，传入True则使用"<输出文件名>_运行报告.json"，默认不生成
+        log_callback: 日志回调函数，参数为日志文本
+
+    合并结果按分片键（输入文件夹名/相对路径）排序，与分片数和各分片的完成顺序无关。
+
+    Returns:
+        输出文件的Path对象
+    """
+    start_time = time.time()
+    timer = StageTimer()
+    records = []
+    run_stats = {"total_files": 0, "processed_files": 0, "detail_rows": 0, "streamed_files": 0,
+                 "cached_files": 0, "resumed_files": 0, "failed_files": [], "cancelled": False}
+    folders = []
+    for partial in partials:
+        records.extend(partial["records"])
+        for key, value in partial["stats"].items():
+            if key == "timings":
+                timer.merge(value)
+            elif key == "failed_files":
+                run_stats[key].extend(value)
+            elif key == "cancelled":
+                run_stats[key] = run_stats[key] or value
+            else:
+                run_stats[key] += value
+        folders.extend(folder for folder in partial["folders"] if folder not in folders)
+    run_stats["shards"] = len(partials)
+    run_stats["missing_shards"] = missing_shards(partials)
+    records.sort(key=lambda record: record[0])
+    output_path = Path(output_file)
+    write_details_output([detail for _, details in records if details for detail in details], output_path,
+                         run_stats, timer)
+    # 各分片并行运行，已用时间取最慢分片的耗时加上合并耗时
+    start_time -= max(partial["elapsed_seconds"] for partial in partials)
+    _write_details_report(report_file, output_path, timer, start_time, [Path(folder) for folder in folders],
+                          run_stats)
+    if log_callback:
+        if run_stats["missing_shards"]:
+            log_callback(f"警告: 缺少分片 {', '.join(map(str, run_stats['missing_shards']))}，明细表不完整\n")
+        log_callback(f"已合并{len(partials)}个分片，共{run_stats['detail_rows']}行明细，"
+                     f"保存到: {output_path.absolute()}\n")
+    return output_path
+
+def _write_details_report(report_file, output_path, timer, start_time, folders, run_stats, utilization=None):
+    """写入JSON运行报告（report_file为空时不生成），utilization 为子进程利用率（见 _iter_detail_rows）"""
+    if not report_file:
+        return None
+    return write_run_report(
+        default_report_path(output_path) if report_file is True else report_file,
+        timer,
+        folder=[str(folder.absolute()) for folder in folders],
+        output=str(output_path.absolute()),
+        elapsed_seconds=round(time.time() - start_time, 3),
+        stats=run_stats,
+        **(utilization or {}),
+    )
+
+def run_gui(profile=None, profile_top=20):
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+
     root = tk.Tk()
     root.title("明细表批量提取工具")
     root.geometry("700x500")
@@ -174,47 +868,233 @@ def run_gui():
     ttk.Label(frm, text="输出文件名:").grid(row=1, column=0, sticky=tk.W, pady=5)
     output_entry = ttk.Entry(frm, textvariable=output_var, width=50)
     output_entry.grid(row=1, column=1, sticky=tk.W, pady=5)
+    sheets_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(frm, text="同时提取其他预算单工作表", variable=sheets_var).grid(row=1, column=2, padx=5)
+    archives_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(frm, text="读取ZIP归档", variable=archives_var).grid(row=1, column=3, padx=5)
+    verbose_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(frm, text="显示每个文件", variable=verbose_var).grid(row=1, column=4, padx=5)
 
     # 进度条
     progress_var = tk.DoubleVar()
     progress_bar = ttk.Progressbar(frm, variable=progress_var, maximum=100)
     progress_bar.grid(row=2, column=0, columnspan=3, sticky=tk.EW, pady=10)
 
+    # 吞吐量、已用时间和剩余时间
+    status_label = ttk.Label(frm, text="")
+    status_label.grid(row=3, column=0, columnspan=3, sticky=tk.W)
+
     # 日志
     log_text = tk.Text(frm, height=15, font=("Consolas", 9))
-    log_text.grid(row=3, column=0, columnspan=3, sticky=tk.NSEW, pady=5)
-    frm.rowconfigure(3, weight=1)
+    log_text.grid(row=4, column=0, columnspan=3, sticky=tk.NSEW, pady=5)
+    frm.rowconfigure(4, weight=1)
     frm.columnconfigure(1, weight=1)
 
-    def log_callback(msg):
-        log_text.insert(tk.END, msg)
-        log_text.see(tk.END)
-        log_text.update_idletasks()
+    # 工作线程只向事件通道投递日志和进度，由主循环定时批量更新界面
+    channel = UIEventChannel()
+    pump_channel(root, channel, log_text, progress_var.set)
+
+    # 当前运行的控制对象，未运行时为None
+    current_run = {"control": None}
+
+    def refresh_status():
+        control = current_run["control"]
+        if control is not None:
+            status_label.config(text=control.status_text())
+            root.after(500, refresh_status)
+
+    def toggle_pause():
+        control = current_run["control"]
+        if control is None:
+            return
+        if control.paused:
+            control.resume()
+            pause_button.config(text="暂停")
+        else:
+            control.pause()
+            pause_button.config(text="继续")
 
-    def progress_callback(val):
-        progress_var.set(val)
-        root.update_idletasks()
+    def cancel_run():
+        control = current_run["control"]
+        if control is not None:
+            control.cancel()
+            status_label.config(text="正在取消，稍后输出已处理的部分结果...")
+            pause_button.config(state=tk.DISABLED)
+            cancel_button.config(state=tk.DISABLED)
+
+    def finish_run():
+        status_label.config(text=current_run["control"].status_text())
+        current_run["control"] = None
+        start_button.config(state=tk.NORMAL)
+        pause_button.config(state=tk.DISABLED, text="暂停")
+        cancel_button.config(state=tk.DISABLED)
 
     def start_extract():
         folder = folder_var.get()
         output_file = output_var.get()
+        all_sheets = sheets_var.get()
+        archives = archives_var.get()
+        set_log_level(logging.INFO if verbose_var.get() else logging.WARNING)
         if not folder:
             messagebox.showerror("错误", "请选择Excel文件夹！")
             return
         log_text.delete(1.0, tk.END)
         progress_var.set(0)
+        control = RunControl()
+        current_run["control"] = control
+        start_button.config(state=tk.DISABLED)
+        pause_button.config(state=tk.NORMAL, text="暂停")
+        cancel_button.config(state=tk.NORMAL)
+        refresh_status()
         def task():
             try:
-                out_path = extract_details_from_folder(folder, output_file, progress_callback, log_callback)
-                messagebox.showinfo("完成", f"处理完成！\n输出文件: {out_path}")
+                out_path = extract_details_from_folder(folder, output_file, channel.progress, channel.log,
+                                                       profile=profile, profile_top=profile_top, control=control,
+                                                       checkpoint=True, all_sheets=all_sheets,
+                                                       archives=archives)
+                if control.cancelled:
+                    channel.post(messagebox.showinfo, "已取消", f"已取消，已处理的部分结果已保存\n输出文件: {out_path}")
+                else:
+                    channel.post(messagebox.showinfo, "完成", f"处理完成！\n输出文件: {out_path}")
             except Exception as e:
-                messagebox.showerror("错误", f"处理出错: {e}")
+                channel.post(messagebox.showerror, "错误", f"处理出错: {e}")
+            finally:
+                channel.post(finish_run)
         threading.Thread(target=task, daemon=True).start()
 
-    ttk.Button(frm, text="开始提取", command=start_extract).grid(row=4, column=0, pady=10)
-    ttk.Button(frm, text="退出", command=root.destroy).grid(row=4, column=2, pady=10)
+    button_frame = ttk.Frame(frm)
+    button_frame.grid(row=5, column=0, columnspan=2, sticky=tk.W, pady=10)
+    start_button = ttk.Button(button_frame, text="开始提取", command=start_extract)
+    start_button.pack(side=tk.LEFT, padx=5)
+    pause_button = ttk.Button(button_frame, text="暂停", command=toggle_pause, state=tk.DISABLED)
+    pause_button.pack(side=tk.LEFT, padx=5)
+    cancel_button = ttk.Button(button_frame, text="取消", command=cancel_run, state=tk.DISABLED)
+    cancel_button.pack(side=tk.LEFT, padx=5)
+    ttk.Button(frm, text="退出", command=root.destroy).grid(row=5, column=2, pady=10)
 
     root.mainloop()
 
+def main(argv=None):
+    """
+    命令行入口，供计划任务和流水线调用（不依赖tkinter）
+
+    不带任何参数时启动图形界面。
+
+    Returns:
+        进程退出码：0成功，1处理失败，2参数或输入文件夹错误
+    """
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="明细表批量提取工具")
+    parser.add_argument("folders", nargs="*", help="要处理的文件夹，可指定多个；不指定时启动图形界面")
+    parser.add_argument("-o", "--output", default="明细表汇总.xlsx",
+                        help="输出文件路径，后缀为.csv时输出CSV（默认：明细表汇总.xlsx）")
+    parser.add_argument("-r", "--recursive", action="store_true", help="递归处理子文件夹")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="隔离子进程数量，0表示在当前进程中依次处理")
+    parser.add_argument("--timeout", type=float, default=None, help="单个文件的处理时间上限（秒）")
+    parser.add_argument("--max-memory", type=int, default=None, help="子进程常驻内存上限（MB）")
+    parser.add_argument("--streaming-threshold", type=float, default=5,
+                        help="超过该大小（MB）的.xlsx文件使用只读流式读取，0表示不启用（默认：5）")
+    parser.add_argument("--max-rows", type=int, default=MAX_DETAIL_ROWS, help="单个文件的明细行数上限")
+    parser.add_argument("--cache", metavar="DIR", default=None, help="结果缓存目录，未变化的文件直接使用上次的结果")
+    parser.add_argument("--changes", nargs="?", const=True, default=None,
+                        help="与 --cache 中上次的结果比较，写出变化报告（新增、删除的文件与修改的明细行），"
+                             "可指定.xlsx或.csv路径（默认：<输出文件名>_变化报告.xlsx）")
+    parser.add_argument("--checkpoint", nargs="?", const=True, default=False,
+                        help="定期保存已完成文件的结果，中断后以相同参数重新运行可继续；可指定检查点路径")
+    parser.add_argument("--shard", metavar="I/K", default=None,
+                        help="只处理第I个分片（共K个，I从0开始），结果写成部分结果文件，用 dlzb_merge.py 合并")
+    parser.add_argument("--index", nargs="?", const=True, default=None,
+                        help="把明细行写入编号索引（默认为输出目录中的dlzb_index.sqlite），用 dlzb_index.py 查询")
+    parser.add_argument("--typed", action="store_true",
+                        help="把预算数量、目标价格转换为数值后输出，无法转换的值在\"类型转换失败\"工作表中列出")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="按存货编码、部门、制单日期月份汇总预算数量与金额，写成汇总工作表")
+    parser.add_argument("--headers", default=None,
+                        help="提供部门与制单日期的汇总提取结果（汇总输出文件或编号索引），默认使用 --index 的索引")
+    parser.add_argument("--all-sheets", action="store_true",
+                        help="同时提取其他表头像预算单的工作表，并增加\"工作表\"列")
+    parser.add_argument("--archives", action="store_true",
+                        help="把文件夹中的ZIP归档当作文件夹，直接读取其中的Excel文件（路径为 归档.zip!成员路径）")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="预读深度：处理当前文件时由后台线程提前读入后面N个文件（默认：0，不预读；使用子进程时不预读）")
+    parser.add_argument("--prefetch-memory", type=float, default=256, metavar="MB",
+                        help="预读内容的内存上限（MB，默认：256）")
+    parser.add_argument("--schedule", choices=("largest", "discovery"), default="largest",
+                        help="使用子进程时的处理顺序：largest按历史耗时或文件大小从大到小（默认），discovery按发现顺序")
+    parser.add_argument("--snapshots", nargs="?", const=True, default=None,
+                        help="把每个工作簿的明细块按内容哈希保存到快照库（默认为输出目录中的dlzb_snapshots.sqlite）")
+    parser.add_argument("--rules-only", action="store_true",
+                        help="只按快照库重新运行明细提取规则，不访问原始文件")
+    parser.add_argument("--progress", action="store_true", help="在标准错误输出中显示进度百分比")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="输出每个文件的警告与处理信息（默认只输出汇总计数），-vv 另外输出验证通过等细节")
+    parser.add_argument("--events", metavar="PATH", default=None,
+                        help="把运行开始、文件完成、警告、吞吐量与运行汇总事件逐行写成JSON；\"-\"表示标准输出"
+                             "（其余输出改写到标准错误输出）")
+    parser.add_argument("--report", nargs="?", const=True, default=None,
+                        help="生成JSON运行报告，可指定路径（默认与输出文件同名）")
+    parser.add_argument("--profile", nargs="?", const=True, default=None,
+                        help="开启性能剖析，可指定pstats输出路径")
+    parser.add_argument("--profile-top", type=int, default=20, help="剖析摘要中列出的函数和最慢文件数量")
+    args = parser.parse_args(argv)
+    set_log_level(verbosity_level(args.verbose))
+
+    if not args.folders:
+        run_gui(profile=args.profile, profile_top=args.profile_top)
+        return 0
+
+    error = None if args.rules_only else check_folders(args.folders)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    output = Path(args.output).absolute()
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        if output.suffix.lower() != PARTIAL_SUFFIX:
+            output = default_partial_path(output, shard)
+    error = check_run_options(output, args.snapshots, args.rules_only, args.changes, args.cache, shard)
+    if error:
+        print(error, file=sys.stderr)
+        return 2
+    if args.headers and not Path(args.headers).exists():
+        print(f"错误：汇总提取结果 {args.headers} 不存在！", file=sys.stderr)
+        return 2
+
+    def print_progress(percent):
+        print(f"\r进度: {percent:5.1f}%", end="", file=sys.stderr, flush=True)
+
+    try:
+        with events_on_stdout() if args.events == "-" else nullcontext(args.events) as events:
+            extract_details_from_folder(
+                args.folders, output,
+                progress_callback=print_progress if args.progress else None,
+                log_callback=lambda msg: print(msg, end=""),
+                profile=args.profile, profile_top=args.profile_top, workers=args.workers, timeout=args.timeout,
+                max_memory_mb=args.max_memory, streaming_threshold_mb=args.streaming_threshold or None,
+                max_rows=args.max_rows, recursive=args.recursive, cache_dir=args.cache, report_file=args.report,
+                checkpoint=args.checkpoint, shard=shard, index=args.index, aggregate=args.aggregate,
+                headers=args.headers, typed=args.typed, snapshots=args.snapshots, rules_only=args.rules_only,
+                all_sheets=args.all_sheets, archives=args.archives, prefetch=args.prefetch,
+                prefetch_memory_mb=args.prefetch_memory, schedule=args.schedule, events=events,
+                changes=args.changes,
+            )
+    except Exception as e:
+        if args.progress:
+            print(file=sys.stderr)
+        print(f"出错：{e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return 1
+    if args.progress:
+        print(file=sys.stderr)
+    return 0
+
 if __name__ == "__main__":
-    run_gui() 
+    import sys
+    sys.exit(main())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+事业部预算编号、单据编号、合同号、存货编码到文件与明细行的持久索引（SQLite）。
+
+两个提取器加 --index 运行时，每处理完一个文件即把结果写入索引；已索引且未变化
+（大小与修改时间相同）的文件不会重复写入，多次运行、多个文件夹的结果累积在同一个索引中。
+
+    python dlzb_index.py query WZ-FJ-202404-012
+    python dlzb_index.py query 1001 --field item
+    python dlzb_index.py query WZ-FJ-2024 --prefix --json
+    python dlzb_index.py stats
+    python dlzb_index.py prune
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from dlzb_runtime import excel_path
+
+# 索引数据库默认文件名（与输出文件放在同一目录）
+INDEX_FILENAME = "dlzb_index.sqlite"
+
+# 可查询的字段：命令行简称 -> 字段名
+INDEX_FIELDS = {
+    "budget": "事业部预算编号",
+    "doc": "单据编号",
+    "contract": "合同号",
+    "item": "存货编码",
+}
+
+# 字段在 files 表与 details 表中对应的列（不在表中的字段通过 path 关联另一张表查询）
+_FILE_COLUMNS = {"事业部预算编号": "budget_id", "单据编号": "doc_id", "合同号": "contract"}
+_DETAIL_COLUMNS = {"事业部预算编号": "budget_id", "单据编号": "doc_id", "存货编码": "item_code"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, name TEXT, budget_id TEXT, doc_id TEXT, contract TEXT, payload TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS details (
+    path TEXT NOT NULL, line INTEGER NOT NULL, budget_id TEXT, doc_id TEXT, item_code TEXT, payload TEXT,
+    PRIMARY KEY (path, line));
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (path, kind));
+CREATE INDEX IF NOT EXISTS files_budget ON files (budget_id);
+CREATE INDEX IF NOT EXISTS files_doc ON files (doc_id);
+CREATE INDEX IF NOT EXISTS files_contract ON files (contract);
+CREATE INDEX IF NOT EXISTS details_budget ON details (budget_id);
+CREATE INDEX IF NOT EXISTS details_doc ON details (doc_id);
+CREATE INDEX IF NOT EXISTS details_item ON details (item_code);
+"""
+
+
+def default_index_path(output_path):
+    """索引默认与输出文件放在同一目录：dlzb_index.sqlite"""
+    return Path(output_path).with_name(INDEX_FILENAME)
+
+
+def _key(value):
+    """把单元格值规范为索引键：去除首尾空白，整数形式的浮点数去掉".0"（Excel中的编码常被读成浮点数）"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _json_default(value):
+    """明细行中的日期等值以字符串形式保存"""
+    return str(value)
+
+
+class BudgetIndex:
+    """
+    文件与明细行的SQLite索引
+
+    Args:
+        db_path: 数据库文件路径，不存在时创建
+
+    写入在同一事务中进行，调用 commit()/close() 或退出 with 语句时提交。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _unchanged(self, path, kind, stat):
+        """文件自上次写入索引后是否未变化；stat为None时视为已变化"""
+        if stat is None:
+            return False
+        row = self.conn.execute("SELECT size, mtime_ns FROM sources WHERE path = ? AND kind = ?",
+                                (path, kind)).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns
+
+    def _mark(self, path, kind, stat):
+        if stat is not None:
+            self.conn.execute("INSERT OR REPLACE INTO sources (path, kind, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                              (path, kind, stat.st_size, stat.st_mtime_ns))
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return excel_path(path).stat()
+        except OSError:
+            return None
+
+    def add_file(self, path, data):
+        """
+        写入（或更新）一个文件的汇总信息
+
+        Args:
+            path: 文件路径
+            data: 汇总提取器的文件信息字典（文件名、事业部预算编号、合同号等）
+
+        Returns:
+            是否写入；文件未变化时跳过并返回False
+        """
+        path = str(excel_path(path).absolute())
+        stat = self._stat(path)
+        if self._unchanged(path, "summary", stat):
+            return False
+        fields = {key: value for key, value in data.items() if key != "文件路径" and not key.startswith("_")}
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (path, name, budget_id, doc_id, contract, payload, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, _key(data.get("文件名")), _key(data.get("事业部预算编号")), _key(data.get("单据编号")),
+             _key(data.get("合同号")), json.dumps(fields, ensure_ascii=False, default=_json_default), time.time()),
+        )
+        self._mark(path, "summary", stat)
+        return True
+
+    def add_details(self, path, rows):
+        """
+        写入（或替换）一个文件的明细行
+
+        Args:
+            path: 文件路径
+            rows: 明细提取器产出的明细行列表
+
+        Returns:
+            是否写入；文件未变化时跳过并返回False
+        """
+        path = str(excel_path(path).absolute())
+        stat = self._stat(path)
+        if self._unchanged(path, "details", stat):
+            return False
+        self.conn.execute("DELETE FROM details WHERE path = ?", (path,))
+        self.conn.executemany(
+            "INSERT INTO details (path, line, budget_id, doc_id, item_code, payload) VALUES (?, ?, ?, ?, ?, ?)",
+            [(path, line, _key(row.get("事业部预算编号")), _key(row.get("单据编号")), _key(row.get("存货编码")),
+              json.dumps({key: value for key, value in row.items() if key != "操作"}, ensure_ascii=False,
+                         default=_json_default))
+             for line, row in enumerate(rows, 1)],
+        )
+        if not self.conn.execute("SELECT 1 FROM files WHERE path = ?", (path,)).fetchone():
+            # 只运行过明细提取的文件也登记到 files 表，以便按明细字段查到文件
+            self.conn.execute("INSERT INTO files (path, name, budget_id, doc_id, payload, updated)"
+                              " VALUES (?, ?, ?, ?, ?, ?)",
+                              (path, excel_path(path).stem, _key(rows[0].get("事业部预算编号")) if rows else "",
+                               _key(rows[0].get("单据编号")) if rows else "", "{}", time.time()))
+        self._mark(path, "details", stat)
+        return True
+
+    def lookup(self, value, field=None, prefix=False, limit=None):
+        """
+        查询与某个编号相关的文件和明细行
+
+        Args:
+            value: 要查询的编号
+            field: 字段名（"事业部预算编号"、"单据编号"、"合同号"、"存货编码"，或其命令行简称），
+                None表示在所有字段中查询
+            prefix: 是否按前缀匹配
+            limit: 每类结果的最大条数，None表示不限
+
+        Returns:
+            {"files": [文件信息字典, ...], "details": [明细行字典, ...]}，字典中含"文件路径"
+
+        Raises:
+            ValueError: 字段名无效或编号为空
+        """
+        field = INDEX_FIELDS.get(field, field)
+        fields = [field] if field else list(INDEX_FIELDS.values())
+        if any(name not in INDEX_FIELDS.values() for name in fields):
+            raise ValueError(f"错误：无法按 {field} 查询，可用字段：{', '.join(INDEX_FIELDS.values())}！")
+        value = _key(value)
+        if not value:
+            raise ValueError("错误：查询的编号不能为空！")
+        # 前缀匹配改写为范围条件，仍可使用索引
+        params = (value, value + "\U0010ffff") if prefix else (value,)
+
+        def match(column):
+            return f"({column} >= ? AND {column} < ?)" if prefix else f"{column} = ?"
+
+        file_parts, detail_parts, file_params, detail_params = [], [], [], []
+        for name in fields:
+            if name in _FILE_COLUMNS:
+                file_parts.append(match(_FILE_COLUMNS[name]))
+            else:
+                file_parts.append(f"path IN (SELECT path FROM details WHERE {match(_DETAIL_COLUMNS[name])})")
+            file_params.extend(params)
+            # 明细行除自身的编号外，也按所属文件的编号匹配（明细表表头中的编号可能带有标签或为空）
+            if name in _DETAIL_COLUMNS and name in _FILE_COLUMNS:
+                detail_parts.append(f"({match(_DETAIL_COLUMNS[name])}"
+                                    f" OR path IN (SELECT path FROM files WHERE {match(_FILE_COLUMNS[name])}))")
+                detail_params.extend(params * 2)
+            elif name in _DETAIL_COLUMNS:
+                detail_parts.append(match(_DETAIL_COLUMNS[name]))
+                detail_params.extend(params)
+            else:
+                detail_parts.append(f"path IN (SELECT path FROM files WHERE {match(_FILE_COLUMNS[name])})")
+                detail_params.extend(params)
+        limit_sql = f" LIMIT {int(limit)}" if limit else ""
+
+        files = []
+        for path, payload in self.conn.execute(
+                f"SELECT path, payload FROM files WHERE {' OR '.join(file_parts)} ORDER BY path{limit_sql}",
+                file_params):
+            files.append({**json.loads(payload or "{}"), "文件路径": path})
+        details = []
+        for path, payload in self.conn.execute(
+                f"SELECT path, payload FROM details WHERE {' OR '.join(detail_parts)} ORDER BY path, line"
+                f"{limit_sql}", detail_params):
+            details.append({**json.loads(payload), "文件路径": path})
+        return {"files": files, "details": details}
+
+    def summary(self):
+        """索引中的文件数、明细行数与不同编号的数量"""
+        def one(sql):
+            return self.conn.execute(sql).fetchone()[0]
+
+        return {
+            "文件数": one("SELECT COUNT(*) FROM files"),
+            "明细行数": one("SELECT COUNT(*) FROM details"),
+            "事业部预算编号数": one("SELECT COUNT(DISTINCT budget_id) FROM files WHERE budget_id != ''"),
+            "单据编号数": one("SELECT COUNT(DISTINCT doc_id) FROM files WHERE doc_id != ''"),
+            "合同号数": one("SELECT COUNT(DISTINCT contract) FROM files WHERE contract != ''"),
+            "存货编码数": one("SELECT COUNT(DISTINCT item_code) FROM details WHERE item_code != ''"),
+        }
+
+    def prune(self):
+        """删除已不存在的文件的索引记录，返回删除的文件数"""
+        missing = [path for (path,) in self.conn.execute("SELECT path FROM files") if not excel_path(path).exists()]
+        for path in missing:
+            for table in ("files", "details", "sources"):
+                self.conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+        self.conn.commit()
+        return len(missing)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def main(argv=None):
+    """
+    命令行入口
+
+    Returns:
+        进程退出码：0成功，2参数错误或索引不存在
+    """
+    parser = argparse.ArgumentParser(description="预算编号、单据编号、合同号、存货编码索引查询")
+    parser.add_argument("--index", default=INDEX_FILENAME, help=f"索引数据库路径（默认：{INDEX_FILENAME}）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    query = sub.add_parser("query", help="查询与编号相关的文件和明细行")
+    query.add_argument("value", help="要查询的编号")
+    query.add_argument("--field", choices=list(INDEX_FIELDS), default=None,
+                       help="只在某个字段中查询：budget 事业部预算编号，doc 单据编号，contract 合同号，item 存货编码")
+    query.add_argument("--prefix", action="store_true", help="按前缀匹配")
+    query.add_argument("--limit", type=int, default=None, help="每类结果的最大条数")
+    query.add_argument("--json", action="store_true", help="以JSON输出")
+    sub.add_parser("stats", help="显示索引中的文件数、明细行数等")
+    sub.add_parser("prune", help="删除已不存在的文件的索引记录")
+    args = parser.parse_args(argv)
+
+    if not Path(args.index).exists():
+        print(f"错误：索引 {args.index} 不存在，请先以 --index 运行提取器！", file=sys.stderr)
+        return 2
+    with BudgetIndex(args.index) as index:
+        if args.command == "query" and not args.value.strip():
+            print("错误：查询的编号不能为空！", file=sys.stderr)
+            return 2
+        if args.command == "stats":
+            for name, count in index.summary().items():
+                print(f"{name}: {count}")
+        elif args.command == "prune":
+            print(f"已删除 {index.prune()} 个不存在的文件的索引记录")
+        else:
+            start = time.perf_counter()
+            result = index.lookup(args.value, args.field, args.prefix, args.limit)
+            elapsed = (time.perf_counter() - start) * 1000
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False, indent=2))
+                return 0
+            print(f"文件（{len(result['files'])}个）：")
+            for item in result["files"]:
+                print(f"  {item['文件路径']}  预算编号={item.get('事业部预算编号', '')}  "
+                      f"单据编号={item.get('单据编号', '')}  合同号={item.get('合同号', '')}")
+            print(f"明细行（{len(result['details'])}行）：")
+            for row in result["details"]:
+                print(f"  {row['文件路径']}  序号={row.get('序号', '')}  存货编码={row.get('存货编码', '')}  "
+                      f"{row.get('存货名称', '')}  数量={row.get('预算数量', '')}")
+            print(f"查询耗时 {elapsed:.1f} 毫秒")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+合并提取结果：分片运行的部分结果，或已有的汇总表/明细表输出文件。
+
+大批量文件可以按稳定哈希分成K个分片，在多个进程或多台机器上分别运行：
+
+    python dlzb_budget_file.py 预算文件夹 --shard 0/4 -o 汇总.xlsx    # 写出 汇总_分片0-4.dlzbpart
+    python dlzb_budget_file.py 预算文件夹 --shard 1/4 -o 汇总.xlsx
+    ...
+    python dlzb_merge.py partials 汇总_分片*.dlzbpart -o 汇总.xlsx
+
+明细表提取（dlzb_buget_file_details.py）用法相同。分片键为输入文件夹名加相对路径，
+不同机器上挂载路径不同也会得到相同的分片；合并时校验各分片的提取器、分片数与运行参数一致。
+
+各部门分别运行后得到的输出文件可以直接合并：
+
+    python dlzb_merge.py workbooks 部门A/预算文件列表.xlsx 部门B/预算文件列表.xlsx -o 合并.xlsx --dedupe budget
+
+输入以只读流式方式逐行读取，输出以只写方式逐行写出，内存占用与输入大小基本无关。
+"""
+
+import argparse
+import csv
+import sys
+import zipfile
+from pathlib import Path
+from xml.etree import ElementTree
+
+from dlzb_store import load_partials
+
+
+def merge_partials(partial_files, output_file, allow_missing=False, report_file=None, strategy_detail=False):
+    """
+    读取分片部分结果，按其提取器合并成最终的汇总表或明细表
+
+    Args:
+        partial_files: 部分结果文件路径列表
+        output_file: 输出文件路径，后缀为.csv时输出CSV
+        allow_missing: 是否允许缺少部分分片
+        report_file: JSON运行报告路径，传入True则使用"<输出文件名>_运行报告.json"，None或False不生成
+        strategy_detail: 汇总表是否额外输出"字段来源明细"工作表
+
+    Returns:
+        输出文件的Path对象
+
+    Raises:
+        ValueError: 分片文件无效、彼此不一致或缺少分片
+    """
+    partials = load_partials(partial_files, allow_missing=allow_missing)
+    output_path = Path(output_file)
+    if partials[0]["kind"] == "summary":
+        from dlzb_budget_file import merge_summary_partials
+        if output_path.suffix.lower() not in ('.xlsx', '.csv'):
+            output_path = output_path.with_suffix('.xlsx')
+        merge_summary_partials(partials, output_path, strategy_detail,
+                               report_file=None if report_file is True else (report_file or False))
+        return output_path
+    from dlzb_buget_file_details import merge_detail_partials
+    return merge_detail_partials(partials, output_path, report_file=report_file,
+                                 log_callback=lambda msg: print(msg, end=""))
+
+
+# 输出文件（.xlsx）中的关系与工作表XML命名空间
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# 去重方式：按文件路径、按事业部预算编号、不去重
+DEDUPE_MODES = ("path", "budget", "none")
+
+
+def _first_sheet_hyperlinks(path, column):
+    """
+    读取.xlsx第一个工作表中某一列的超链接目标 {行号: 目标}
+
+    openpyxl只读模式不解析超链接，而输出文件的"操作"列只以超链接保存文件路径，
+    这里直接增量解析工作表XML中的 <hyperlink> 元素及其关系文件。
+    """
+    from openpyxl.utils.cell import column_index_from_string, coordinate_from_string
+
+    with zipfile.ZipFile(path) as archive:
+        workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+        sheet_rid = workbook.find(f"{_NS_MAIN}sheets/{_NS_MAIN}sheet").get(f"{_NS_REL}id")
+        workbook_rels = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        target = next(rel.get("Target") for rel in workbook_rels if rel.get("Id") == sheet_rid)
+        sheet_path = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+        sheet_dir, sheet_name = sheet_path.rsplit("/", 1)
+        try:
+            sheet_rels = ElementTree.fromstring(archive.read(f"{sheet_dir}/_rels/{sheet_name}.rels"))
+        except KeyError:
+            return {}
+        targets = {rel.get("Id"): rel.get("Target") for rel in sheet_rels.iter(f"{_NS_PKG_REL}Relationship")}
+
+        links = {}
+        with archive.open(sheet_path) as f:
+            for _, element in ElementTree.iterparse(f):
+                if element.tag == f"{_NS_MAIN}hyperlink":
+                    letters, row = coordinate_from_string(element.get("ref").split(":")[0])
+                    if column_index_from_string(letters) == column:
+                        links[row] = targets.get(element.get(f"{_NS_REL}id"), element.get("location"))
+                elif element.tag == f"{_NS_MAIN}row":
+                    element.clear()
+        return links
+
+
+def iter_output_rows(path):
+    """
+    逐行读取一个输出文件（.xlsx或.csv）
+
+    Yields:
+        首先产出表头（"操作"列统一为"文件路径"），之后每行产出 (除文件路径外的值列表, 文件路径)
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            path_col = header.index("文件路径") if "文件路径" in header else None
+            yield header
+            for values in reader:
+                if not any(values):
+                    continue
+                file_path = values.pop(path_col) if path_col is not None and path_col < len(values) else ""
+                yield values, file_path
+        return
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = [str(value) if value is not None else "" for value in next(rows, ())]
+        while header and not header[-1]:
+            header.pop()
+        path_col = header.index("操作") if "操作" in header else None
+        links = _first_sheet_hyperlinks(path, path_col + 1) if path_col is not None else {}
+        yield ["文件路径" if name == "操作" else name for name in header]
+        for row_idx, values in enumerate(rows, 2):
+            values = list(values[:len(header)]) + [None] * (len(header) - len(values))
+            if all(value is None for value in values):
+                continue
+            values = ["" if value is None else value for value in values]
+            if path_col is not None:
+                values.pop(path_col)
+            yield values, links.get(row_idx, "")
+    finally:
+        wb.close()
+
+
+def _output_kind(header):
+    """由表头判断输出文件类型：返回 ("summary"/"details", 除文件路径外的列名列表)"""
+    from dlzb_buget_file_details import DETAIL_COLUMNS
+
+    columns = [name for name in header if name != "文件路径"]
+    if "文件路径" in header and columns in (DETAIL_COLUMNS[:-1], DETAIL_COLUMNS[:-1] + ["工作表"]):
+        return "details", columns
+    if "文件路径" in header and columns and columns[0] == "文件名":
+        return "summary", columns
+    raise ValueError(f"错误：无法识别的表头 {header}，只能合并汇总表或明细表输出文件！")
+
+
+def merge_workbooks(input_files, output_file, dedupe="path", progress_callback=None):
+    """
+    合并多个汇总表或明细表输出文件（.xlsx或.csv），逐行流式读写
+
+    Args:
+        input_files: 输入文件路径列表，须为同一种输出（同为汇总表且字段相同，或同为明细表）
+        output_file: 输出文件路径，后缀为.csv时输出CSV，否则输出.xlsx
+        dedupe: 去重方式：
+            "path" 按文件路径去重，"budget" 按事业部预算编号去重，"none" 不去重；
+            同一个键只保留第一个包含它的输入文件中的行（明细表中同一文件的多行作为整体保留或跳过）
+        progress_callback: 进度回调函数，每读完一个输入文件调用一次，参数为百分比
+
+    Returns:
+        重新计算的统计数据字典
+
+    Raises:
+        ValueError: 输入文件类型不一致、无法识别，或去重方式不适用
+    """
+    if dedupe not in DEDUPE_MODES:
+        raise ValueError(f"错误：去重方式应为 {', '.join(DEDUPE_MODES)} 之一！")
+    output_path = Path(output_file)
+    if output_path.suffix.lower() not in ('.xlsx', '.csv'):
+        output_path = output_path.with_suffix('.xlsx')
+
+    if not input_files:
+        raise ValueError("错误：没有指定输入文件！")
+
+    # 开始写出之前检查所有输入的表头，输入不能合并时不留下输出文件
+    kind = columns = None
+    for input_file in input_files:
+        rows = iter_output_rows(input_file)
+        try:
+            input_kind, input_columns = _output_kind(next(rows))
+        finally:
+            rows.close()
+        if kind is None:
+            kind, columns = input_kind, input_columns
+        elif (input_kind, input_columns) != (kind, columns):
+            raise ValueError(f"错误：{input_file} 与 {input_files[0]} 不是同一种输出文件，不能合并！")
+    if dedupe == "budget" and "事业部预算编号" not in columns:
+        raise ValueError("错误：输入文件不含事业部预算编号，不能按预算编号去重！")
+    key_col = columns.index("事业部预算编号") if dedupe == "budget" else None
+    budget_col = columns.index("事业部预算编号") if kind == "summary" and "事业部预算编号" in columns else None
+    if budget_col is not None:
+        from dlzb_budget_file import budget_matches_filename
+
+    owners = {}
+    file_paths = set()
+    stats = {"inputs": [], "rows": 0, "skipped_rows": 0}
+    missing = {field: 0 for field in columns[1:]} if kind == "summary" else {}
+    matched = unmatched = 0
+    with _OutputWriter(output_path) as writer:
+        writer.start(kind, columns)
+        for input_idx, input_file in enumerate(input_files):
+            rows = iter_output_rows(input_file)
+            next(rows)
+
+            read = kept = 0
+            for values, file_path in rows:
+                read += 1
+                key = None if dedupe == "none" else (file_path if dedupe == "path" else values[key_col])
+                if key:
+                    owner = owners.setdefault(key, input_idx)
+                    if owner != input_idx:
+                        continue
+                kept += 1
+                writer.write(values, file_path)
+                file_paths.add(file_path)
+                if kind == "summary":
+                    for field, value in zip(columns[1:], values[1:]):
+                        if value == "":
+                            missing[field] += 1
+                    if budget_col is not None and values[budget_col] != "":
+                        if budget_matches_filename(values[budget_col], str(values[0])):
+                            matched += 1
+                        else:
+                            unmatched += 1
+            stats["inputs"].append((str(input_file), read, kept))
+            stats["rows"] += kept
+            stats["skipped_rows"] += read - kept
+            if progress_callback:
+                progress_callback((input_idx + 1) / len(input_files) * 100)
+
+        stats.update(kind=kind, output=str(output_path.absolute()), dedupe=dedupe,
+                     total_files=len(file_paths - {""}) if kind == "details" else stats["rows"])
+        if budget_col is not None:
+            stats.update(matched_budgets=matched, unmatched_budgets=unmatched)
+        if missing:
+            stats["missing_data"] = missing
+        writer.write_stats(stats)
+    return stats
+
+
+class _OutputWriter:
+    """合并结果的流式写出：.xlsx使用openpyxl只写模式，.csv直接逐行写出"""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.csv = output_path.suffix.lower() == ".csv"
+        self._file = self._writer = self._wb = self._ws = None
+
+    def __enter__(self):
+        return self
+
+    def start(self, kind, columns):
+        """写出表头：汇总表的"操作"列在末尾，明细表与提取器输出一致"""
+        header = columns + ["文件路径" if self.csv else "操作"]
+        if self.csv:
+            self._file = open(self.output_path, "w", newline="", encoding="utf-8-sig")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(header)
+            return
+        import openpyxl
+        from openpyxl.utils import get_column_letter
+
+        self._wb = openpyxl.Workbook(write_only=True)
+        self._ws = self._wb.create_sheet("Sheet1")
+        for col, name in enumerate(header, 1):
+            self._ws.column_dimensions[get_column_letter(col)].width = max(len(name) * 2.4 + 4, 14)
+        self._ws.freeze_panes = "A2"
+        self._ws.append(header)
+
+    def write(self, values, file_path):
+        if self.csv:
+            self._writer.writerow(list(values) + [file_path])
+            return
+        from openpyxl.cell import WriteOnlyCell
+
+        link = WriteOnlyCell(self._ws, value="打开文件" if file_path else "")
+        if file_path:
+            link.hyperlink = file_path
+            link.style = "Hyperlink"
+        self._ws.append(list(values) + [link])
+
+    def write_stats(self, stats):
+        """写出"统计信息"工作表（CSV输出不含统计信息）"""
+        if self.csv:
+            return
+        ws = self._wb.create_sheet("统计信息")
+        ws.column_dimensions["A"].width = 40
+        ws.column_dimensions["B"].width = 15
+        ws.column_dimensions["C"].width = 15
+        ws.append(["总文件数", stats["total_files"]])
+        if stats["kind"] == "details":
+            ws.append(["明细行数", stats["rows"]])
+        if "matched_budgets" in stats:
+            ws.append(["预算编号匹配文件数", stats["matched_budgets"]])
+            ws.append(["预算编号不匹配文件数", stats["unmatched_budgets"]])
+        for field, count in stats.get("missing_data", {}).items():
+            ws.append([f"缺失{field}的文件数", count])
+        ws.append([])
+        ws.append(["合并的输入文件数", len(stats["inputs"])])
+        ws.append(["去重方式", {"path": "按文件路径", "budget": "按事业部预算编号", "none": "不去重"}[stats["dedupe"]]])
+        ws.append(["重复而跳过的行数", stats["skipped_rows"]])
+        ws.append([])
+        ws.append(["输入文件", "读取行数", "保留行数"])
+        for name, read, kept in stats["inputs"]:
+            ws.append([name, read, kept])
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._file is not None:
+            self._file.close()
+            # 合并中途出错时不留下不完整的CSV
+            if exc_type is not None:
+                self.output_path.unlink(missing_ok=True)
+        if self._wb is not None and exc_type is None:
+            self._wb.save(self.output_path)
+        return False
+
+
+def main(argv=None):
+    """
+    命令行入口
+
+    Returns:
+        进程退出码：0成功，1合并失败，2参数或分片文件错误
+    """
+    parser = argparse.ArgumentParser(description="合并预算文件提取工具的分片结果")
+    sub = parser.add_subparsers(dest="command", required=True)
+    partials = sub.add_parser("partials", help="把各分片的部分结果合并成最终的汇总表或明细表")
+    partials.add_argument("files", nargs="+", help="分片部分结果文件（.dlzbpart）")
+    partials.add_argument("-o", "--output", required=True, help="输出文件路径，后缀为.csv时输出CSV")
+    partials.add_argument("--allow-missing", action="store_true", help="允许缺少部分分片，输出不完整的结果")
+    partials.add_argument("--report", nargs="?", const=True, default=None,
+                          help="生成JSON运行报告，可指定路径（默认与输出文件同名）")
+    partials.add_argument("--strategy-detail", action="store_true", help="汇总表额外输出每个文件各字段的提取来源")
+    workbooks = sub.add_parser("workbooks", help="合并多个已有的汇总表或明细表输出文件（.xlsx或.csv）")
+    workbooks.add_argument("files", nargs="+", help="输入文件，须为同一种输出")
+    workbooks.add_argument("-o", "--output", required=True, help="输出文件路径，后缀为.csv时输出CSV")
+    workbooks.add_argument("--dedupe", choices=DEDUPE_MODES, default="path",
+                           help="去重方式：按文件路径（默认）、按事业部预算编号或不去重；同一键保留最先出现的输入文件中的行")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "workbooks":
+            stats = merge_workbooks(args.files, Path(args.output).absolute(), args.dedupe)
+            print(f"已合并 {len(stats['inputs'])} 个文件，保留 {stats['rows']} 行，"
+                  f"跳过重复 {stats['skipped_rows']} 行，保存到：{stats['output']}")
+        else:
+            merge_partials(args.files, Path(args.output).absolute(), args.allow_missing, args.report,
+                           args.strategy_detail)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    except Exception as e:
+        print(f"出错：{e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
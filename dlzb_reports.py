@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+"""
+基于提取结果的分析报告。
+
+核对报告：汇总提取器与明细提取器从不同位置读取事业部预算编号和单据编号，
+这里把两份结果按文件路径连接，列出编号不一致、明细表无明细行、表头无对应明细等异常：
+
+    python dlzb_reports.py reconcile --summary 文件名列表.csv --details 明细表汇总.csv -o 核对异常.xlsx
+    python dlzb_reports.py reconcile --index 输出目录/dlzb_index.sqlite -o 核对异常.xlsx
+
+输入可以是两个提取器的输出文件（.csv读取最快），也可以是 --index 运行后的编号索引。
+
+类型转换：convert_types 把日期列（Excel序列号、各种日期文本）与数量、价格列批量转换为
+日期和数值，无法转换的值保留原文并逐行报告；两个提取器以 --typed 运行时在写出前调用。
+
+明细汇总：明细提取器以 --aggregate 运行时，DetailAggregator 在明细行流过时按存货编码、
+部门、制单日期月份分组累加预算数量与金额，写成汇总工作表。
+
+变化报告：两个提取器以 --cache 和 --changes 运行时，compare_runs 把本次的结果与结果缓存中
+上次的结果按文件路径和明细行序号连接，列出新增、删除的文件以及修改的字段和明细行。
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# 核对异常表的列
+EXCEPTION_COLUMNS = ['文件名', '问题', '表头事业部预算编号', '明细事业部预算编号', '表头单据编号', '明细单据编号',
+                     '明细行数', '文件路径']
+
+# 汇总工作表名 -> 分组列
+AGGREGATE_SHEETS = {"按存货编码汇总": "存货编码", "按部门汇总": "部门", "按月份汇总": "月份"}
+
+# 部门或月份未知（没有对应的汇总提取结果或无法识别日期）时的分组名
+UNKNOWN = "未知"
+
+# 单元格中的标签前缀（如"单据编号：WZBD2024..."），比较或转换前去除；标签不含数字，避免误删时间中的冒号
+_LABEL_PREFIX = r'^[^\d：:]*[：:]\s*'
+
+# Excel（1900日期系统）序列号的起点，以及按日期解释的序列号范围（约1954~2119年），范围外的数字不当作日期
+_EXCEL_EPOCH = "1899-12-30"
+_SERIAL_RANGE = (20000, 80000)
+
+# 类型转换失败表的列
+CONVERSION_FAILURE_COLUMNS = ['行号', '字段', '原值']
+
+# 变化报告的列；变化为 新增文件、删除文件、字段修改（汇总）、新增明细、删除明细、明细修改（明细），
+# 多工作表提取时另有 新增工作表、删除工作表
+CHANGE_COLUMNS = ['变化', '事业部预算编号', '序号', '字段', '上次', '本次', '文件路径']
+
+
+def _clean_ids(series):
+    """编号列的向量化规范：转为字符串，去掉"单据编号："之类的标签前缀和首尾空白"""
+    return series.fillna("").astype(str).str.replace(_LABEL_PREFIX, "", regex=True).str.strip()
+
+
+def reconcile(summary, details, detail_files=None):
+    """
+    核对汇总表表头与明细表中的事业部预算编号和单据编号
+
+    Args:
+        summary: 汇总提取结果 DataFrame，含 文件路径、事业部预算编号、单据编号 列
+        details: 明细提取结果 DataFrame，每行一条明细，含 文件路径、事业部预算编号、单据编号 列
+        detail_files: 明细提取器处理过的全部文件路径（含没有明细行的文件），None表示未知；
+            已知时可以区分"明细表无明细行"与"表头无对应明细"
+
+    Returns:
+        异常 DataFrame（列见 EXCEPTION_COLUMNS），每个文件的每种问题一行，按文件路径排序
+    """
+    import pandas as pd
+
+    head = pd.DataFrame({
+        "文件路径": summary["文件路径"].astype(str),
+        "表头事业部预算编号": _clean_ids(summary["事业部预算编号"]),
+        "表头单据编号": _clean_ids(summary["单据编号"]),
+    }).drop_duplicates("文件路径")
+    lines = pd.DataFrame({
+        "文件路径": details["文件路径"].astype(str),
+        "明细事业部预算编号": _clean_ids(details["事业部预算编号"]),
+        "明细单据编号": _clean_ids(details["单据编号"]),
+    })
+
+    # 先按 (文件, 编号) 去重再分组，分组的行数与文件数同量级
+    pairs = lines.drop_duplicates()
+    per_file = pairs.groupby("文件路径", sort=False).agg(
+        明细事业部预算编号=("明细事业部预算编号", "first"),
+        明细单据编号=("明细单据编号", "first"),
+        编号组合数=("明细单据编号", "size"),
+    )
+    per_file["明细行数"] = lines.groupby("文件路径", sort=False).size()
+    merged = head.merge(per_file.reset_index(), on="文件路径", how="outer", indicator=True)
+
+    empty_files = None
+    if detail_files is not None:
+        empty_files = pd.Index(pd.Series(list(detail_files), dtype=str)).difference(per_file.index)
+        extra = pd.DataFrame({"文件路径": empty_files.difference(head["文件路径"])})
+        merged = pd.concat([merged, extra.assign(_merge="right_only", 明细行数=0)], ignore_index=True)
+    merged["明细行数"] = merged["明细行数"].fillna(0).astype(int)
+
+    both = merged["_merge"] == "both"
+    header_only = merged["_merge"] == "left_only"
+    no_lines = merged["文件路径"].isin(empty_files) if empty_files is not None else pd.Series(False, merged.index)
+    checks = [
+        (both & (merged["表头事业部预算编号"] != merged["明细事业部预算编号"]), "事业部预算编号不一致"),
+        (both & (merged["表头单据编号"] != merged["明细单据编号"]), "单据编号不一致"),
+        (merged["编号组合数"].fillna(0) > 1, "明细表内编号不一致"),
+        (no_lines, "明细表无明细行"),
+        (header_only & ~no_lines, "表头无对应明细"),
+        ((merged["_merge"] == "right_only") & ~no_lines, "明细无对应表头"),
+    ]
+    exceptions = pd.concat([merged[mask].assign(问题=label) for mask, label in checks], ignore_index=True)
+    exceptions["文件名"] = exceptions["文件路径"].str.extract(r'([^/\\]+?)(?:\.[^./\\]*)?$', expand=False)
+    return exceptions.sort_values(["文件路径", "问题"], kind="stable")[EXCEPTION_COLUMNS].fillna("") \
+        .reset_index(drop=True)
+
+
+def to_numbers(series):
+    """
+    数量、价格列的向量化数值转换
+
+    去掉千分位逗号、货币符号、"元"和空白后转换，无法识别的值为NaN。
+    """
+    import pandas as pd
+    from pandas.api.types import is_numeric_dtype
+
+    if is_numeric_dtype(series):
+        return series.astype(float)
+    text = series.astype(str).str.replace(r"[,，\s¥￥元]", "", regex=True)
+    return pd.to_numeric(text, errors="coerce")
+
+
+def to_dates(series):
+    """
+    日期列的向量化转换，无法识别的值为NaT
+
+    支持单元格中的日期、.xls经xlrd读出的Excel序列号（包括"45292.0"这样的文本）、
+    "2024-05-15""2024/5/15""2024年5月15日"等文本，以及带"制单日期："标签的文本。
+    """
+    import pandas as pd
+
+    values = series.astype(object)
+    text = values.where(values.notna(), "").astype(str).str.replace(_LABEL_PREFIX, "", regex=True).str.strip()
+    numbers = pd.to_numeric(text, errors="coerce")
+    serial = numbers.where((numbers >= _SERIAL_RANGE[0]) & (numbers <= _SERIAL_RANGE[1]))
+    dates = pd.to_datetime(serial, unit="D", origin=_EXCEL_EPOCH)
+    text = text.where(serial.isna() & numbers.isna(), "")
+    text = text.str.replace(r"[年月/.]", "-", regex=True).str.replace("日", "", regex=False)
+    return dates.fillna(pd.to_datetime(text, errors="coerce", format="mixed"))
+
+
+def convert_types(df, numeric_columns=(), date_columns=(), context_column=None):
+    """
+    批量把数值列和日期列转换为数值和日期（原地修改 df）
+
+    无法转换的非空值保留原文，并在返回的失败表中逐行列出。
+
+    Args:
+        df: 提取结果 DataFrame，行号按输出工作表计算（第1行为表头）
+        numeric_columns: 数值列名
+        date_columns: 日期列名，转换为 datetime.date
+        context_column: 失败表中附带的列（如文件名），便于定位
+
+    Returns:
+        失败表 DataFrame，列为 CONVERSION_FAILURE_COLUMNS（及 context_column）
+    """
+    import pandas as pd
+
+    failures = []
+    conversions = [(column, to_numbers) for column in numeric_columns] + \
+                  [(column, to_dates) for column in date_columns]
+    for column, convert in conversions:
+        if column not in df.columns:
+            continue
+        original = df[column]
+        converted = convert(original)
+        blank = original.isna() | original.astype(str).str.strip().isin(["", "None", "nan"])
+        missing = converted.isna()
+        failed = missing & ~blank
+        if failed.any():
+            failure = pd.DataFrame({"行号": df.index[failed] + 2, "字段": column,
+                                    "原值": original[failed].astype(str)})
+            if context_column:
+                failure[context_column] = df.loc[failed, context_column]
+            failures.append(failure)
+        if convert is to_dates:
+            converted = converted.dt.date
+        # 空值和无法转换的值保留原文
+        df[column] = converted.astype(object).where(~missing, original)
+    columns = CONVERSION_FAILURE_COLUMNS + ([context_column] if context_column else [])
+    if not failures:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(failures, ignore_index=True)[columns].sort_values(["行号", "字段"], kind="stable") \
+        .reset_index(drop=True)
+
+
+def write_failure_sheet(wb, failures, title="类型转换失败"):
+    """把 convert_types 返回的失败表写入openpyxl工作簿的新工作表"""
+    ws = wb.create_sheet(title=title)
+    ws.append(list(failures.columns))
+    for values in failures.itertuples(index=False):
+        ws.append([int(values[0])] + [str(value) for value in values[1:]])
+    for letter, width in zip("ABCD", (10, 14, 30, 60)):
+        ws.column_dimensions[letter].width = width
+    ws.freeze_panes = "A2"
+
+
+def failure_csv_path(output_path, title="类型转换失败"):
+    """CSV输出时失败表写成单独的CSV文件：<输出文件名>_类型转换失败.csv"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_{title}.csv")
+
+
+def _to_month(series):
+    """日期列的向量化月份提取（"YYYY-MM"），无法识别时为 UNKNOWN"""
+    return to_dates(series).dt.strftime("%Y-%m").fillna(UNKNOWN)
+
+
+def _text(value):
+    """分组键的文本形式：整数形式的浮点数去掉".0"（Excel中的编码常被读成浮点数）"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def load_header_table(source):
+    """
+    读取汇总提取结果中每个文件的部门和制单日期月份，供明细汇总按部门、月份分组
+
+    Args:
+        source: 汇总提取器的输出文件（.csv或.xlsx），或编号索引（.sqlite）
+
+    Returns:
+        {文件绝对路径: (部门, 月份)}
+    """
+    import pandas as pd
+
+    source = Path(source)
+    if source.suffix.lower() in (".sqlite", ".db"):
+        import json
+        import sqlite3
+
+        conn = sqlite3.connect(str(source))
+        try:
+            rows = [(path, json.loads(payload or "{}")) for path, payload in conn.execute(
+                "SELECT path, payload FROM files")]
+        finally:
+            conn.close()
+        table = pd.DataFrame({"文件路径": [path for path, _ in rows],
+                              "部门（显示值）": [item.get("部门（显示值）", "") for _, item in rows],
+                              "制单日期": [item.get("制单日期", "") for _, item in rows]})
+    else:
+        table = load_output_table(source, ["文件路径", "部门（显示值）", "制单日期"])
+    departments = table["部门（显示值）"].fillna("").astype(str).str.strip().replace("", UNKNOWN)
+    months = _to_month(table["制单日期"])
+    return dict(zip(table["文件路径"].astype(str), zip(departments, months)))
+
+
+class DetailAggregator:
+    """
+    明细行的流式分组汇总（按存货编码、部门、制单日期月份）
+
+    明细行先缓存，每满 batch_rows 行转换为带类型的DataFrame做一次分组求和，再与已有的汇总结果
+    合并压缩；内存占用与分组数（加一个批次）成正比，与明细总行数无关。
+
+    Args:
+        headers: {文件绝对路径: (部门, 月份)}，见 load_header_table；None表示部门和月份未知
+        batch_rows: 每批分组求和的行数
+    """
+
+    _SUMS = {"明细行数": "sum", "预算数量": "sum", "金额": "sum", "非数值行数": "sum"}
+
+    def __init__(self, headers=None, batch_rows=50000):
+        self.headers = headers or {}
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._buffer = {"存货编码": [], "存货名称": [], "预算数量": [], "目标价格": [], "部门": [], "月份": []}
+        self._totals = {}
+
+    def add(self, path, rows):
+        """累加一个文件的明细行"""
+        if not rows:
+            return
+        department, month = self.headers.get(str(Path(path).absolute()), (UNKNOWN, UNKNOWN))
+        buffer = self._buffer
+        for row in rows:
+            buffer["存货编码"].append(_text(row.get("存货编码")))
+            buffer["存货名称"].append(row.get("存货名称"))
+            buffer["预算数量"].append(row.get("预算数量"))
+            buffer["目标价格"].append(row.get("目标价格"))
+        buffer["部门"].extend([department] * len(rows))
+        buffer["月份"].extend([month] * len(rows))
+        self.rows += len(rows)
+        if len(buffer["存货编码"]) >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        import pandas as pd
+
+        if not self._buffer["存货编码"]:
+            return
+        df = pd.DataFrame(self._buffer)
+        for values in self._buffer.values():
+            values.clear()
+        quantity = to_numbers(df["预算数量"])
+        price = to_numbers(df["目标价格"])
+        df["预算数量"] = quantity
+        df["金额"] = quantity * price
+        df["明细行数"] = 1
+        df["非数值行数"] = (quantity.isna() | price.isna()).astype(int)
+        for sheet, key in AGGREGATE_SHEETS.items():
+            how = dict(self._SUMS, 存货名称="first") if key == "存货编码" else self._SUMS
+            part = df.groupby(key, sort=False).agg(how)
+            previous = self._totals.get(sheet)
+            self._totals[sheet] = part if previous is None else \
+                pd.concat([previous, part]).groupby(level=0, sort=False).agg(how)
+
+    def results(self):
+        """
+        Returns:
+            {工作表名: DataFrame}，每个分组一行，按分组键排序
+        """
+        self._flush()
+        results = {}
+        for sheet, key in AGGREGATE_SHEETS.items():
+            totals = self._totals.get(sheet)
+            if totals is None:
+                continue
+            totals = totals.sort_index().reset_index().round({"预算数量": 4, "金额": 2})
+            columns = [key] + (["存货名称"] if key == "存货编码" else []) + list(self._SUMS)
+            results[sheet] = totals[columns].rename(columns={
+                "预算数量": "预算数量合计", "金额": "金额合计（目标价格×预算数量）", "非数值行数": "数量或价格非数值的行数"})
+        return results
+
+
+def load_output_table(path, columns):
+    """
+    读取提取器输出文件中的若干列（"操作"超链接列读作"文件路径"）
+
+    Args:
+        path: 输出文件路径（.csv或.xlsx）
+        columns: 需要的列名列表
+
+    Returns:
+        DataFrame，值均为字符串
+    """
+    import pandas as pd
+
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        return pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    from dlzb_merge import iter_output_rows
+
+    rows = iter_output_rows(path)
+    header = [name for name in next(rows) if name != "文件路径"]
+    positions = [header.index(name) for name in columns if name != "文件路径"]
+    records = [[values[pos] for pos in positions] + [file_path] for values, file_path in rows]
+    return pd.DataFrame(records, columns=[name for name in columns if name != "文件路径"] + ["文件路径"],
+                        dtype=str)
+
+
+def load_index_tables(index_path):
+    """
+    从编号索引中读取核对所需的数据
+
+    Returns:
+        (汇总 DataFrame, 明细 DataFrame, 明细提取器处理过的文件路径列表)
+    """
+    import sqlite3
+    import pandas as pd
+
+    conn = sqlite3.connect(str(index_path))
+    try:
+        summary = pd.read_sql_query(
+            "SELECT f.path AS 文件路径, f.budget_id AS 事业部预算编号, f.doc_id AS 单据编号 FROM files f"
+            " JOIN sources s ON s.path = f.path AND s.kind = 'summary'", conn)
+        details = pd.read_sql_query(
+            "SELECT path AS 文件路径, budget_id AS 事业部预算编号, doc_id AS 单据编号 FROM details", conn)
+        detail_files = [path for (path,) in conn.execute("SELECT path FROM sources WHERE kind = 'details'")]
+    finally:
+        conn.close()
+    return summary, details, detail_files
+
+
+def write_exceptions(exceptions, output_path, sheet_name="核对异常"):
+    """把核对异常写入.xlsx（单个工作表）或.csv"""
+    output_path = Path(output_path)
+    if output_path.suffix.lower() == ".csv":
+        exceptions.to_csv(output_path, index=False, encoding="utf-8-sig")
+        return output_path
+    import pandas as pd
+    from openpyxl.utils import get_column_letter
+
+    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
+        exceptions.to_excel(writer, sheet_name=sheet_name, index=False)
+        ws = writer.sheets[sheet_name]
+        for col, name in enumerate(exceptions.columns, 1):
+            width = max([len(name)] + [len(str(value)) for value in exceptions[name].head(200)])
+            ws.column_dimensions[get_column_letter(col)].width = min(width * 1.2 + 4, 80)
+        ws.freeze_panes = "A2"
+    return output_path
+
+
+def _keyed(records, line_key):
+    """按 (工作表, line_key 字段值, 同键出现次数) 为键的记录字典"""
+    keyed = {}
+    seen = {}
+    for record in records:
+        key = (record.get('工作表', ''), _text(record.get(line_key)) if line_key else '')
+        seen[key] = seen.get(key, 0) + 1
+        keyed[key + (seen[key],)] = record
+    return keyed
+
+
+def compare_runs(previous, current, fields, line_key=None):
+    """
+    比较上次与本次运行的提取结果，列出新增、删除的文件和修改的字段或明细行
+
+    两次的结果按文件路径放在字典中连接；内容不同的文件再把文件内的记录按键放在字典中逐条连接，
+    耗时与记录总数成线性关系。
+
+    Args:
+        previous: 上次的结果 {文件路径: 记录列表}
+        current: 本次的结果 {文件路径: 记录列表}，值为None的文件（本次出错、跳过或取消未处理）不参与比较，
+            也不会被当作已删除
+        fields: 比较的字段，值按文本比较（整数形式的浮点数与整数相同）
+        line_key: 明细行的键字段（如"序号"），None表示每个文件（或每个工作表）只有一条记录
+
+    Returns:
+        变化记录列表，每条为字典，键见 CHANGE_COLUMNS；按本次的文件顺序排列，删除的文件在最后
+    """
+    changes = []
+    if line_key:
+        added, removed, modified = "新增明细", "删除明细", "明细修改"
+    else:
+        added, removed, modified = "新增工作表", "删除工作表", "字段修改"
+
+    def change(kind, path, record, field="", old="", new=""):
+        changes.append({"变化": kind, "事业部预算编号": _text(record.get('事业部预算编号')),
+                        "序号": _text(record.get(line_key)) if line_key else "", "字段": field,
+                        "上次": old, "本次": new, "文件路径": path})
+
+    for path, records in current.items():
+        if records is None:
+            continue
+        before = previous.get(path)
+        if before is None:
+            change("新增文件", path, records[0] if records else {})
+            continue
+        if before == records:
+            continue
+        keyed = _keyed(before, line_key)
+        for key, record in _keyed(records, line_key).items():
+            old = keyed.pop(key, None)
+            if old is None:
+                change(added, path, record)
+                continue
+            for field in fields:
+                old_value, new_value = _text(old.get(field)), _text(record.get(field))
+                if old_value != new_value:
+                    change(modified, path, record, field, old_value, new_value)
+        for record in keyed.values():
+            change(removed, path, record)
+    for path, records in previous.items():
+        if path not in current:
+            change("删除文件", path, records[0] if records else {})
+    return changes
+
+
+def change_counts(changes):
+    """变化报告中各类变化的条数，按 CHANGE_COLUMNS 说明中的顺序"""
+    counts = {}
+    for item in changes:
+        counts[item["变化"]] = counts.get(item["变化"], 0) + 1
+    order = ["新增文件", "删除文件", "字段修改", "新增工作表", "删除工作表", "新增明细", "删除明细", "明细修改"]
+    return {kind: counts[kind] for kind in order if kind in counts}
+
+
+def default_change_report_path(output_path):
+    """变化报告的默认路径："<输出文件名>_变化报告.xlsx"，与输出文件在同一目录"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_变化报告.xlsx")
+
+
+def write_change_report(changes, output_path):
+    """把变化记录写入.xlsx（"变化报告"工作表）或.csv，返回输出路径"""
+    import pandas as pd
+
+    return write_exceptions(pd.DataFrame(changes, columns=CHANGE_COLUMNS), output_path, sheet_name="变化报告")
+
+
+def _cmd_reconcile(args):
+    start = time.perf_counter()
+    if args.index:
+        summary, details, detail_files = load_index_tables(args.index)
+    else:
+        columns = ["文件路径", "事业部预算编号", "单据编号"]
+        summary = load_output_table(args.summary, columns)
+        details = load_output_table(args.details, columns)
+        detail_files = None
+    loaded = time.perf_counter()
+    exceptions = reconcile(summary, details, detail_files)
+    reconciled = time.perf_counter()
+    output_path = write_exceptions(exceptions, Path(args.output).absolute())
+    print(f"表头 {len(summary)} 个文件，明细 {len(details)} 行；发现 {len(exceptions)} 条异常")
+    for problem, count in exceptions["问题"].value_counts().items():
+        print(f"  {problem}: {count}")
+    print(f"读取 {loaded - start:.2f}秒，核对 {reconciled - loaded:.2f}秒；已保存到：{output_path}")
+    return 0
+
+
+def main(argv=None):
+    """
+    命令行入口
+
+    Returns:
+        进程退出码：0成功，1处理失败，2参数或输入文件错误
+    """
+    parser = argparse.ArgumentParser(description="预算文件提取结果分析报告")
+    sub = parser.add_subparsers(dest="command", required=True)
+    reconcile_parser = sub.add_parser("reconcile", help="核对汇总表表头与明细表中的编号")
+    source = reconcile_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--index", help="编号索引路径（两个提取器以 --index 运行后生成）")
+    source.add_argument("--summary", help="汇总提取器的输出文件（.csv或.xlsx），需同时指定 --details")
+    reconcile_parser.add_argument("--details", help="明细提取器的输出文件（.csv或.xlsx）")
+    reconcile_parser.add_argument("-o", "--output", default="核对异常.xlsx", help="输出文件（默认：核对异常.xlsx）")
+    args = parser.parse_args(argv)
+
+    if args.summary and not args.details:
+        parser.error("--summary 需要同时指定 --details")
+    for path in (args.index, args.summary, args.details):
+        if path and not Path(path).exists():
+            print(f"错误：文件 {path} 不存在！", file=sys.stderr)
+            return 2
+    try:
+        return {"reconcile": _cmd_reconcile}[args.command](args)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    except Exception as e:
+        print(f"出错：{e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
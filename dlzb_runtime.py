@@ -0,0 +1,1552 @@
+# -*- coding: utf-8 -*-
+"""
+预算文件提取工具的运行时支持：分阶段计时、提取策略统计、性能剖析、
+带超时与内存上限的隔离子进程池、运行报告、运行控制（暂停/取消/吞吐量）、图形界面事件通道、
+ZIP归档中Excel文件的读取等。
+供 dlzb_budget_file.py 与 dlzb_buget_file_details.py 共用。
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import struct
+import sys
+import threading
+import time
+import zipfile
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# 阶段名称及其在统计信息表中显示的中文名称（按流水线顺序）
+STAGE_LABELS = {
+    "discovery": "文件发现",
+    "cache_lookup": "读取缓存",
+    "snapshot_load": "读取快照",
+    "prefetch_wait": "等待预读",
+    "workbook_open": "打开工作簿",
+    "snapshot_capture": "保存快照",
+    "sheet_probe": "工作表探测",
+    "coordinate_lookup": "坐标定位",
+    "keyword_fallback": "关键字回退",
+    "regex_scan": "正则扫描",
+    "cleanup_validation": "清理与校验",
+    "detail_read": "读取明细",
+    "aggregate": "流式汇总",
+    "dataframe_build": "构建DataFrame",
+    "type_conversion": "类型转换",
+    "excel_write": "写入Excel",
+    "restyle": "格式优化",
+    "workbook_save": "保存工作簿",
+    "change_report": "变化比较",
+}
+
+# 文件级警告类别（见 EventStream.warning）及其在汇总计数中显示的中文名称
+WARNING_LABELS = {
+    "budget_mismatch": "预算编号与文件名不匹配",
+    "budget_from_filename": "预算编号取自文件名",
+    "read_error": "读取出错",
+    "file_error": "处理出错",
+    "truncated": "明细行被截断",
+}
+
+# 日志：每个文件的处理信息为 INFO（警告）或 DEBUG（验证通过等）级别，默认只输出 WARNING 及以上，
+# 运行结束时输出汇总计数；级别保存在环境变量中，子进程沿用
+LOG_LEVEL_ENV = "DLZB_LOG_LEVEL"
+
+
+class _PrintHandler(logging.Handler):
+    """按当前的 sys.stdout 输出，图形界面的输出重定向与 --events - 的改写随之生效"""
+
+    def emit(self, record):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def _init_logger():
+    logger = logging.getLogger("dlzb")
+    if not logger.handlers:
+        logger.addHandler(_PrintHandler())
+        logger.propagate = False
+    logger.setLevel(os.environ.get(LOG_LEVEL_ENV, "WARNING"))
+    return logger
+
+
+LOGGER = _init_logger()
+
+
+def set_log_level(level):
+    """
+    设置日志级别（logging.WARNING、logging.INFO 或 logging.DEBUG），之后启动的子进程沿用
+
+    Args:
+        level: 级别数值或名称
+    """
+    LOGGER.setLevel(level)
+    os.environ[LOG_LEVEL_ENV] = logging.getLevelName(LOGGER.level)
+
+
+def verbosity_level(verbose):
+    """命令行 -v 的次数对应的日志级别：0为WARNING，1为INFO（每个文件的警告），2及以上为DEBUG"""
+    return (logging.WARNING, logging.INFO)[verbose] if verbose < 2 else logging.DEBUG
+
+
+def format_warning_counts(warnings):
+    """
+    文件级警告的汇总计数文本
+
+    Args:
+        warnings: [(文件路径, 类别, 消息), ...]
+    """
+    counts = {}
+    for _, kind, _ in warnings:
+        counts[kind] = counts.get(kind, 0) + 1
+    return "，".join(f"{WARNING_LABELS.get(kind, kind)} {count}" for kind, count in counts.items())
+
+
+# 支持的Excel文件后缀
+EXCEL_SUFFIXES = ('.xls', '.xlsx')
+
+# 按文件夹处理的归档后缀，以及归档成员路径中归档与成员之间的分隔符（归档.zip!成员路径）
+ARCHIVE_SUFFIXES = ('.zip',)
+ARCHIVE_SEPARATOR = '!'
+_ARCHIVE_PATH = re.compile(r'^(.+?\.zip)!(.+)$', re.IGNORECASE)
+
+# 多工作表时判断其他工作表是否为预算单：前 FORM_PROBE_ROWS 行、FORM_PROBE_COLS 列中
+# 出现至少两个不同的表头标记（编号类字段须为"标签：值"的形式，以免把输出表的列名当成预算单）
+FORM_MARKERS = ('预算单', r'事业部预算编号\s*[：:]', r'单据编号\s*[：:]', r'合同号\s*[：:]', '制单日期', '存货编码')
+FORM_PROBE_ROWS = 10
+FORM_PROBE_COLS = 13
+_FORM_PATTERNS = [re.compile(marker) for marker in FORM_MARKERS]
+
+
+def is_budget_form(sheet, min_markers=2):
+    """
+    表头探测：只读取工作表左上角的少量单元格，判断它是否像一张预算单
+
+    Args:
+        sheet: openpyxl工作表（含只读模式）或xlrd工作表
+        min_markers: 至少出现的不同表头标记数
+
+    Returns:
+        是否为预算单
+    """
+    if hasattr(sheet, 'iter_rows'):
+        rows = sheet.iter_rows(max_row=FORM_PROBE_ROWS, max_col=FORM_PROBE_COLS, values_only=True)
+    else:
+        ncols = min(sheet.ncols, FORM_PROBE_COLS)
+        rows = (sheet.row_values(row, 0, ncols) for row in range(min(sheet.nrows, FORM_PROBE_ROWS)))
+    found = set()
+    for row in rows:
+        for value in row:
+            if isinstance(value, str):
+                found.update(pattern.pattern for pattern in _FORM_PATTERNS if pattern.search(value))
+        if len(found) >= min_markers:
+            return True
+    return False
+
+
+# 归档成员的文件状态：大小为解压后的大小，修改时间取归档文件的修改时间
+MemberStat = namedtuple("MemberStat", ["st_size", "st_mtime", "st_mtime_ns"])
+
+
+class _StoredMember(io.RawIOBase):
+    """归档中未压缩成员的只读视图：直接在归档文件内定位读取，不复制成员内容"""
+
+    def __init__(self, archive, start, size):
+        self._file = open(archive, "rb")
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self._size - self._pos))
+        if not count:
+            return 0
+        self._file.seek(self._start + self._pos)
+        data = self._file.read(count)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class ArchiveMember:
+    """
+    ZIP归档中的一个Excel文件，路径形式为"归档路径!成员路径"
+
+    提供提取流程用到的Path接口（name、stem、suffix、parent、absolute、stat等），
+    open() 得到可交给openpyxl读取的二进制文件对象，read_bytes() 得到交给xlrd的文件内容，不解压到磁盘。
+    """
+
+    __slots__ = ("archive", "member", "_info")
+
+    def __init__(self, archive, member, info=None):
+        self.archive = Path(archive)
+        self.member = member
+        self._info = info
+
+    def __str__(self):
+        return f"{self.archive}{ARCHIVE_SEPARATOR}{self.member}"
+
+    def __repr__(self):
+        return f"ArchiveMember({str(self)!r})"
+
+    def __eq__(self, other):
+        return (isinstance(other, ArchiveMember)
+                and (self.archive, self.member) == (other.archive, other.member))
+
+    def __hash__(self):
+        return hash((self.archive, self.member))
+
+    def __lt__(self, other):
+        return str(self) < str(other)
+
+    @property
+    def name(self):
+        return PurePosixPath(self.member).name
+
+    @property
+    def stem(self):
+        return PurePosixPath(self.member).stem
+
+    @property
+    def suffix(self):
+        return PurePosixPath(self.member).suffix
+
+    @property
+    def parent(self):
+        """归档所在的文件夹：归档按文件夹处理，其中的成员视为位于归档所在文件夹"""
+        return self.archive.parent
+
+    @property
+    def parents(self):
+        return (self.archive.parent,) + tuple(self.archive.parent.parents)
+
+    def absolute(self):
+        return ArchiveMember(self.archive.absolute(), self.member, self._info)
+
+    def resolve(self):
+        return ArchiveMember(self.archive.resolve(), self.member, self._info)
+
+    def exists(self):
+        try:
+            self.info()
+        except (OSError, zipfile.BadZipFile):
+            return False
+        return True
+
+    def is_file(self):
+        return self.exists()
+
+    def relative_to(self, folder):
+        """相对路径为归档的相对路径加成员路径（归档.zip!成员路径）"""
+        return PurePosixPath(f"{self.archive.relative_to(folder).as_posix()}{ARCHIVE_SEPARATOR}{self.member}")
+
+    def info(self):
+        """成员的ZipInfo（发现阶段已读取时不再打开归档）"""
+        if self._info is None:
+            with zipfile.ZipFile(self.archive) as zf:
+                try:
+                    self._info = zf.getinfo(self.member)
+                except KeyError:
+                    raise FileNotFoundError(f"归档 {self.archive} 中没有 {self.member}") from None
+        return self._info
+
+    def stat(self):
+        archive_stat = self.archive.stat()
+        return MemberStat(self.info().file_size, archive_stat.st_mtime, archive_stat.st_mtime_ns)
+
+    def open(self, mode="rb"):
+        """
+        以二进制只读方式打开成员
+
+        未压缩的成员（.xlsx本身已是压缩格式，归档时常直接存储）直接在归档文件内随机读取；
+        压缩的成员解压一次到内存，之后的随机读取不再重复解压。
+        """
+        if mode != "rb":
+            raise ValueError(f"错误：归档成员 {self} 只能以 rb 方式打开！")
+        info = self.info()
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            with open(self.archive, "rb") as f:
+                f.seek(info.header_offset)
+                header = f.read(30)
+            if header[:4] == b"PK\x03\x04":
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                start = info.header_offset + 30 + name_length + extra_length
+                return io.BufferedReader(_StoredMember(self.archive, start, info.file_size))
+        return io.BytesIO(self.read_bytes())
+
+    def read_bytes(self):
+        with zipfile.ZipFile(self.archive) as zf:
+            return zf.read(self.info())
+
+
+class PrefetchedFile:
+    """
+    已预读到内存的文件（见 Prefetcher）
+
+    路径接口（name、stem、absolute等）与原文件对象（Path 或 ArchiveMember）相同，
+    open()/read_bytes() 从内存中的内容读取，stat() 返回预读时的文件状态，不再访问文件。
+    """
+
+    __slots__ = ("file", "data", "_stat")
+
+    def __init__(self, file, data, stat):
+        self.file = file
+        self.data = data
+        self._stat = stat
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __str__(self):
+        return str(self.file)
+
+    def __repr__(self):
+        return f"PrefetchedFile({str(self.file)!r})"
+
+    def stat(self):
+        return self._stat
+
+    def open(self, mode="rb"):
+        if mode != "rb":
+            raise ValueError(f"错误：预读的文件 {self} 只能以 rb 方式打开！")
+        return io.BytesIO(self.data)
+
+    def read_bytes(self):
+        return self.data
+
+
+# 内容从归档或内存中读取、不能直接按路径打开的文件对象
+_MEMORY_FILES = (ArchiveMember, PrefetchedFile)
+
+
+def excel_path(path):
+    """由路径字符串得到文件对象：归档成员路径（归档.zip!成员路径）为 ArchiveMember，其余为 Path"""
+    if isinstance(path, (Path,) + _MEMORY_FILES):
+        return path
+    match = _ARCHIVE_PATH.match(str(path))
+    if match:
+        return ArchiveMember(match.group(1), match.group(2))
+    return Path(path)
+
+
+def link_target(path):
+    """输出表中"打开文件"超链接的目标：归档成员链接到所在的归档"""
+    file = excel_path(path)
+    return str(file.archive) if isinstance(file, ArchiveMember) else path
+
+
+@contextmanager
+def workbook_source(file):
+    """
+    openpyxl.load_workbook 可接受的来源：归档成员和预读的文件为打开的文件对象，其余原样返回
+
+    文件对象在 with 块结束时关闭；只读模式的工作簿读取时仍需要它，须在 with 块内读完并 close()。
+    """
+    if isinstance(file, _MEMORY_FILES):
+        with file.open() as source:
+            yield source
+    else:
+        yield file
+
+
+def open_binary(file):
+    """以二进制只读方式打开文件（归档成员和预读的文件从归档或内存中读取）"""
+    return file.open() if isinstance(file, _MEMORY_FILES) else open(file, "rb")
+
+
+def open_xls(file):
+    """用xlrd打开.xls文件，归档成员和预读的文件从内存中的文件内容打开"""
+    import xlrd
+    if isinstance(file, _MEMORY_FILES):
+        return xlrd.open_workbook(file_contents=file.read_bytes())
+    return xlrd.open_workbook(str(file))
+
+
+def archive_members(archive, unreadable=None):
+    """
+    列出ZIP归档中的Excel文件（只读取归档目录，不解压）
+
+    Args:
+        unreadable: 列表，无法读取的归档以 (归档路径, 原因) 追加到其中
+
+    Returns:
+        ArchiveMember列表，按成员在归档中的顺序；归档损坏时返回空列表
+    """
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            infos = zf.infolist()
+    except (OSError, zipfile.BadZipFile) as e:
+        LOGGER.warning("! 警告：无法读取归档 %s: %s", archive, e)
+        if unreadable is not None:
+            unreadable.append((archive, f"无法读取归档: {e}"))
+        return []
+    return [ArchiveMember(archive, info.filename, info) for info in infos
+            if not info.is_dir() and PurePosixPath(info.filename).suffix.lower() in EXCEL_SUFFIXES]
+
+
+def discover_excel_files(folders, recursive=False, archives=False, unreadable=None):
+    """
+    查找一个或多个文件夹中的Excel文件
+
+    Args:
+        folders: 文件夹路径，或多个文件夹路径组成的列表
+        recursive: 是否递归查找子文件夹
+        archives: 是否把ZIP归档当作文件夹，其中的Excel文件以 ArchiveMember（归档.zip!成员路径）返回
+        unreadable: 列表，无法读取的归档以 (归档路径, 原因) 追加到其中，由调用方计入跳过的文件
+
+    Returns:
+        Excel文件的Path（或ArchiveMember）列表，同一文件只出现一次
+    """
+    if isinstance(folders, (str, Path)):
+        folders = [folders]
+    seen = set()
+    excel_files = []
+    for folder in folders:
+        folder = Path(folder)
+        candidates = folder.rglob('*') if recursive else folder.iterdir()
+        for f in candidates:
+            suffix = f.suffix.lower()
+            if suffix in EXCEL_SUFFIXES and f.is_file():
+                members = [f]
+            elif archives and suffix in ARCHIVE_SUFFIXES and f.is_file():
+                members = archive_members(f, unreadable)
+            else:
+                continue
+            for member in members:
+                key = member.resolve()
+                if key not in seen:
+                    seen.add(key)
+                    excel_files.append(member)
+    return excel_files
+
+
+def shard_key(file, folders):
+    """
+    文件的分片键：所在输入文件夹的名称加文件在该文件夹中的相对路径（POSIX形式）
+
+    不含挂载位置，同一批文件在不同机器上（挂载路径不同）得到相同的键。
+    """
+    file = excel_path(file)
+    if isinstance(folders, (str, Path)):
+        folders = [folders]
+    for folder in folders:
+        folder = Path(folder)
+        try:
+            relative = file.relative_to(folder)
+        except ValueError:
+            continue
+        return f"{folder.absolute().name}/{relative.as_posix()}"
+    return file.name
+
+
+def shard_of(key, shard_count):
+    """按稳定哈希把分片键分配到 0 ~ shard_count-1 中的一个分片（不受进程哈希随机化影响）"""
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % shard_count
+
+
+def check_shard(shard):
+    """
+    校验分片参数 (序号, 分片数)
+
+    Raises:
+        ValueError: 分片数小于1或序号不在 0 ~ 分片数-1 之间
+    """
+    index, count = shard
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"错误：分片 {index}/{count} 无效，序号应在 0 ~ {count - 1} 之间！")
+    return index, count
+
+
+def parse_shard(text):
+    """解析命令行中的分片参数 "I/K"（第I个分片，共K个，I从0开始）"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"错误：分片参数 {text} 格式应为 I/K，例如 0/4！")
+    return check_shard((index, count))
+
+
+def select_shard(excel_files, folders, shard):
+    """
+    从已发现的文件中选出属于指定分片的文件
+
+    Args:
+        excel_files: discover_excel_files 返回的文件列表
+        folders: 输入文件夹
+        shard: (序号, 分片数)
+
+    Returns:
+        属于该分片的文件列表（保持原顺序）
+    """
+    index, count = check_shard(shard)
+    return [f for f in excel_files if shard_of(shard_key(f, folders), count) == index]
+
+
+def check_folders(folders):
+    """
+    检查文件夹是否都存在
+
+    Returns:
+        错误信息，全部存在时返回None
+    """
+    if isinstance(folders, (str, Path)):
+        folders = [folders]
+    for folder in folders:
+        folder = Path(folder)
+        if not folder.exists():
+            return f"错误：文件夹 {folder} 不存在！"
+        if not folder.is_dir():
+            return f"错误：{folder} 不是一个文件夹！"
+    return None
+
+
+class Prefetcher:
+    """
+    预读阶段：后台线程按处理顺序提前把后面的文件读入内存，使读取与当前文件的解析重叠
+
+    网络共享上打开工作簿的大部分时间在等待数据；预读线程等待I/O时释放GIL，解析不受影响。
+    最多预读 depth 个文件，已读入但尚未取走的内容合计不超过 max_memory_mb；
+    单个文件超过内存上限或读取失败时不预读，由解析时照常直接读取（错误也在那时照常报告）；
+    预读线程意外退出时，其余文件都改为由解析时直接读取。
+
+    用法：
+        with Prefetcher(files, depth=4) as prefetcher:
+            for _ in files:
+                file, waited = prefetcher.take()
+    """
+
+    def __init__(self, files, depth=4, max_memory_mb=256):
+        self.files = list(files)
+        self.depth = depth
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.waited = 0.0
+        self._ready = {}
+        self._taken = 0
+        self._buffered = 0
+        self._closed = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __enter__(self):
+        if self.depth > 0 and self.files:
+            self._thread = threading.Thread(target=self._run, name="dlzb-prefetch", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """停止预读并丢弃尚未取走的内容"""
+        with self._cond:
+            self._closed = True
+            self._ready.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        try:
+            self._prefetch()
+        finally:
+            # 线程因任何原因退出后，take() 不再等待尚未预读的文件
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    def _prefetch(self):
+        for position, file in enumerate(self.files):
+            try:
+                stat = file.stat()
+            except OSError:
+                stat = None
+            size = stat.st_size if stat is not None else 0
+            wanted = stat is not None and size <= self.max_bytes
+            with self._cond:
+                while not self._closed and (position - self._taken >= self.depth
+                                            or (wanted and self._buffered and self._buffered + size > self.max_bytes)):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                if wanted:
+                    self._buffered += size
+            item = file
+            if wanted:
+                try:
+                    item = PrefetchedFile(file, file.read_bytes(), stat)
+                except Exception:
+                    # 如ZIP成员的压缩数据损坏（zlib.error、BadZipFile），交给解析时照常读取并报告
+                    pass
+            with self._cond:
+                if wanted:
+                    self._buffered += (len(item.data) if item is not file else 0) - size
+                if self._closed:
+                    return
+                self._ready[position] = item
+                self._cond.notify_all()
+
+    def take(self):
+        """
+        按顺序取出下一个文件
+
+        Returns:
+            (文件, 等待秒数)：已预读的文件为 PrefetchedFile，其余为原文件对象
+        """
+        position = self._taken
+        file = self.files[position]
+        if self._thread is None:
+            self._taken += 1
+            return file, 0.0
+        start = time.perf_counter()
+        with self._cond:
+            while position not in self._ready and not self._closed and not self._stopped:
+                self._cond.wait()
+            item = self._ready.pop(position, file)
+            if item is not file:
+                self._buffered -= len(item.data)
+            self._taken += 1
+            self._cond.notify_all()
+        waited = time.perf_counter() - start
+        self.waited += waited
+        return item, waited
+
+
+class StageTimer:
+    """
+    按阶段累计耗时的轻量计时器
+
+    每个阶段只记录一次 perf_counter 差值，汇总时再计算总计、平均值和P95，
+    因此在逐文件的热路径中开销可以忽略。
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def stage(self, name):
+        """计时上下文：with timer.stage("regex_scan"): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """记录一次阶段耗时（秒）"""
+        self.samples.setdefault(name, []).append(seconds)
+
+    def merge(self, other):
+        """合并另一个计时器的样本（例如来自子进程的结果）"""
+        for name, values in other.samples.items():
+            self.samples.setdefault(name, []).extend(values)
+
+    def summary(self):
+        """
+        汇总各阶段耗时
+
+        Returns:
+            {阶段名: {"count", "total", "mean", "p95"}}，单位为秒，按流水线顺序排列
+        """
+        ordered = [name for name in STAGE_LABELS if name in self.samples]
+        ordered += [name for name in self.samples if name not in STAGE_LABELS]
+        result = {}
+        for name in ordered:
+            values = self.samples[name]
+            if not values:
+                continue
+            total = sum(values)
+            result[name] = {
+                "count": len(values),
+                "total": total,
+                "mean": total / len(values),
+                "p95": percentile(values, 95),
+            }
+        return result
+
+
+# 提取策略名称及其中文名称
+STRATEGY_LABELS = {
+    "coordinate": "固定坐标",
+    "column_scan": "列扫描",
+    "keyword": "关键字搜索",
+    "regex_scan": "正则扫描",
+    "filename": "文件名",
+}
+
+
+class StrategyStats:
+    """
+    按字段、按提取策略统计尝试次数、命中次数和累计耗时
+
+    同时记录当前文件各字段由哪种策略命中，调用方处理完一个文件后
+    通过 take_sources() 取走。
+    """
+
+    def __init__(self):
+        # (字段, 策略) -> [尝试次数, 命中次数, 累计耗时]
+        self.counters = {}
+        self.sources = {}
+
+    def record(self, field, strategy, hit, seconds):
+        """记录一次策略调用"""
+        counter = self.counters.get((field, strategy))
+        if counter is None:
+            counter = self.counters[(field, strategy)] = [0, 0, 0.0]
+        counter[0] += 1
+        counter[2] += seconds
+        if hit:
+            counter[1] += 1
+            self.sources[field] = strategy
+
+    def take_sources(self):
+        """取走并清空当前文件的字段来源 {字段: 策略}"""
+        sources, self.sources = self.sources, {}
+        return sources
+
+    def merge(self, other):
+        """合并另一份策略统计"""
+        for key, (attempts, hits, seconds) in other.counters.items():
+            counter = self.counters.setdefault(key, [0, 0, 0.0])
+            counter[0] += attempts
+            counter[1] += hits
+            counter[2] += seconds
+
+    def summary(self):
+        """
+        汇总策略统计
+
+        Returns:
+            [{"field", "strategy", "attempts", "hits", "seconds"}, ...]，按字段、策略顺序排列
+        """
+        # 字段按首次出现的顺序排列，同一字段内按策略的尝试顺序排列
+        field_order = {}
+        for field, _ in self.counters:
+            field_order.setdefault(field, len(field_order))
+        strategy_order = {name: idx for idx, name in enumerate(STRATEGY_LABELS)}
+        keys = sorted(self.counters, key=lambda k: (field_order[k[0]], strategy_order.get(k[1], len(strategy_order))))
+        return [
+            {
+                "field": field,
+                "strategy": strategy,
+                "attempts": self.counters[(field, strategy)][0],
+                "hits": self.counters[(field, strategy)][1],
+                "seconds": self.counters[(field, strategy)][2],
+            }
+            for field, strategy in keys
+        ]
+
+
+def percentile(values, pct):
+    """最近秩法计算百分位数，values 为空时返回0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))  # 向上取整
+    return ordered[int(rank) - 1]
+
+
+def write_stage_rows(ws, start_row, timer, title="阶段耗时统计"):
+    """
+    将阶段耗时汇总写入统计信息工作表
+
+    Args:
+        ws: openpyxl工作表
+        start_row: 起始行号
+        timer: StageTimer对象
+        title: 小节标题
+
+    Returns:
+        写入后的下一个空行行号
+    """
+    from openpyxl.styles import Font
+
+    ws.cell(row=start_row, column=1, value=title).font = Font(bold=True)
+    header_row = start_row + 1
+    for col, header in enumerate(["阶段", "次数", "总耗时(秒)", "平均(毫秒)", "P95(毫秒)"], 1):
+        ws.cell(row=header_row, column=col, value=header).font = Font(bold=True)
+
+    row = header_row + 1
+    for name, item in timer.summary().items():
+        ws.cell(row=row, column=1, value=STAGE_LABELS.get(name, name))
+        ws.cell(row=row, column=2, value=item["count"])
+        ws.cell(row=row, column=3, value=round(item["total"], 3))
+        ws.cell(row=row, column=4, value=round(item["mean"] * 1000, 2))
+        ws.cell(row=row, column=5, value=round(item["p95"] * 1000, 2))
+        row += 1
+    return row
+
+
+def write_strategy_sheet(wb, strategies, title="提取策略统计"):
+    """
+    将提取策略统计写入新的工作表
+
+    Args:
+        wb: openpyxl工作簿
+        strategies: StrategyStats对象
+        title: 工作表名称
+
+    Returns:
+        新建的工作表
+    """
+    from openpyxl.styles import Font
+
+    ws = wb.create_sheet(title=title)
+    headers = ["字段", "提取策略", "尝试次数", "命中次数", "命中率", "累计耗时(秒)", "平均耗时(毫秒)"]
+    for col, header in enumerate(headers, 1):
+        ws.cell(row=1, column=col, value=header).font = Font(bold=True)
+
+    for row, item in enumerate(strategies.summary(), 2):
+        attempts = item["attempts"]
+        ws.cell(row=row, column=1, value=item["field"])
+        ws.cell(row=row, column=2, value=STRATEGY_LABELS.get(item["strategy"], item["strategy"]))
+        ws.cell(row=row, column=3, value=attempts)
+        ws.cell(row=row, column=4, value=item["hits"])
+        ws.cell(row=row, column=5, value=f"{item['hits'] / attempts:.1%}" if attempts else "")
+        ws.cell(row=row, column=6, value=round(item["seconds"], 4))
+        ws.cell(row=row, column=7, value=round(item["seconds"] / attempts * 1000, 2) if attempts else 0)
+
+    ws.column_dimensions['A'].width = 18
+    ws.column_dimensions['B'].width = 12
+    for col_letter in ('C', 'D', 'E', 'F', 'G'):
+        ws.column_dimensions[col_letter].width = 14
+    ws.freeze_panes = "A2"
+    return ws
+
+
+def default_report_path(output_path):
+    """运行报告默认与输出文件放在一起：<输出文件名>_运行报告.json"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_运行报告.json")
+
+
+def write_run_report(report_path, timer, **fields):
+    """
+    写入机器可读的JSON运行报告
+
+    Args:
+        report_path: 报告文件路径
+        timer: StageTimer对象，其汇总写入 "stages" 字段
+        **fields: 其他需要写入报告的字段（统计数据、耗时等）
+
+    Returns:
+        报告文件的Path对象
+    """
+    report = {"generated_at": datetime.now().isoformat(timespec="seconds")}
+    report.update(fields)
+    report["stages"] = timer.summary()
+    report_path = Path(report_path)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    return report_path
+
+
+def default_profile_path(output_path):
+    """性能剖析文件默认与输出文件放在一起：<输出文件名>_profile.prof"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_profile.prof")
+
+
+class RunProfiler:
+    """
+    用 cProfile 包裹一次完整运行，输出 pstats 文件、累计耗时 Top-N 摘要和最慢文件列表
+
+    用法：
+        with RunProfiler("run.prof", top_n=20) as profiler:
+            ...
+        profiler.save(file_times)
+
+    进程池中的子进程通过 profile_worker_call 把各自的剖析数据写入
+    worker_dir，save() 时会自动合并。
+    """
+
+    def __init__(self, profile_path, top_n=20):
+        self.profile_path = Path(profile_path)
+        self.top_n = top_n
+        self.worker_dir = self.profile_path.with_name(f"{self.profile_path.stem}_workers")
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        global _active_profiler
+        # 清理上一次运行遗留的子进程剖析数据
+        if self.worker_dir.is_dir():
+            for dump in self.worker_dir.glob("worker-*.prof"):
+                dump.unlink()
+        _active_profiler = self
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active_profiler
+        self.profile.disable()
+        _active_profiler = None
+        return False
+
+    def save(self, file_times=()):
+        """
+        写出剖析结果
+
+        Args:
+            file_times: [(文件名, 耗时秒, 文件大小字节), ...]
+
+        Returns:
+            (pstats文件路径, 摘要文本文件路径)
+        """
+        import pstats
+        merged = pstats.Stats(self.profile)
+        if self.worker_dir.is_dir():
+            for dump in sorted(self.worker_dir.glob("worker-*.prof")):
+                try:
+                    merged.add(str(dump))
+                except Exception as e:
+                    print(f"合并子进程剖析数据 {dump.name} 时出错: {e}")
+        merged.dump_stats(str(self.profile_path))
+
+        stream = io.StringIO()
+        stream.write(f"累计耗时前{self.top_n}的函数\n")
+        stream.write("=" * 60 + "\n")
+        pstats.Stats(str(self.profile_path), stream=stream).sort_stats("cumulative").print_stats(self.top_n)
+
+        slowest = sorted(file_times, key=lambda item: item[1], reverse=True)[:self.top_n]
+        stream.write(f"\n最慢的{len(slowest)}个文件\n")
+        stream.write("=" * 60 + "\n")
+        stream.write(f"{'耗时(秒)':>10}  {'大小(KB)':>10}  文件\n")
+        for name, seconds, size in slowest:
+            stream.write(f"{seconds:>10.3f}  {size / 1024:>10.1f}  {name}\n")
+
+        summary_path = self.profile_path.with_suffix(".txt")
+        summary_path.write_text(stream.getvalue(), encoding="utf-8")
+        print(f"性能剖析数据：{self.profile_path.absolute()}")
+        print(f"剖析摘要：{summary_path.absolute()}")
+        return self.profile_path, summary_path
+
+
+# 当前正在运行的RunProfiler，IsolatedPool据此决定是否在子进程中剖析
+_active_profiler = None
+
+# 子进程内的剖析器，每个进程一个，跨任务累计
+_worker_profile = None
+
+
+def profile_worker_call(worker_dir, func, *args, **kwargs):
+    """
+    在子进程中以剖析模式调用 func
+
+    每个进程维护一个累计的 cProfile.Profile，每次调用结束后覆盖写入
+    worker_dir/worker-<pid>.prof，父进程在 RunProfiler.save() 中合并。
+    """
+    global _worker_profile
+    if _worker_profile is None:
+        import cProfile
+        _worker_profile = cProfile.Profile()
+    _worker_profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _worker_profile.disable()
+        worker_dir = Path(worker_dir)
+        worker_dir.mkdir(parents=True, exist_ok=True)
+        _worker_profile.dump_stats(str(worker_dir / f"worker-{os.getpid()}.prof"))
+
+
+def process_rss_mb(pid):
+    """
+    获取进程常驻内存（MB）
+
+    优先使用psutil，未安装时在Linux上读取/proc，其他平台返回None。
+    """
+    try:
+        if psutil is not None:
+            return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        return None
+
+
+def _isolated_worker(conn, func):
+    """子进程主循环：逐个接收任务并返回 (序号, 状态, 结果)"""
+    # fork方式启动时会继承GUI的输出重定向，子进程中恢复为原始标准输出
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        index, args = message
+        try:
+            conn.send((index, "ok", func(*args)))
+        except Exception as e:
+            conn.send((index, "error", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+class IsolatedPool:
+    """
+    长驻子进程池，为每个任务提供墙钟超时和内存上限
+
+    与 ProcessPoolExecutor 不同，超时或内存超限的子进程会被直接终止并重新拉起，
+    其余任务不受影响。run() 逐个产出 (序号, 状态, 结果)，状态为：
+        "ok"      - 正常完成，结果为 func 的返回值
+        "error"   - func 抛出异常，结果为错误描述
+        "timeout" - 超过 timeout 秒，结果为原因描述
+        "memory"  - 子进程常驻内存超过 max_memory_mb，结果为原因描述
+        "crashed" - 子进程异常退出，结果为原因描述
+    结果按完成顺序产出，调用方根据序号还原原始顺序。
+
+    run() 结束后 worker_stats 为每个子进程的任务数、忙碌时间与利用率（忙碌时间 / 运行墙钟时间），
+    parallel_efficiency 为所有子进程的平均利用率。
+    """
+
+    # 轮询间隔（秒），决定超时与内存检查的精度
+    poll_interval = 0.1
+
+    def __init__(self, func, workers=None, timeout=None, max_memory_mb=None):
+        self.func = func
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.timeout = timeout
+        self.max_memory_mb = max_memory_mb
+        import multiprocessing
+        self._ctx = multiprocessing.get_context()
+        self._slots = []
+        self._rss_warned = False
+        self.worker_stats = []
+        self.parallel_efficiency = None
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        func = self.func
+        if _active_profiler is not None:
+            func = _ProfiledCall(str(_active_profiler.worker_dir), func)
+        process = self._ctx.Process(target=_isolated_worker, args=(child_conn, func), daemon=True)
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "task": None, "started": 0.0}
+
+    def _kill(self, slot):
+        slot["process"].kill()
+        slot["process"].join()
+        slot["conn"].close()
+
+    def run(self, tasks, control=None):
+        """
+        执行任务
+
+        Args:
+            tasks: 可迭代对象，每一项是传给 func 的参数元组
+            control: RunControl，暂停时不再分配新任务，取消时终止正在处理的任务并结束
+
+        Yields:
+            (序号, 状态, 结果)
+        """
+        from multiprocessing.connection import wait
+        pending = deque(enumerate(tasks))
+        run_start = time.perf_counter()
+        self._slots = [dict(self._spawn(), busy=0.0, tasks=0) for _ in range(min(self.workers, len(pending)))]
+        try:
+            while pending or any(slot["task"] is not None for slot in self._slots):
+                if control is not None and control.cancelled:
+                    break
+                # 给空闲子进程分配任务
+                for slot in self._slots:
+                    if slot["task"] is None and pending and not (control is not None and control.paused):
+                        slot["task"] = pending.popleft()
+                        slot["started"] = time.perf_counter()
+                        slot["conn"].send(slot["task"])
+
+                busy = {slot["conn"]: slot for slot in self._slots if slot["task"] is not None}
+                if not busy:
+                    # 暂停中且没有正在处理的任务
+                    time.sleep(self.poll_interval)
+                    continue
+                for conn in wait(list(busy), timeout=self.poll_interval):
+                    slot = busy[conn]
+                    self._finish(slot)
+                    try:
+                        index, status, value = conn.recv()
+                    except (EOFError, OSError):
+                        index = slot["task"][0]
+                        # 先等子进程退出，才能取得退出码；kill已退出的进程不会改变退出码
+                        process = slot["process"]
+                        process.join(timeout=1)
+                        self._replace(slot)
+                        status, value = "crashed", f"子进程异常退出（退出码 {process.exitcode}）"
+                    slot["task"] = None
+                    yield index, status, value
+
+                # 检查超时和内存上限
+                now = time.perf_counter()
+                for slot in self._slots:
+                    if slot["task"] is None:
+                        continue
+                    reason = None
+                    if self.timeout and now - slot["started"] > self.timeout:
+                        status, reason = "timeout", f"处理超过{self.timeout}秒"
+                    elif self.max_memory_mb:
+                        rss = process_rss_mb(slot["process"].pid)
+                        if rss is None and not self._rss_warned:
+                            print("警告：无法获取子进程内存占用（可安装psutil），内存上限不生效")
+                            self._rss_warned = True
+                        elif rss is not None and rss > self.max_memory_mb:
+                            status, reason = "memory", f"内存占用{rss:.0f}MB超过上限{self.max_memory_mb}MB"
+                    if reason:
+                        index = slot["task"][0]
+                        self._finish(slot)
+                        self._replace(slot)
+                        yield index, status, reason
+        finally:
+            self._record_utilization(time.perf_counter() - run_start)
+            self.close()
+
+    def _finish(self, slot):
+        """子进程完成（或被终止）当前任务时累计其忙碌时间"""
+        slot["busy"] += time.perf_counter() - slot["started"]
+        slot["tasks"] += 1
+
+    def _record_utilization(self, wall_seconds):
+        self.worker_stats = [
+            {"worker": number, "tasks": slot["tasks"], "busy_seconds": round(slot["busy"], 3),
+             "utilization": round(slot["busy"] / wall_seconds, 4) if wall_seconds > 0 else 0.0}
+            for number, slot in enumerate(self._slots, 1)
+        ]
+        if self.worker_stats:
+            self.parallel_efficiency = round(
+                sum(item["utilization"] for item in self.worker_stats) / len(self.worker_stats), 4)
+
+    def _replace(self, slot):
+        """终止子进程并在原位置拉起新的子进程"""
+        self._kill(slot)
+        slot.update(self._spawn())
+
+    def close(self):
+        """通知并回收所有子进程"""
+        for slot in self._slots:
+            try:
+                if slot["task"] is None:
+                    slot["conn"].send(None)
+                    slot["process"].join(timeout=1)
+            except (OSError, ValueError):
+                pass
+            if slot["process"].is_alive():
+                slot["process"].kill()
+                slot["process"].join()
+            slot["conn"].close()
+        self._slots = []
+
+
+def format_utilization(worker_stats, efficiency):
+    """子进程利用率的文字说明（每个子进程一行），供控制台和日志输出"""
+    lines = [f"子进程利用率（并行效率 {efficiency:.1%}）："]
+    for item in worker_stats:
+        lines.append(f"  子进程{item['worker']}: {item['tasks']} 个文件，忙碌 {item['busy_seconds']:.2f}秒，"
+                     f"利用率 {item['utilization']:.1%}")
+    return lines
+
+
+def largest_first(files, indices=None, stats=None, history=None):
+    """
+    按预计耗时从大到小排列文件（最长任务优先），大文件尽早开始，小文件最后填补空闲的子进程
+
+    目录顺序下少数大文件排在最后时，只剩一个子进程在处理而其他子进程空闲；先处理大文件可以消除这段长尾。
+    预计耗时优先使用历史耗时（结果缓存或检查点中上次处理该路径的耗时，文件修改后仍可作为估计），
+    没有历史耗时的文件按大小估计：有历史耗时的文件按其平均每字节耗时换算，否则直接按大小比较。
+    无法获取状态的文件排在最后，预计耗时相同的文件保持原顺序。
+
+    Args:
+        files: 文件列表
+        indices: 要排列的文件序号，默认为全部
+        stats: {序号: 文件状态}，已获取的文件状态，其余文件在这里获取
+        history: {文件绝对路径字符串: 历史耗时秒}
+
+    Returns:
+        排列后的序号列表
+    """
+    indices = list(range(len(files))) if indices is None else list(indices)
+    stats = stats or {}
+    history = history or {}
+    sizes = {}
+    seconds = {}
+    for index in indices:
+        stat = stats.get(index)
+        if stat is None:
+            try:
+                stat = files[index].stat()
+            except OSError:
+                stat = None
+        sizes[index] = stat.st_size if stat is not None else None
+        if history:
+            duration = history.get(str(files[index].absolute()))
+            if duration:
+                seconds[index] = duration
+    known = [index for index in seconds if sizes[index]]
+    rate = sum(seconds[index] for index in known) / sum(sizes[index] for index in known) if known else None
+
+    def cost(index):
+        if rate is not None and index in seconds:
+            return seconds[index]
+        if sizes[index] is None:
+            return -1
+        return sizes[index] * rate if rate is not None else sizes[index]
+
+    return sorted(indices, key=cost, reverse=True)
+
+
+class _ProfiledCall:
+    """可序列化的包装器：在子进程中以剖析模式调用 func"""
+
+    def __init__(self, worker_dir, func):
+        self.worker_dir = worker_dir
+        self.func = func
+
+    def __call__(self, *args):
+        return profile_worker_call(self.worker_dir, self.func, *args)
+
+
+def format_duration(seconds):
+    """把秒数格式化为 时:分:秒"""
+    seconds = int(max(0, seconds))
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class RunControl:
+    """
+    一次提取运行的控制与进度计数，可在界面线程与工作线程之间共享
+
+    提取函数在文件之间调用 checkpoint()：暂停时在此等待，取消后返回False，
+    提取函数随即停止分配新文件，并用已提取的结果写出部分输出。
+    暂停的时间不计入吞吐量和剩余时间的估算。
+    """
+
+    def __init__(self):
+        self._cancel = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self._lock = threading.Lock()
+        self.total_files = 0
+        self.files_done = 0
+        self.rows_done = 0
+        self._started = None
+        self._paused_at = None
+        self._paused_total = 0.0
+
+    def start(self, total_files):
+        """开始计时，记录文件总数"""
+        with self._lock:
+            self.total_files = total_files
+            self.files_done = 0
+            self.rows_done = 0
+            self._started = time.monotonic()
+            self._paused_total = 0.0
+            if self._paused_at is not None:
+                self._paused_at = self._started
+
+    def advance(self, files=1, rows=0):
+        """记录完成的文件数和输出行数"""
+        with self._lock:
+            self.files_done += files
+            self.rows_done += rows
+
+    def cancel(self):
+        self._cancel.set()
+        # 解除暂停，使等待中的 checkpoint() 立即返回
+        self.resume()
+
+    def pause(self):
+        with self._lock:
+            if self._running.is_set() and not self._cancel.is_set():
+                self._paused_at = time.monotonic()
+                self._running.clear()
+
+    def resume(self):
+        with self._lock:
+            if not self._running.is_set():
+                self._paused_total += time.monotonic() - self._paused_at
+                self._paused_at = None
+                self._running.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def checkpoint(self):
+        """
+        文件之间的检查点：暂停时阻塞等待
+
+        Returns:
+            可以继续处理返回True，已取消返回False
+        """
+        self._running.wait()
+        return not self._cancel.is_set()
+
+    def elapsed(self):
+        """已用时间（秒），不含暂停时间"""
+        with self._lock:
+            if self._started is None:
+                return 0.0
+            now = self._paused_at if self._paused_at is not None else time.monotonic()
+            return now - self._started - self._paused_total
+
+    def snapshot(self):
+        """
+        当前进度与吞吐量
+
+        Returns:
+            字典：files_done, total_files, rows_done, elapsed, files_per_sec, rows_per_sec, eta（秒，无法估算时为None）
+        """
+        elapsed = self.elapsed()
+        files_done, total_files, rows_done = self.files_done, self.total_files, self.rows_done
+        files_per_sec = files_done / elapsed if elapsed > 0 else 0.0
+        eta = (total_files - files_done) / files_per_sec if files_per_sec > 0 else None
+        return {
+            "files_done": files_done,
+            "total_files": total_files,
+            "rows_done": rows_done,
+            "elapsed": elapsed,
+            "files_per_sec": files_per_sec,
+            "rows_per_sec": rows_done / elapsed if elapsed > 0 else 0.0,
+            "eta": eta,
+        }
+
+    def status_text(self):
+        """供界面显示的一行状态文本"""
+        snap = self.snapshot()
+        eta = format_duration(snap["eta"]) if snap["eta"] is not None else "--:--:--"
+        state = "已取消" if self.cancelled else "已暂停" if self.paused else "处理中"
+        return (f"{state}  {snap['files_done']}/{snap['total_files']} 个文件  "
+                f"{snap['files_per_sec']:.1f} 文件/秒  {snap['rows_per_sec']:.0f} 行/秒  "
+                f"已用 {format_duration(snap['elapsed'])}  剩余约 {eta}")
+
+
+class EventStream:
+    """
+    结构化事件流：每个事件写成一行JSON（JSON Lines），供调度系统等外部程序监控运行
+
+    事件（event 字段）：
+        run_start   - 运行开始：extractor（summary/details）、total_files、folders、output
+        file_done   - 一个文件处理完成：index、path、status、seconds、size、rows、reason
+        warning     - 文件级警告：path、kind（如 budget_mismatch、truncated）、message
+        throughput  - 吞吐量快照（每隔 interval 秒随 file_done 输出一次）：字段同 RunControl.snapshot()
+        run_end     - 运行结束：运行的汇总统计
+        run_error   - 运行出错：message
+    每行另有 time（Unix时间戳）与 elapsed（自运行开始的秒数）。
+    不需要事件流时调用方传入None，不产生任何开销。
+
+    Args:
+        target: 输出文件路径，"-" 表示标准输出，也可以是已打开的文本文件对象
+        interval: 吞吐量快照的间隔（秒）
+    """
+
+    def __init__(self, target, interval=5.0):
+        if target == "-":
+            self._file, self._owned = sys.stdout, False
+        elif hasattr(target, "write"):
+            self._file, self._owned = target, False
+        else:
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+            self._file, self._owned = open(target, "w", encoding="utf-8"), True
+        self.interval = interval
+        self._progress = RunControl()
+        self._start = time.perf_counter()
+        self._last_snapshot = self._start
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, target, interval=5.0):
+        """由参数得到事件流：None 表示不输出，已是 EventStream 时原样返回"""
+        if target is None or isinstance(target, cls):
+            return target
+        return cls(target, interval)
+
+    def emit(self, event, **fields):
+        """写出一个事件"""
+        line = json.dumps({"event": event, "time": round(time.time(), 3),
+                           "elapsed": round(time.perf_counter() - self._start, 3), **fields},
+                          ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def run_start(self, extractor, total_files, **fields):
+        self._progress.start(total_files)
+        self.emit("run_start", extractor=extractor, total_files=total_files, **fields)
+
+    def file_done(self, index, path, status, seconds=None, size=None, rows=None, reason=None):
+        self._progress.advance(rows=rows or 0)
+        self.emit("file_done", index=index, path=str(path), status=status,
+                  seconds=round(seconds, 4) if seconds is not None else None, size=size, rows=rows, reason=reason)
+        now = time.perf_counter()
+        if now - self._last_snapshot >= self.interval:
+            self._last_snapshot = now
+            self.throughput()
+
+    def warning(self, path, kind, message):
+        self.emit("warning", path=str(path), kind=kind, message=message)
+
+    def throughput(self):
+        snapshot = self._progress.snapshot()
+        self.emit("throughput", **{key: round(value, 3) if isinstance(value, float) else value
+                                   for key, value in snapshot.items() if key != "elapsed"})
+
+    def run_end(self, **fields):
+        self.throughput()
+        self.emit("run_end", **fields)
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+
+
+@contextmanager
+def events_on_stdout():
+    """
+    命令行 --events - 使用：产出写到标准输出的 EventStream，期间其余输出（包括子进程的输出）
+    改写到标准错误输出，使标准输出中只有事件行
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    file = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    try:
+        yield EventStream(file)
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        file.close()
+
+
+class UIEventChannel:
+    """
+    工作线程与图形界面主循环之间的事件通道
+
+    工作线程只向队列投递事件（日志文本、进度、待在主线程执行的函数），从不直接操作控件；
+    主循环通过 pump_channel() 定时取出并批量更新界面。
+    可作为 sys.stdout 的替代对象，print 的输出会变成日志事件。
+
+    Args:
+        progress_interval: 进度事件的最小间隔（秒），间隔内的中间进度被丢弃
+    """
+
+    def __init__(self, progress_interval=0.1):
+        self._queue = queue.SimpleQueue()
+        self.progress_interval = progress_interval
+        self._last_progress = 0.0
+
+    def write(self, text):
+        if text:
+            self._queue.put(("log", text))
+
+    def flush(self):
+        pass
+
+    def log(self, text):
+        self.write(text)
+
+    def progress(self, value):
+        """投递进度（百分比），限频；100%总是投递"""
+        now = time.monotonic()
+        if value >= 100 or now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            self._queue.put(("progress", value))
+
+    def post(self, func, *args):
+        """请求在界面主线程中调用 func(*args)"""
+        self._queue.put(("call", (func, args)))
+
+    def drain(self, max_events=5000):
+        """
+        取出当前积压的事件
+
+        Returns:
+            (合并后的日志文本, 最新进度或None, [(func, args), ...])
+        """
+        logs = []
+        progress = None
+        calls = []
+        for _ in range(max_events):
+            try:
+                kind, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "log":
+                logs.append(value)
+            elif kind == "progress":
+                progress = value
+            else:
+                calls.append(value)
+        return "".join(logs), progress, calls
+
+
+def pump_channel(root, channel, log_widget, on_progress, interval_ms=100, max_log_lines=5000):
+    """
+    在Tk主循环中定时处理 UIEventChannel 的事件
+
+    日志合并为一次插入，日志控件超过 max_log_lines 行时删除最早的行。
+
+    Args:
+        root: Tk根窗口
+        channel: UIEventChannel
+        log_widget: 显示日志的Text控件
+        on_progress: 进度更新函数，参数为百分比
+        interval_ms: 处理间隔（毫秒）
+        max_log_lines: 日志控件保留的最大行数
+    """
+    def tick():
+        # 先安排下一次处理，回调中弹出模态对话框或出错时事件仍会继续被处理
+        root.after(interval_ms, tick)
+        text, progress, calls = channel.drain()
+        if text:
+            log_widget.insert("end", text)
+            lines = int(log_widget.index("end-1c").split(".")[0])
+            if lines > max_log_lines:
+                log_widget.delete("1.0", f"{lines - max_log_lines + 1}.0")
+            log_widget.see("end")
+        if progress is not None:
+            on_progress(progress)
+        for func, args in calls:
+            func(*args)
+
+    tick()
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+预算文件提取的本地HTTP服务。
+
+常驻进程内保持一组已完成导入的工作进程，避免每批文件都重新启动解释器和导入pandas/openpyxl。
+只依赖标准库，默认只监听127.0.0.1。
+
+接口：
+    GET  /health                    服务状态
+    GET  /metrics                   请求数、处理文件数、耗时等运行指标
+    POST /extract                   JSON请求体 {"folder": "文件夹路径", "recursive": false,
+                                    "archives": false, "content": true, "details": true}
+    POST /extract/upload?filename=预算单.xlsx
+                                    请求体为工作簿文件的原始字节
+
+返回JSON：{"files": [{"文件名", "路径", "状态", "内容", "明细", "明细截断", "耗时", "错误"}, ...], ...}
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from dlzb_runtime import EXCEL_SUFFIXES, check_folders, discover_excel_files, percentile
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+# 工作进程中用于报告任务开始时间的队列（见 _warm_worker）
+_task_starts = None
+
+
+def _warm_worker(task_starts=None):
+    """
+    工作进程初始化：预先导入提取模块及其依赖，并屏蔽提取过程中的打印输出
+
+    Args:
+        task_starts: multiprocessing队列，任务开始时放入 (任务号, time.time())，服务据此从开始时刻计算超时
+    """
+    global _task_starts
+    _task_starts = task_starts
+    sys.stdout = open(os.devnull, "w", encoding="utf-8")
+    import openpyxl  # noqa: F401
+    import xlrd  # noqa: F401
+    import dlzb_budget_file  # noqa: F401
+    import dlzb_buget_file_details  # noqa: F401
+
+
+def _ping():
+    return os.getpid()
+
+
+def _report_start(task_id):
+    """在工作进程中报告任务开始处理的时间"""
+    if _task_starts is not None:
+        _task_starts.put((task_id, time.time()))
+
+
+def _extract_task(task_id, file_path, content, details, streaming_threshold_mb, max_rows):
+    """工作进程任务：提取单个文件的表头内容和明细行"""
+    _report_start(task_id)
+    from dlzb_budget_file import _process_file_task
+    from dlzb_buget_file_details import _extract_file_task
+    start = time.perf_counter()
+    result = {"内容": None, "明细": None, "明细截断": False}
+    if content:
+        file_data, _ = _process_file_task(file_path, True, streaming_threshold_mb)
+        if file_data is not None:
+            file_data = dict(file_data)
+            result["来源"] = file_data.pop("_来源", {})
+        result["内容"] = file_data
+    if details:
+        rows, truncated, _, _, _ = _extract_file_task(file_path, streaming_threshold_mb, max_rows)
+        result["明细"] = rows
+        result["明细截断"] = truncated
+    result["耗时"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+class ServiceMetrics:
+    """服务运行指标，供 /metrics 接口输出（线程安全）"""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.responses = {}
+        self.rejected = 0
+        self.in_flight = 0
+        self.files_ok = 0
+        self.files_failed = 0
+        self.latencies = deque(maxlen=window)
+
+    def begin(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.in_flight += 1
+
+    def end(self, status, seconds):
+        with self._lock:
+            self.responses[str(status)] = self.responses.get(str(status), 0) + 1
+            self.in_flight -= 1
+            self.latencies.append(seconds)
+
+    def count_files(self, ok, failed):
+        with self._lock:
+            self.files_ok += ok
+            self.files_failed += failed
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def summary(self):
+        with self._lock:
+            latencies = list(self.latencies)
+            return {
+                "uptime_seconds": round(time.time() - self.started, 1),
+                "requests": dict(self.requests),
+                "responses": dict(self.responses),
+                "rejected_busy": self.rejected,
+                "in_flight": self.in_flight,
+                "files_ok": self.files_ok,
+                "files_failed": self.files_failed,
+                "latency_mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+                "latency_p95": round(percentile(latencies, 95), 4) if latencies else 0.0,
+            }
+
+
+class ExtractionService:
+    """
+    常驻的提取服务：持有预热的进程池、并发限制和运行指标
+
+    进程池由并发的请求共用。每个文件的超时从它在工作进程中实际开始处理时计算，不受排队时间影响；
+    超时的文件所在的工作进程无法单独终止，因此整个进程池被回收并重新预热，
+    其他请求中因回收而中断的文件在新的进程池中重新提交（最多 MAX_RESUBMITS 次）。
+
+    Args:
+        workers: 工作进程数量
+        max_concurrent: 同时处理的请求数上限，超出时返回503
+        timeout: 单个文件的处理时间上限（秒）
+        max_upload_mb: 上传工作簿的大小上限（MB）
+        streaming_threshold_mb: 超过该大小（MB）的.xlsx文件使用只读流式读取
+        max_rows: 单个文件的明细行数上限
+    """
+
+    # 等待结果时检查超时的间隔（秒）
+    poll_interval = 0.1
+
+    # 因进程池回收而中断的文件最多重新提交的次数
+    MAX_RESUBMITS = 2
+
+    # 工作进程中执行的任务函数（参数同 _extract_task），须能在工作进程中按模块名导入
+    task = staticmethod(_extract_task)
+
+    def __init__(self, workers=2, max_concurrent=4, timeout=60, max_upload_mb=50, streaming_threshold_mb=5,
+                 max_rows=None):
+        from dlzb_buget_file_details import MAX_DETAIL_ROWS
+        self.workers = max(1, workers)
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_upload_bytes = int(max_upload_mb * 1024 * 1024)
+        self.streaming_threshold_mb = streaming_threshold_mb
+        self.max_rows = max_rows or MAX_DETAIL_ROWS
+        self.metrics = ServiceMetrics()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._ctx = multiprocessing.get_context()
+        self._task_ids = itertools.count()
+        self.pool_restarts = 0
+        self._starts_lock = threading.Lock()
+        self._task_started = {}
+        # 因超时而主动回收的进程池，其中中断的文件可以重新提交
+        self._recycled = weakref.WeakSet()
+        self._start_pool()
+
+    def _start_pool(self):
+        """创建进程池，并让每个工作进程完成导入后再开始接收请求"""
+        starts = self._ctx.Queue()
+        threading.Thread(target=self._collect_starts, args=(starts,), name="dlzb-task-starts", daemon=True).start()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._ctx, initializer=_warm_worker,
+                                         initargs=(starts,))
+        self._pool.task_starts = starts
+        for future in [self._pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def _collect_starts(self, starts):
+        """记录工作进程报告的任务开始时间，收到None（进程池已停止）时结束"""
+        while True:
+            item = starts.get()
+            if item is None:
+                break
+            with self._starts_lock:
+                self._task_started[item[0]] = item[1]
+
+    def _stop_pool(self, pool, kill=False):
+        """停止进程池；kill 为True时先终止其中的工作进程（用于回收有文件超时的进程池）"""
+        if kill:
+            for process in list((getattr(pool, "_processes", None) or {}).values()):
+                process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool.task_starts.put(None)
+
+    def _restart_pool(self, broken, recycle=False):
+        """
+        用新的进程池替换 broken（其他请求已替换时不重复替换）
+
+        Args:
+            recycle: 是否因文件超时主动回收：终止其中的工作进程，被中断的文件可重新提交
+        """
+        with self._pool_lock:
+            if recycle:
+                self._recycled.add(broken)
+            if self._pool is broken:
+                self._stop_pool(broken, kill=recycle)
+                self._start_pool()
+                self.pool_restarts += 1
+
+    def _submit(self, file, content, details):
+        """提交一个文件，返回 (进程池, 任务号, future)"""
+        with self._pool_lock:
+            pool = self._pool
+            task_id = next(self._task_ids)
+            future = pool.submit(self.task, task_id, str(file), content, details, self.streaming_threshold_mb,
+                                 self.max_rows)
+        return pool, task_id, future
+
+    def _wait(self, task_id, future):
+        """
+        等待任务结果，超时从任务在工作进程中开始处理时计算
+
+        Raises:
+            FutureTimeout: 处理时间超过 timeout
+            BrokenProcessPool: 进程池已损坏或被回收
+        """
+        try:
+            while True:
+                with self._starts_lock:
+                    started = self._task_started.get(task_id)
+                wait = self.poll_interval
+                if self.timeout and started is not None:
+                    wait = min(wait, max(0.0, started + self.timeout - time.time()))
+                try:
+                    return future.result(timeout=wait)
+                except FutureTimeout:
+                    if self.timeout and started is not None and time.time() - started >= self.timeout:
+                        raise
+        finally:
+            with self._starts_lock:
+                self._task_started.pop(task_id, None)
+
+    def try_acquire(self):
+        """占用一个并发名额，已满时返回False"""
+        if self._slots.acquire(blocking=False):
+            return True
+        self.metrics.reject()
+        return False
+
+    def release(self):
+        self._slots.release()
+
+    def extract_files(self, files, content=True, details=True, display_names=None):
+        """
+        在进程池中提取一组文件
+
+        Args:
+            files: 文件路径列表
+            content: 是否提取表头内容（extract_excel_content 的结果）
+            details: 是否提取明细行
+            display_names: 结果中显示的路径（上传文件使用原始文件名），默认为文件路径
+
+        Returns:
+            每个文件一条结果的列表，顺序与 files 相同
+        """
+        submitted = [self._submit(file, content, details) for file in files]
+        resubmits = [0] * len(files)
+        results = []
+        for index, file in enumerate(files):
+            shown = display_names[index] if display_names else str(file)
+            item = {"文件名": Path(shown).stem, "路径": shown}
+            while True:
+                pool, task_id, future = submitted[index]
+                try:
+                    value = self._wait(task_id, future)
+                    item["状态"] = "ok"
+                    item.update(value)
+                    if display_names:
+                        _replace_path(item, str(file), shown)
+                except FutureTimeout:
+                    # 卡住的工作进程只能随进程池一起终止，其余文件在新的进程池中重新提交
+                    self._restart_pool(pool, recycle=True)
+                    item.update({"状态": "timeout", "错误": f"处理超过{self.timeout}秒"})
+                except (BrokenProcessPool, CancelledError) as e:
+                    # 进程池被回收或替换时，正在处理的文件中断、尚未开始的文件被取消
+                    interrupted = pool in self._recycled or isinstance(e, CancelledError)
+                    if interrupted and resubmits[index] < self.MAX_RESUBMITS:
+                        resubmits[index] += 1
+                        self._resubmit_interrupted(files, submitted, index, content, details)
+                        continue
+                    self._restart_pool(pool)
+                    item.update({"状态": "crashed", "错误": "工作进程异常退出"})
+                except Exception as e:
+                    item.update({"状态": "error", "错误": str(e)})
+                break
+            results.append(item)
+        ok = sum(1 for item in results if item["状态"] == "ok")
+        self.metrics.count_files(ok, len(results) - ok)
+        return results
+
+    def _resubmit_interrupted(self, files, submitted, start, content, details):
+        """把从 start 起、在已回收的进程池中被中断的文件重新提交到当前进程池"""
+        for index in range(start, len(files)):
+            pool, task_id, future = submitted[index]
+            if pool is not self._pool and future.done() and (
+                    future.cancelled() or isinstance(future.exception(), BrokenProcessPool)):
+                with self._starts_lock:
+                    self._task_started.pop(task_id, None)
+                submitted[index] = self._submit(files[index], content, details)
+
+    def health(self):
+        return {"status": "ok", "workers": self.workers, "max_concurrent": self.max_concurrent,
+                "in_flight": self.metrics.in_flight, "pool_restarts": self.pool_restarts, "pid": os.getpid()}
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._pool.task_starts.put(None)
+
+
+def _replace_path(item, real_path, shown):
+    """把上传文件在临时目录中的路径替换为原始文件名"""
+    if item.get("内容"):
+        item["内容"]["文件路径"] = shown
+    for row in item.get("明细") or ():
+        if row.get("操作") == real_path:
+            row["操作"] = shown
+
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    """HTTP请求处理，服务对象通过 self.server.service 访问"""
+
+    server_version = "dlzb-extract/1.0"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        service = self.server.service
+        if path == "/health":
+            self._send(200, service.health())
+        elif path == "/metrics":
+            self._send(200, service.metrics.summary())
+        else:
+            self._send(404, {"error": f"未知路径 {path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path not in ("/extract", "/extract/upload"):
+            self._send(404, {"error": f"未知路径 {url.path}"})
+            return
+        if not service.try_acquire():
+            self._send(503, {"error": "服务繁忙，请稍后重试"}, {"Retry-After": "1"})
+            return
+        start = time.perf_counter()
+        service.metrics.begin(url.path)
+        status = 500
+        try:
+            if url.path == "/extract":
+                status, body = self._extract_folder()
+            else:
+                status, body = self._extract_upload(parse_qs(url.query))
+            if status == 200:
+                body["elapsed_seconds"] = round(time.perf_counter() - start, 4)
+            self._send(status, body)
+        except Exception as e:
+            self._send(500, {"error": str(e)})
+        finally:
+            service.metrics.end(status, time.perf_counter() - start)
+            service.release()
+
+    def _read_body(self, limit):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > limit:
+            return None
+        return self.rfile.read(length)
+
+    def _extract_folder(self):
+        service = self.server.service
+        raw = self._read_body(1024 * 1024)
+        if raw is None:
+            return 413, {"error": "请求体过大"}
+        try:
+            request = json.loads(raw or b"{}")
+        except ValueError:
+            return 400, {"error": "请求体不是有效的JSON"}
+        if not isinstance(request, dict):
+            return 400, {"error": "请求体应为JSON对象"}
+        folder = request.get("folder")
+        if not folder:
+            return 400, {"error": "缺少 folder 参数"}
+        error = check_folders(folder)
+        if error:
+            return 404, {"error": error}
+        files = discover_excel_files(folder, bool(request.get("recursive")), bool(request.get("archives")))
+        results = service.extract_files(files, request.get("content", True), request.get("details", True))
+        return 200, {"folder": str(folder), "total_files": len(files), "files": results}
+
+    def _extract_upload(self, query):
+        service = self.server.service
+        filename = Path((query.get("filename") or ["上传文件.xlsx"])[0]).name
+        if Path(filename).suffix.lower() not in EXCEL_SUFFIXES:
+            return 400, {"error": f"不支持的文件格式: {Path(filename).suffix}"}
+        data = self._read_body(service.max_upload_bytes)
+        if data is None:
+            return 413, {"error": f"上传文件超过{service.max_upload_bytes // (1024 * 1024)}MB"}
+        if not data:
+            return 400, {"error": "请求体为空"}
+        content = (query.get("content") or ["1"])[0] not in ("0", "false")
+        details = (query.get("details") or ["1"])[0] not in ("0", "false")
+        # 保留原始文件名，文件名本身也是提取预算编号的依据
+        with tempfile.TemporaryDirectory(prefix="dlzb_upload_") as tmp:
+            path = Path(tmp) / filename
+            path.write_bytes(data)
+            results = service.extract_files([path], content, details, display_names=[filename])
+        return 200, {"total_files": 1, "files": results}
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, **service_options):
+    """
+    创建HTTP服务（尚未开始监听循环）
+
+    port为0时由系统分配端口，可通过 server.server_address 获取，便于在本机测试。
+    调用方负责 server.serve_forever() 以及结束时 server.shutdown() / server.service.close()。
+    """
+    server = ThreadingHTTPServer((host, port), ExtractionHandler)
+    server.daemon_threads = True
+    server.service = ExtractionService(**service_options)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="预算文件提取本地HTTP服务")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"监听地址（默认：{DEFAULT_HOST}）")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"监听端口（默认：{DEFAULT_PORT}）")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="工作进程数量")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="同时处理的请求数上限")
+    parser.add_argument("--timeout", type=float, default=60, help="单个文件的处理时间上限（秒）")
+    parser.add_argument("--max-upload", type=float, default=50, help="上传工作簿的大小上限（MB）")
+    parser.add_argument("--streaming-threshold", type=float, default=5,
+                        help="超过该大小（MB）的.xlsx文件使用只读流式读取，0表示不启用（默认：5）")
+    args = parser.parse_args(argv)
+
+    try:
+        server = make_server(args.host, args.port, workers=args.workers, max_concurrent=args.max_concurrent,
+                             timeout=args.timeout, max_upload_mb=args.max_upload,
+                             streaming_threshold_mb=args.streaming_threshold or None)
+    except OSError as e:
+        print(f"无法启动服务：{e}", file=sys.stderr)
+        return 1
+    host, port = server.server_address[:2]
+    print(f"提取服务已启动：http://{host}:{port}（工作进程 {args.workers} 个，Ctrl+C 停止）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+逐文件提取结果的持久化存储（SQLite）。
+
+以 (路径, 文件大小, 修改时间) 判断文件是否变化，未变化的文件直接复用上次的提取结果，
+不必重新打开工作簿。同一结构既用作跨运行的结果缓存，也用作单次运行的检查点：
+检查点定期提交，运行中断后以相同参数重新运行即可从中断处继续。
+
+分片运行的部分结果（每个分片的提取结果与可合并的统计数据）也在这里读写。
+
+工作簿单元格快照（提取规则读取的表头区域与明细块）按文件内容哈希保存在 SnapshotStore 中，
+修改提取规则后可以只按快照重新运行，不必重新打开原始文件。
+"""
+
+import hashlib
+import pickle
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+
+from dlzb_runtime import excel_path, open_binary
+
+# 缓存目录中的数据库文件名
+CACHE_FILENAME = "dlzb_cache.sqlite"
+
+# 快照库的默认文件名
+SNAPSHOT_FILENAME = "dlzb_snapshots.sqlite"
+
+# 分片部分结果的文件格式标识、版本与后缀
+PARTIAL_FORMAT = "dlzb-partial"
+PARTIAL_VERSION = 1
+PARTIAL_SUFFIX = ".dlzbpart"
+
+
+def default_checkpoint_path(output_path):
+    """检查点文件默认与输出文件放在一起：<输出文件名>_检查点.sqlite"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}_检查点.sqlite")
+
+
+def default_partial_path(output_path, shard):
+    """分片部分结果默认与输出文件放在一起：<输出文件名>_分片I-K.dlzbpart"""
+    output_path = Path(output_path)
+    index, count = shard
+    return output_path.with_name(f"{output_path.stem}_分片{index}-{count}{PARTIAL_SUFFIX}")
+
+
+def default_snapshot_path(output_path):
+    """快照库默认与输出文件放在同一目录：dlzb_snapshots.sqlite"""
+    return Path(output_path).with_name(SNAPSHOT_FILENAME)
+
+
+def check_run_options(output_path, snapshots=None, rules_only=False, changes=None, cache_dir=None, shard=None):
+    """
+    检查快照库、结果缓存与变化报告相关的运行参数（不访问输入文件夹）
+
+    Returns:
+        错误信息，参数有效时返回None
+    """
+    if rules_only:
+        snapshot_path = default_snapshot_path(output_path) if snapshots in (None, True) else Path(snapshots)
+        if not snapshot_path.exists():
+            return f"错误：快照库 {snapshot_path} 不存在！"
+    if changes and (not cache_dir or shard or rules_only):
+        return "错误：变化报告需要结果缓存（cache_dir），且不能用于分片或只按快照运行！"
+    return None
+
+
+def content_hash(path, chunk_size=1 << 20):
+    """文件内容的SHA-1，内容相同的文件（复制、改名后的文件，或归档中的同一文件）共用同一份快照"""
+    digest = hashlib.sha1()
+    with open_binary(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_fingerprint(*parts):
+    """由运行参数生成简短的指纹，参数不同的运行不会复用彼此的检查点"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def remove_store(db_path):
+    """删除存储文件（运行正常完成后清理检查点）"""
+    db_path = Path(db_path)
+    for path in [db_path] + [db_path.with_name(db_path.name + suffix) for suffix in ("-journal", "-wal", "-shm")]:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ResultStore:
+    """
+    基于SQLite的逐文件结果存储
+
+    每条记录以 (kind, path) 为主键，kind 区分不同的提取器及其选项，
+    payload 为提取结果的pickle序列化数据。
+
+    Args:
+        db_path: 数据库文件路径
+        kind: 记录类别
+        commit_every: 每写入多少条记录自动提交一次，None表示只在 commit()/close() 时提交
+    """
+
+    def __init__(self, db_path, kind, commit_every=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.kind = kind
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " kind TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, mtime_ns INTEGER,"
+            " duration REAL, payload BLOB, updated REAL,"
+            " PRIMARY KEY (kind, path))"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def in_dir(cls, cache_dir, kind):
+        """在缓存目录中打开存储"""
+        return cls(Path(cache_dir) / CACHE_FILENAME, kind)
+
+    @classmethod
+    def checkpoint(cls, db_path, kind):
+        """
+        打开运行检查点，并丢弃参数不同的旧运行留下的记录
+
+        每完成一个文件即提交。使用WAL日志且不在每次提交时强制刷盘，提交开销很小；
+        进程崩溃不会丢失已提交的结果，断电时可能丢失最近的少量文件。
+        """
+        store = cls(db_path, kind, commit_every=1)
+        store.conn.execute("PRAGMA journal_mode=WAL")
+        store.conn.execute("PRAGMA synchronous=NORMAL")
+        store.conn.execute("DELETE FROM results WHERE kind != ?", (kind,))
+        store.conn.commit()
+        return store
+
+    def count(self):
+        """当前类别的记录数"""
+        return self.conn.execute("SELECT COUNT(*) FROM results WHERE kind = ?", (self.kind,)).fetchone()[0]
+
+    def get(self, path, stat):
+        """
+        读取未变化文件的缓存结果
+
+        Args:
+            path: 文件路径
+            stat: 文件当前的 os.stat_result
+
+        Returns:
+            缓存的结果，文件不在缓存中或已变化时返回None
+        """
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, payload FROM results WHERE kind = ? AND path = ?",
+            (self.kind, str(path)),
+        ).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        try:
+            return pickle.loads(row[2])
+        except Exception:
+            return None
+
+    def durations(self):
+        """
+        当前类别各文件上次的处理耗时 {路径: 秒}
+
+        不比较大小和修改时间：文件修改后需要重新处理，上次的耗时仍可用来估计这次的耗时（见 largest_first）。
+        """
+        return dict(self.conn.execute(
+            "SELECT path, duration FROM results WHERE kind = ? AND duration > 0", (self.kind,)
+        ).fetchall())
+
+    def results(self, folders, recursive=False):
+        """
+        当前类别中位于指定文件夹的全部结果 {路径: 结果}，不比较文件大小和修改时间
+
+        运行开始前读取即为上次运行的结果，供变化报告与本次的结果比较（见 dlzb_reports.compare_runs）；
+        无法反序列化的记录被忽略。
+
+        Args:
+            folders: 文件夹路径列表
+            recursive: 是否包括子文件夹中的文件（ZIP归档中的文件视为位于归档所在的文件夹）
+        """
+        folder_set = {Path(folder).absolute() for folder in folders}
+        results = {}
+        for path, payload in self.conn.execute("SELECT path, payload FROM results WHERE kind = ?", (self.kind,)):
+            location = excel_path(path)
+            parents = location.parents if recursive else [location.parent]
+            if not any(parent in folder_set for parent in parents):
+                continue
+            try:
+                results[path] = pickle.loads(payload)
+            except Exception:
+                continue
+        return results
+
+    def discard(self, paths):
+        """删除当前类别中这些路径的结果（如已删除的文件），需调用 commit() 落盘"""
+        self.conn.executemany("DELETE FROM results WHERE kind = ? AND path = ?",
+                              [(self.kind, str(path)) for path in paths])
+
+    def put(self, path, stat, payload, duration=0.0):
+        """写入（或覆盖）一个文件的结果，未设置自动提交时需调用 commit() 落盘"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (kind, path, size, mtime_ns, duration, payload, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.kind, str(path), stat.st_size, stat.st_mtime_ns, duration,
+             pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), time.time()),
+        )
+        self._uncommitted += 1
+        if self.commit_every and self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class SnapshotStore:
+    """
+    基于SQLite的工作簿单元格快照库
+
+    snapshots 表以文件内容哈希为主键，每份快照分为两部分：header 为汇总提取器读取的表头区域，
+    details 为明细提取器读取的明细块，各自为zlib压缩的pickle数据，由对应的提取器写入；
+    files 表记录每个路径最近一次读取时的大小、修改时间与内容哈希；
+    discovery 表记录每个路径在最近一次查找文件时的顺序。
+    只按快照运行提取规则时，文件列表与单元格都来自快照库，不访问原始文件，文件顺序与查找时相同。
+
+    Args:
+        db_path: 数据库文件路径
+        commit_every: 每写入多少份快照自动提交一次
+    """
+    PARTS = ("header", "details")
+
+    def __init__(self, db_path, commit_every=100):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (hash TEXT PRIMARY KEY, header BLOB, details BLOB)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT NOT NULL, updated REAL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS discovery (path TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        self.conn.commit()
+
+    @classmethod
+    def _column(cls, part):
+        if part not in cls.PARTS:
+            raise ValueError(f"错误：未知的快照部分 {part}！")
+        return part
+
+    def has(self, path, stat, part):
+        """文件未变化且已有该部分快照"""
+        row = self.conn.execute(
+            f"SELECT f.size, f.mtime_ns, s.{self._column(part)} IS NOT NULL"
+            " FROM files f JOIN snapshots s ON s.hash = f.hash WHERE f.path = ?",
+            (str(path),),
+        ).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns and bool(row[2])
+
+    def put(self, path, part, snapshot):
+        """
+        写入一个文件的一部分快照
+
+        Args:
+            path: 文件路径
+            part: "header" 或 "details"
+            snapshot: {"hash": 内容哈希, "size": 文件大小, "mtime_ns": 修改时间, "data": 快照内容}
+        """
+        column = self._column(part)
+        blob = zlib.compress(pickle.dumps(snapshot["data"], protocol=pickle.HIGHEST_PROTOCOL))
+        self.conn.execute("INSERT OR IGNORE INTO snapshots (hash) VALUES (?)", (snapshot["hash"],))
+        self.conn.execute(f"UPDATE snapshots SET {column} = ? WHERE hash = ?", (blob, snapshot["hash"]))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, updated) VALUES (?, ?, ?, ?, ?)",
+            (str(path), snapshot["size"], snapshot["mtime_ns"], snapshot["hash"], time.time()),
+        )
+        self._uncommitted += 1
+        if self.commit_every and self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def get(self, path, part):
+        """
+        读取一个文件的一部分快照
+
+        Returns:
+            (快照内容, 文件大小)，没有该部分快照时返回None
+        """
+        row = self.conn.execute(
+            f"SELECT s.{self._column(part)}, f.size FROM files f JOIN snapshots s ON s.hash = f.hash"
+            " WHERE f.path = ?",
+            (str(path),),
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return pickle.loads(zlib.decompress(row[0])), row[1]
+
+    def record_order(self, files):
+        """
+        记录一次查找文件得到的文件顺序，只按快照运行时按此顺序输出
+
+        Args:
+            files: discover_excel_files 返回的文件列表
+        """
+        self.conn.executemany("INSERT OR REPLACE INTO discovery (path, seq) VALUES (?, ?)",
+                              ((str(file.absolute()), seq) for seq, file in enumerate(files)))
+        self.commit()
+
+    def paths(self, part, folders, recursive=False):
+        """
+        快照库中位于指定文件夹、且有该部分快照的文件路径
+
+        路径按输入文件夹的顺序排列，同一文件夹内按最近一次查找文件时的顺序（见 record_order）排列，
+        没有记录顺序的路径排在最后并按路径排序；不访问文件夹本身。
+
+        Args:
+            part: "header" 或 "details"
+            folders: 文件夹路径列表
+            recursive: 是否包括子文件夹中的文件
+
+        Returns:
+            文件Path列表（ZIP归档中的文件为 ArchiveMember，视为位于归档所在的文件夹）
+        """
+        rows = self.conn.execute(
+            f"SELECT f.path FROM files f JOIN snapshots s ON s.hash = f.hash LEFT JOIN discovery d ON d.path = f.path"
+            f" WHERE s.{self._column(part)} IS NOT NULL ORDER BY d.seq IS NULL, d.seq, f.path"
+        ).fetchall()
+        stored = [excel_path(row[0]) for row in rows]
+        seen = set()
+        paths = []
+        for folder in folders:
+            folder = Path(folder).absolute()
+            for path in stored:
+                inside = folder in path.parents if recursive else path.parent == folder
+                if inside and path not in seen:
+                    seen.add(path)
+                    paths.append(path)
+        return paths
+
+    def summary(self):
+        """快照库概况：路径数、快照数、各部分的快照数与压缩后字节数"""
+        info = {
+            "files": self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+            "snapshots": self.conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0],
+        }
+        for part in self.PARTS:
+            count, size = self.conn.execute(
+                f"SELECT COUNT({part}), COALESCE(SUM(LENGTH({part})), 0) FROM snapshots").fetchone()
+            info[part] = {"count": count, "bytes": size}
+        return info
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def save_partial(path, kind, shard, options, records, stats, **fields):
+    """
+    写入一个分片的部分结果（先写临时文件再替换，中途失败不会留下残缺文件）
+
+    Args:
+        path: 部分结果文件路径
+        kind: 提取器类别（"summary" 或 "details"），合并时据此选择合并方式
+        shard: (序号, 分片数)
+        options: 影响结果内容的运行参数，只有参数相同的分片才能合并
+        records: [(分片键, 结果), ...]，结果为该文件的提取结果，文件失败时为None
+        stats: 该分片可合并的统计数据
+        fields: 其他附加信息（如 folders、elapsed_seconds、cancelled）
+
+    Returns:
+        部分结果文件的Path对象
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {"format": PARTIAL_FORMAT, "version": PARTIAL_VERSION, "kind": kind, "shard": tuple(shard),
+               "options": options, "records": records, "stats": stats, **fields}
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(path)
+    return path
+
+
+def load_partials(paths, kind=None, allow_missing=False):
+    """
+    读取并校验一组分片部分结果（部分结果为pickle格式，只应加载可信来源的文件）
+
+    Args:
+        paths: 部分结果文件路径列表
+        kind: 期望的提取器类别，None表示不限但要求所有分片一致
+        allow_missing: 是否允许缺少部分分片（合并出的结果不完整）
+
+    Returns:
+        按分片序号排序的部分结果字典列表
+
+    Raises:
+        ValueError: 文件不是部分结果、类别/分片数/运行参数不一致、分片重复或缺少分片
+    """
+    partials = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                partial = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            raise ValueError(f"错误：无法读取分片文件 {path}：{e}")
+        if not isinstance(partial, dict) or partial.get("format") != PARTIAL_FORMAT:
+            raise ValueError(f"错误：{path} 不是分片部分结果文件！")
+        if partial["version"] != PARTIAL_VERSION:
+            raise ValueError(f"错误：{path} 的格式版本 {partial['version']} 不受支持！")
+        partial["path"] = str(path)
+        partials.append(partial)
+    if not partials:
+        raise ValueError("错误：没有指定分片文件！")
+
+    first = partials[0]
+    seen = {}
+    for partial in partials:
+        if kind is not None and partial["kind"] != kind:
+            raise ValueError(f"错误：{partial['path']} 是 {partial['kind']} 的结果，不能作为 {kind} 合并！")
+        if partial["kind"] != first["kind"]:
+            raise ValueError(f"错误：{partial['path']} 与 {first['path']} 来自不同的提取器！")
+        if partial["shard"][1] != first["shard"][1]:
+            raise ValueError(f"错误：{partial['path']} 与 {first['path']} 的分片数不同！")
+        if partial["options"] != first["options"]:
+            raise ValueError(f"错误：{partial['path']} 与 {first['path']} 的运行参数不同！")
+        index = partial["shard"][0]
+        if index in seen:
+            raise ValueError(f"错误：分片 {index} 重复（{seen[index]} 与 {partial['path']}）！")
+        seen[index] = partial["path"]
+    missing = [index for index in range(first["shard"][1]) if index not in seen]
+    if missing and not allow_missing:
+        raise ValueError(f"错误：缺少分片 {', '.join(map(str, missing))}！")
+    return sorted(partials, key=lambda partial: partial["shard"][0])
+
+
+def missing_shards(partials):
+    """已加载的部分结果中缺少的分片序号"""
+    present = {partial["shard"][0] for partial in partials}
+    return [index for index in range(partials[0]["shard"][1]) if index not in present]